@@ -0,0 +1,84 @@
+"""
+Benchmark check_site_versions on a generated history of site versions.
+
+Each of --sites urls gets --versions versions, a month apart, and some of them are broken the ways the command
+looks for. The versions are written to a throwaway test database. Run from the repository root against the testing
+database settings:
+
+    DJANGO_SETTINGS_MODULE=openedxstats.settings.testing python benchmarks/check_site_versions.py --sites 200000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'openedxstats.settings.testing')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+
+from openedxstats.apps.sites.management.commands.check_site_versions import (  # noqa: E402
+    find_anomalies, repair_versions,
+)
+from openedxstats.apps.sites.models import Language, Site, TagSet  # noqa: E402
+
+
+def generate_versions(num_sites, num_versions):
+    """
+    Insert the versions with SQL: every 10th url has two current versions, and every 7th url's versions after the
+    first lost their languages.
+    """
+    Language.objects.get_or_create(name='English')
+    tag_set_id = TagSet.id_for(['English'], [])
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {Site._meta.db_table} (site_type, name, url, is_private_instance, is_gone, course_count,
+                active_start_date, active_end_date, org_type, github_fork, notes, course_type, aliases, hosts,
+                valid_during, last_modified)
+            SELECT 'General', '', 'https://site' || s || '.example.org', false, false, v,
+                start, finish, '', '', '', 'Unknown', '{{}}', ARRAY['site' || s || '.example.org'],
+                tstzrange(start, finish, '[]'), now()
+            FROM generate_series(1, %s) s, generate_series(1, %s) v,
+                LATERAL (SELECT timestamp '2016-01-01' + (v - 1) * interval '1 month' AS start) starts,
+                LATERAL (SELECT CASE WHEN v = %s OR (s %% 10 = 0 AND v = %s - 1) THEN NULL
+                                     ELSE start + interval '1 month' END AS finish) finishes
+        """, [num_sites, num_versions, num_versions, num_versions])
+        cursor.execute(f"""
+            UPDATE {Site._meta.db_table} SET tag_set_id = %s
+            WHERE substring(url from 'site(\\d+)')::int %% 7 <> 0 OR active_start_date = %s
+        """, [tag_set_id, '2016-01-01'])
+        cursor.execute("ANALYZE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sites', type=int, default=200000)
+    parser.add_argument('--versions', type=int, default=5)
+    args = parser.parse_args()
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        generate_versions(args.sites, args.versions)
+        print(f"{args.sites * args.versions} versions of {args.sites} urls")
+
+        began = time.perf_counter()
+        anomalies = find_anomalies()
+        print(f"check:  {time.perf_counter() - began:8.3f}s  "
+              + ", ".join(f"{name}: {len(versions)}" for name, versions in anomalies.items()))
+
+        began = time.perf_counter()
+        repaired = repair_versions(tags=True)
+        print(f"repair: {time.perf_counter() - began:8.3f}s  {repaired}")
+
+        assert not any(find_anomalies().values()), "the repair left anomalies"
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
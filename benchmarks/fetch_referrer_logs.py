@@ -0,0 +1,94 @@
+"""
+Benchmark fetch_referrer_logs.process_keys with one worker against a thread pool.
+
+Runs offline: the logs are generated into an in-memory log source, and each file's read is delayed by --latency
+seconds to stand in for the S3 round trip. Both runs write to a throwaway test database.
+Run from the repository root against the testing database settings:
+
+    DJANGO_SETTINGS_MODULE=openedxstats.settings.testing python benchmarks/fetch_referrer_logs.py --files 100 --workers 16
+"""
+import argparse
+import gzip
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'openedxstats.settings.testing')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+
+from openedxstats.apps.sites.management.commands import fetch_referrer_logs  # noqa: E402
+from openedxstats.apps.sites.models import AccessLogAggregate, DomainDailyTraffic, FilenameLog  # noqa: E402
+from openedxstats.apps.sites.referrer_logs import MemoryLogSource  # noqa: E402
+
+
+class SlowLogSource(MemoryLogSource):
+    """
+    Log files in memory that take `latency` seconds to start reading, like an S3 download.
+    """
+
+    def __init__(self, files, latency):
+        super().__init__(files)
+        self.latency = latency
+
+    def open_lines(self, key):
+        time.sleep(self.latency)
+        yield from super().open_lines(key)
+
+
+def generate_logs(num_files, lines_per_file):
+    rnd = random.Random(42)
+    files = {}
+    for i in range(num_files):
+        lines = ["#Version: 1.0", "#Fields: date time ..."]
+        for _ in range(lines_per_file):
+            referrer = f"https://courses{rnd.randint(0, 500)}.example.org/dashboard"
+            day = f"2020-01-{rnd.randint(1, 28):02d}"
+            lines.append("\t".join([day, '12:00:00', 'EDGE', '100', '1.2.3.4', 'GET', 'cdn', '/logo.png', '200', referrer]))
+        files[f"logs/file_{i}.gz"] = gzip.compress("\n".join(lines).encode())
+    return files
+
+
+def timed_run(source, workers):
+    AccessLogAggregate.objects.all().delete()
+    DomainDailyTraffic.objects.all().delete()
+    FilenameLog.objects.all().delete()
+    began = time.perf_counter()
+    num_files = fetch_referrer_logs.process_keys(source, source.list_keys("logs/"), workers=workers)
+    seconds = time.perf_counter() - began
+    rollup = sorted(DomainDailyTraffic.objects.values_list('domain__name', 'access_date', 'access_count'))
+    return num_files, seconds, rollup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--lines', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        source = SlowLogSource(generate_logs(args.files, args.lines), args.latency)
+
+        num_files, old_seconds, old_rollup = timed_run(source, 1)
+        print(f"{num_files} files, {args.lines} lines each, {args.latency}s per download")
+        print(f"1 worker:   {old_seconds:8.3f}s")
+        _, new_seconds, new_rollup = timed_run(source, args.workers)
+        print(f"{args.workers} workers: {new_seconds:8.3f}s  ({old_seconds / new_seconds:.1f}x faster)")
+
+        assert old_rollup == new_rollup, "the thread pool saved different counts"
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
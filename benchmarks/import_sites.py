@@ -0,0 +1,69 @@
+"""
+Benchmark importing a generated site history csv with the import_sites command.
+
+Each site has --versions rows, in shuffled order, so the import has to chain them back together. The import writes to
+a throwaway test database. Run from the repository root against the testing database settings:
+
+    DJANGO_SETTINGS_MODULE=openedxstats.settings.testing python benchmarks/import_sites.py --sites 10000 --versions 5
+"""
+import argparse
+from io import StringIO
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'openedxstats.settings.testing')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+
+from openedxstats.apps.sites.management.commands.import_sites import import_data  # noqa: E402
+from openedxstats.apps.sites.models import Site  # noqa: E402
+
+
+def generate_csv(num_sites, num_versions):
+    rnd = random.Random(42)
+    languages = ["English", "French", "Spanish", "Chinese", "Arabic"]
+    countries = ["US", "France", "Spain", "China", "Egypt", "India"]
+    rows = []
+    for i in range(num_sites):
+        for version in range(num_versions):
+            rows.append(",".join([
+                f"https://courses{i}.example.org",
+                f"Site {i}",
+                str(rnd.randint(0, 500)),
+                f"{version + 1:02d}/01/16",
+                rnd.choice(languages),
+                rnd.choice(countries),
+            ]))
+    rnd.shuffle(rows)
+    return "url,name,course_count,active_start_date,language,geography\n" + "\n".join(rows) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sites', type=int, default=10000)
+    parser.add_argument('--versions', type=int, default=5)
+    args = parser.parse_args()
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        csvfile = StringIO(generate_csv(args.sites, args.versions))
+        began = time.perf_counter()
+        import_data(csvfile)
+        seconds = time.perf_counter() - began
+        print(f"{args.sites * args.versions} rows ({args.sites} sites, {args.versions} versions each): {seconds:.3f}s")
+
+        assert Site.objects.filter(active_end_date=None).count() == args.sites, "the versions weren't chained"
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark counting referrer log lines: splitting every field and parsing every referrer against the fast parser.
+
+Counts test_data/s3_data.txt repeated to --lines lines, and the same number of synthetic CloudFront lines with
+--referrers distinct referrers, reporting lines per second. Doesn't need a database. Run from the repository root:
+
+    python benchmarks/log_line_parsing.py --lines 1000000
+"""
+import argparse
+import collections
+import itertools
+import os
+import random
+import sys
+import time
+from urllib import parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'openedxstats.settings.testing')
+
+import django  # noqa: E402
+
+django.setup()
+
+from openedxstats.apps.sites import referrer_logs  # noqa: E402
+
+S3_DATA = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'openedxstats', 'apps', 'sites', 'test_data',
+    's3_data.txt',
+)
+
+
+class FullLogLine:
+    """
+    LogLine as it was: every field split, and every referrer parsed.
+    """
+    def __init__(self, line):
+        self.parts = line.split("\t")
+        self.parsed = parse.urlparse(self.parts[9])
+
+    @property
+    def host(self):
+        return self.parsed.netloc
+
+    @property
+    def date(self):
+        return self.parts[0]
+
+
+def count_full_log_lines(lines, log_name):
+    line_counter = collections.defaultdict(int)
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+
+        logline = FullLogLine(line)
+        line_counter[(logline.host, logline.date, log_name)] += 1
+    return line_counter
+
+
+def cloudfront_lines(num_lines, num_referrers):
+    rnd = random.Random(42)
+    referrers = [f"https://courses{n}.example.org/courses/course-v1:X+Y+Z/about?{n}" for n in range(num_referrers)]
+    lines = []
+    for _ in range(num_lines):
+        fields = [
+            f"2020-01-{rnd.randint(1, 28):02d}", '12:00:00', 'IAD79-C1', '4093', f'10.0.{rnd.randint(0, 255)}.1', 'GET',
+            'd1.cloudfront.net', '/openedx-logos/openedx-logo-tag.png', '200', rnd.choice(referrers),
+        ]
+        fields += ['Mozilla/5.0%20(X11;%20Linux%20x86_64)', '-', '-', 'Hit', 'abc123==', 'd1.cloudfront.net', 'https',
+                   '306', '0.001', '-', 'TLSv1.3', 'TLS_AES_128_GCM_SHA256', 'Hit', 'HTTP/2.0', '-', '-', '54321',
+                   '0.001', 'Hit', 'image/png', '3787', '-', '-']
+        lines.append("\t".join(fields))
+    return lines
+
+
+def lines_per_second(count, lines):
+    referrer_logs.referrer_host.cache_clear()
+    began = time.perf_counter()
+    counts = count(lines, 'bench.gz')
+    return counts, len(lines) / (time.perf_counter() - began)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--referrers', type=int, default=2000)
+    args = parser.parse_args()
+
+    with open(S3_DATA) as s3_data:
+        sample = s3_data.read().splitlines()
+    for name, lines in [
+        ("s3_data.txt", list(itertools.islice(itertools.cycle(sample), args.lines))),
+        (f"cloudfront, {args.referrers} referrers", cloudfront_lines(args.lines, args.referrers)),
+    ]:
+        old_counts, old_rate = lines_per_second(count_full_log_lines, lines)
+        new_counts, new_rate = lines_per_second(referrer_logs.count_log_lines, lines)
+        assert old_counts == new_counts, "the fast parser counted differently"
+        print(f"{name}: {len(lines)} lines")
+        print(f"  full split:  {old_rate:12,.0f} lines/s")
+        print(f"  fast parser: {new_rate:12,.0f} lines/s  ({new_rate / old_rate:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark the OT chart's daily series: the old two-queries-per-day loop against the sweep line.
+
+Creates a throwaway test database, fills it with site versions, and times both over the same range of days.
+Run from the repository root against the testing database settings:
+
+    DJANGO_SETTINGS_MODULE=openedxstats.settings.testing python benchmarks/ot_chart_series.py --sites 10000 --years 5
+"""
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'openedxstats.settings.testing')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.db.models import Count, Q, Sum  # noqa: E402
+
+from openedxstats.apps.sites.management.commands.materialize_daily_summaries import (  # noqa: E402
+    daily_totals, end_of_day,
+)
+from openedxstats.apps.sites.models import OverCount, Site  # noqa: E402
+from openedxstats.apps.sites.views import valid_sites_query  # noqa: E402
+
+
+def populate(num_sites, start, days):
+    """
+    Give each of `num_sites` urls a chain of versions over the range, with a few OverCounts.
+    """
+    rnd = random.Random(42)
+    versions = []
+    for i in range(num_sites):
+        version_start = start + timedelta(days=rnd.randint(0, days // 2), seconds=rnd.randint(0, 86399))
+        while version_start is not None:
+            version_end = version_start + timedelta(days=rnd.randint(30, 400))
+            if version_end > start + timedelta(days=days):
+                version_end = None
+            versions.append(Site(
+                url=f'https://site{i}.example.com',
+                course_count=rnd.choice([0, 1, 5, 20, 100, None]),
+                is_private_instance=rnd.random() < 0.05,
+                is_gone=rnd.random() < 0.1,
+                active_start_date=version_start,
+                active_end_date=version_end,
+            ))
+            version_start = version_end
+    Site.objects.bulk_create(versions, batch_size=5000)
+
+    over_count_start = start
+    for n in range(5):
+        over_count_end = start + timedelta(days=days * (n + 1) // 5) if n < 4 else None
+        OverCount.objects.create(
+            course_count=rnd.randint(0, 50), active_start_date=over_count_start, active_end_date=over_count_end
+        )
+        over_count_start = over_count_end
+    return len(versions)
+
+
+def per_day_queries(days):
+    """
+    The original OTChartView.generate_summary_data loop, without the writes.
+    """
+    series = []
+    for day in days:
+        date_select = Q(active_start_date__lte=day) & (Q(active_end_date__gte=day) | Q(active_end_date=None))
+        day_stats = Site.objects.filter(valid_sites_query() & date_select).aggregate(
+            sites=Count('*'), courses=Sum('course_count')
+        )
+        try:
+            over_count = OverCount.objects.get(date_select).course_count
+        except OverCount.DoesNotExist:
+            over_count = 0
+        series.append((day_stats['sites'], (day_stats['courses'] or 0) - over_count))
+    return series
+
+
+def sweep_line(days):
+    """
+    The totals computed by materialize_daily_summaries, without the writes.
+    """
+    return daily_totals(days)
+
+
+def timed(func, *args):
+    began = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - began
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sites', type=int, default=10000)
+    parser.add_argument('--years', type=int, default=5)
+    args = parser.parse_args()
+
+    num_days = 365 * args.years
+    start = datetime(2015, 1, 1)
+    days = [end_of_day(start + timedelta(days=n)) for n in range(num_days)]
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        num_versions = populate(args.sites, start, num_days)
+        print(f"{args.sites} sites, {num_versions} versions, {len(days)} days")
+
+        old_series, old_seconds = timed(per_day_queries, days)
+        print(f"per-day queries: {old_seconds:8.3f}s")
+        new_series, new_seconds = timed(sweep_line, days)
+        print(f"sweep line:      {new_seconds:8.3f}s  ({old_seconds / new_seconds:.0f}x faster)")
+
+        assert old_series == new_series, "sweep line disagrees with the per-day queries"
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,11 +11,12 @@ class SiteAdmin(admin.ModelAdmin):
     list_display = ('site_type', 'name', 'url', 'course_count', 'org_type',
                     'get_languages', 'get_geographies', 'github_fork', 'notes', 'course_type', 'registered_user_count',
                     'active_learner_count', 'active_start_date', 'active_end_date')
+    # The languages and geographies are read from the tag set
+    list_select_related = ('tag_set',)
 
 
 # Register models
 admin.site.register(Site, SiteAdmin)
 admin.site.register(Language)
 admin.site.register(GeoZone)
-admin.site.register(SiteLanguage)
-admin.site.register(SiteGeoZone)
+admin.site.register(TagSet)
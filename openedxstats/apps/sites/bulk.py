@@ -0,0 +1,356 @@
+"""
+The work behind the bulk_update and bulk_create endpoints, run either in the request or, for large payloads, as a
+BulkJob: the payload is split into chunks that the run_bulk_jobs command processes one transaction at a time,
+recording each chunk's per-site results and retrying chunks that fail.
+
+Payloads can also be sent as NDJSON, one site per line, which is read and processed a chunk at a time so that
+neither the body nor the results are ever all in memory.
+"""
+from datetime import datetime, timedelta
+import gzip
+import itertools
+import json
+import traceback
+
+from django.db import transaction
+from django.db.models import Q
+
+from openedxstats.apps.sites.models import (
+    BulkJob, BulkJobChunk, GeoZone, Language, OverCount, Site, SiteCheck, TagSet, tag_set_digest,
+)
+
+# How many sites go in each chunk of a job, by default
+JOB_CHUNK_SIZE = 500
+
+# How many sites of a streamed NDJSON body are processed at once, by default
+STREAM_CHUNK_SIZE = 500
+
+# How many bytes of a streamed body to read at a time
+READ_BLOCK_SIZE = 64 * 1024
+
+# How many times a chunk is tried before it's marked as failed, by default
+MAX_ATTEMPTS = 3
+
+# How long to wait before trying a chunk again after its first failure, by default; the wait grows with each one
+RETRY_DELAY = timedelta(minutes=1)
+
+
+def update_sites(site_updates, now=None):
+    """
+    Start new versions of the sites in `site_updates`, a dict mapping urls to dicts with their new course_count
+    and is_gone, for those that have changed. Returns the urls updated, unchanged and not found.
+    """
+    now = now or datetime.now()
+    updated = []
+    unchanged = []
+    not_found = []
+
+    with transaction.atomic():
+        matches = Site.current_by_host(site_updates)
+        matched = []
+        changes = {}
+        for siteurl, update in list(site_updates.items()):
+            site = matches.get(siteurl)
+            if site is None:
+                not_found.append(siteurl)
+                continue
+            # If a site is in the payload twice, the last update wins
+            changes[site] = {'course_count': update['course_count'], 'is_gone': update['is_gone']}
+            matched.append((siteurl, site))
+
+        changes = {
+            site: values for site, values in changes.items()
+            if any(getattr(site, name) != value for name, value in values.items())
+        }
+        for siteurl, site in matched:
+            (updated if site in changes else unchanged).append(siteurl)
+        Site.start_new_versions(changes, now)
+        SiteCheck.touch([site.url for _, site in matched], now)
+
+    return {'updated': updated, 'unchanged': unchanged, 'not_found': not_found}
+
+
+def set_over_count(over_count):
+    """
+    Record the payload's over-count, if it has one. Returns whether it did.
+    """
+    if over_count is None:
+        return False
+    OverCount.set_latest(over_count)
+    return True
+
+
+def create_sites(sites):
+    """
+    Create the `sites`, a list of dicts as posted to bulk_create, if none of them already exists and all of their
+    languages and geographies do. Returns whether they were created and the messages for the response.
+
+    The existing sites, languages and geographies are each looked up with one query, the sites' tag sets are found
+    or created with one upsert, and the sites are inserted with one bulk insert, in one transaction.
+    """
+    site_dicts = []
+    resp = []
+    ok = True
+
+    with transaction.atomic():
+        existing_sites = Site.current_by_host([site["url"] for site in sites])
+        languages = set(
+            Language.objects.filter(name__in={site.get("language") for site in sites} - {None})
+            .values_list('name', flat=True)
+        )
+        geozones = set(
+            GeoZone.objects.filter(name__in={site.get("geography") for site in sites} - {None})
+            .values_list('name', flat=True)
+        )
+
+        for site in sites:
+            siteurl = site["url"]
+            if siteurl in existing_sites:
+                resp.append(f"Error: {siteurl} already exists: {existing_sites[siteurl]}")
+                ok = False
+                continue
+
+            kwargs = {
+                k:v for k, v in site.items()
+                if v and (k in {"name", "url", "course_count", "notes"})
+                }
+
+            site_obj = Site(**kwargs)
+            site_dicts.append({"site": site_obj, "lang": [], "geo": []})
+
+            # This endpoint can only make a single language per site.
+            lang = site.get("language")
+            if lang:
+                if lang not in languages:
+                    resp.append(f"Error: Language {lang!r} doesn't exist")
+                    ok = False
+                    continue
+                site_dicts[-1]["lang"] = [lang]
+
+            # This endpoint can only make a single geography per site.
+            geo = site.get("geography")
+            if geo:
+                if geo not in geozones:
+                    resp.append(f"Error: GeoZone {geo!r} doesn't exist")
+                    ok = False
+                    continue
+                site_dicts[-1]["geo"] = [geo]
+
+        if ok:
+            tag_set_ids = TagSet.ids_for((site_dict["lang"], site_dict["geo"]) for site_dict in site_dicts)
+            for site_dict in site_dicts:
+                site_dict["site"].tag_set_id = tag_set_ids.get(tag_set_digest(site_dict["lang"], site_dict["geo"]))
+            Site.objects.bulk_create([site_dict["site"] for site_dict in site_dicts], batch_size=1000)
+            resp.append(f"Created {len(site_dicts)} sites")
+
+    return ok, resp
+
+
+def chunked(items, size):
+    """
+    Yield lists of up to `size` of `items`, consuming them as it goes.
+    """
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_ndjson(stream, gzipped=False):
+    """
+    Yield the objects in an NDJSON body, one per non-blank line, reading `stream` (e.g. the request) a block at a
+    time, and decompressing it first if `gzipped`. Raises ValueError at a line that isn't JSON.
+    """
+    if gzipped:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    # Not `for line in stream`: a request's readline() reads the whole rest of the body to find the line's end
+    partial = b''
+    number = 0
+    while True:
+        block = stream.read(READ_BLOCK_SIZE)
+        if not block:
+            break
+        lines = (partial + block).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            if line.strip():
+                number += 1
+                yield parse_ndjson_line(number, line)
+    if partial.strip():
+        yield parse_ndjson_line(number + 1, partial)
+
+
+def parse_ndjson_line(number, line):
+    """
+    The object on line `number` of an NDJSON body, or a ValueError that says which line isn't JSON.
+    """
+    try:
+        return json.loads(line)
+    except ValueError as ex:
+        raise ValueError(f"Line {number} isn't valid JSON: {ex}")
+
+
+def update_chunks(records, chunk_size, over_counts):
+    """
+    Yield the site updates in the NDJSON `records` of a bulk_update body as dicts of up to `chunk_size` urls, the
+    form update_sites takes. Each line is either a site, {"url": ..., "course_count": ..., "is_gone": ...}, or the
+    over-count, {"overcount": ...}, which is appended to `over_counts` instead. Raises ValueError at a line that's
+    neither.
+    """
+    chunk = {}
+    for number, record in enumerate(records, 1):
+        if not isinstance(record, dict) or ('url' not in record and 'overcount' not in record):
+            raise ValueError(f"Line {number} is neither a site nor an over-count: {json.dumps(record)}")
+        if 'url' not in record:
+            if record['overcount'] is not None:
+                over_counts.append(record['overcount'])
+            continue
+        chunk[record['url']] = record
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = {}
+    if chunk:
+        yield chunk
+
+
+def stream_updates(records, chunk_size=None):
+    """
+    Update the sites in the NDJSON `records` of a bulk_update body a chunk at a time, each in its own transaction,
+    yielding NDJSON result lines as each chunk is done: {"url": ..., "result": "updated"} (or "unchanged" or
+    "not_found") per site, then {"updated_over_count": ...}.
+
+    A line that's neither a site nor an over-count stops the update with an {"error": ...} line. The chunks before
+    it have been updated, but the ones after it and the over-count are not.
+    """
+    over_counts = []
+    try:
+        for chunk in update_chunks(records, chunk_size or STREAM_CHUNK_SIZE, over_counts):
+            results = update_sites(chunk)
+            outcomes = {url: outcome for outcome, urls in results.items() for url in urls}
+            for url in chunk:
+                yield json.dumps({'url': url, 'result': outcomes[url]}) + "\n"
+    except ValueError as ex:
+        yield json.dumps({'error': str(ex)}) + "\n"
+        return
+    over_count = over_counts[-1] if over_counts else None
+    yield json.dumps({'updated_over_count': set_over_count(over_count)}) + "\n"
+
+
+def create_records(records):
+    """
+    Yield the sites in the NDJSON `records` of a bulk_create body, each a dict with at least a "url", the form
+    create_sites takes. Raises ValueError at a line that isn't a site.
+    """
+    for number, record in enumerate(records, 1):
+        if not isinstance(record, dict) or 'url' not in record:
+            raise ValueError(f"Line {number} is not a site: {json.dumps(record)}")
+        yield record
+
+
+def stream_creates(records, chunk_size=None):
+    """
+    Create the sites in the NDJSON `records` of a bulk_create body, one site per line, a chunk at a time, yielding
+    the messages for each chunk as NDJSON lines, {"message": ...}. Each chunk is checked and created on its own.
+
+    A line that isn't a site stops the creation with an {"error": ...} line. The chunks before its chunk have been
+    created, but its own and the ones after it are not.
+    """
+    try:
+        for chunk in chunked(create_records(records), chunk_size or STREAM_CHUNK_SIZE):
+            _, messages = create_sites(chunk)
+            for message in messages:
+                yield json.dumps({'message': message}) + "\n"
+    except ValueError as ex:
+        yield json.dumps({'error': str(ex)}) + "\n"
+
+
+def submit_job(kind, payload, chunk_size=None):
+    """
+    Queue a BulkJob of `kind` for the run_bulk_jobs command: the site updates and over-count of a bulk_update
+    payload, or the sites of a bulk_create payload, split into chunks of `chunk_size` (default JOB_CHUNK_SIZE)
+    sites. Returns the job.
+    """
+    chunk_size = chunk_size or JOB_CHUNK_SIZE
+    if kind == BulkJob.UPDATE:
+        chunks = (dict(chunk) for chunk in chunked(payload['sites'].items(), chunk_size))
+        return submit_job_chunks(kind, chunks, [payload.get('overcount')])
+    return submit_job_chunks(kind, chunked(payload, chunk_size))
+
+
+def submit_job_chunks(kind, chunks, over_counts=None):
+    """
+    Queue a BulkJob of `kind` made of `chunks`, which are only read one at a time, so they can come from a
+    streamed body. The last of `over_counts`, which update_chunks may add to as the chunks are read, is recorded
+    when the job finishes. Returns the job.
+    """
+    with transaction.atomic():
+        job = BulkJob.objects.create(kind=kind, num_sites=0)
+        for index, chunk in enumerate(chunks):
+            BulkJobChunk.objects.create(job=job, index=index, payload=chunk, num_sites=len(chunk))
+            job.num_sites += len(chunk)
+        job.over_count = over_counts[-1] if over_counts else None
+        job.save(update_fields=['num_sites', 'over_count'])
+        job.finish_if_done()
+    return job
+
+
+def run_chunk(chunk):
+    """
+    Do the work of one chunk, returning its results.
+    """
+    if chunk.job.kind == BulkJob.UPDATE:
+        return update_sites(chunk.payload)
+    # Like the endpoint, a chunk with any invalid site creates nothing; that's a result, not a reason to retry
+    ok, messages = create_sites(chunk.payload)
+    return {'created': len(chunk.payload) if ok else 0, 'messages': messages}
+
+
+def run_next_chunk(max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+    """
+    Run the oldest pending chunk of any job that's ready to run, returning it, or None if there's nothing to do.
+
+    The chunk stays locked while it runs, so several run_bulk_jobs workers can share the queue, and if a worker
+    dies its chunk is simply pending again. A chunk that raises an error is retried until it has been tried
+    `max_attempts` times, then marked as failed. It waits `retry_delay` times the number of attempts so far before
+    each retry, and the chunks behind it run in the meantime.
+    """
+    now = datetime.now()
+    with transaction.atomic():
+        chunk = BulkJobChunk.objects.select_for_update(skip_locked=True, of=('self',)).select_related('job').filter(
+            Q(retry_after__isnull=True) | Q(retry_after__lte=now), status=BulkJobChunk.PENDING
+        ).order_by('pk').first()
+        if chunk is None:
+            return None
+
+        chunk.attempts += 1
+        try:
+            with transaction.atomic():
+                chunk.results = run_chunk(chunk)
+        except Exception:
+            chunk.error = traceback.format_exc()
+            if chunk.attempts >= max_attempts:
+                chunk.status = BulkJobChunk.FAILED
+            else:
+                chunk.retry_after = now + retry_delay * chunk.attempts
+        else:
+            chunk.status = BulkJobChunk.DONE
+            chunk.error = ''
+        chunk.save()
+        chunk.job.finish_if_done()
+    return chunk
+
+
+def retry_failed_chunks(job=None):
+    """
+    Put the failed chunks of `job`, or of every job, back in the queue. Returns how many there were.
+    """
+    chunks = BulkJobChunk.objects.filter(status=BulkJobChunk.FAILED)
+    if job is not None:
+        chunks = chunks.filter(job=job)
+    with transaction.atomic():
+        jobs = set(chunks.values_list('job', flat=True))
+        num_chunks = chunks.update(status=BulkJobChunk.PENDING, attempts=0, retry_after=None)
+        BulkJob.objects.filter(pk__in=jobs).update(finished=None)
+    return num_chunks
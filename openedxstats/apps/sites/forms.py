@@ -12,14 +12,27 @@ default_url_errors = {
 class SiteForm(forms.ModelForm):
     url = forms.URLField(max_length=1000, required=True, error_messages=default_url_errors)
     aliases = SimpleArrayField(forms.CharField(), required=False, delimiter='\n', widget=forms.Textarea)
+    # Saved as the site's TagSet by the add_site view
+    language = forms.ModelMultipleChoiceField(Language.objects.all(), required=False,
+                                              help_text="Select multiple languages with CMD+Click")
+    geography = forms.ModelMultipleChoiceField(GeoZone.objects.all(), required=False,
+                                               help_text="Select multiple geo-zones with CMD+Click")
+
+    field_order = ['site_type', 'name', 'url', 'is_private_instance', 'is_gone', 'course_count', 'active_start_date',
+                   'org_type', 'language', 'geography']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.tag_set_id:
+            self.initial.setdefault('language', self.instance.tag_set.languages)
+            self.initial.setdefault('geography', self.instance.tag_set.geozones)
 
     class Meta:
         model = Site
-        exclude = ['active_end_date', 'github_fork', 'registered_user_count', 'active_learner_count', 'course_type',]
+        exclude = ['active_end_date', 'github_fork', 'registered_user_count', 'active_learner_count', 'course_type',
+                   'tag_set',]
         # If the corresponding attribute in site form is uncommented above, these help messages won't show
         help_texts = {
-            "language": "Select multiple languages with CMD+Click",
-            "geography": "Select multiple geo-zones with CMD+Click",
             #'url': 'This text is not persistent on page, what gives!',
             #'last_checked': 'This text is persistent on the page, conflicts with error help text provided by bootstrap',
         }
@@ -0,0 +1,178 @@
+"""
+Check that the versions of each site url form an unbroken chain, and optionally repair the ones that don't.
+
+The versions of a url, ordered by active_start_date, should each end when the next one starts, with only the
+latest one current. The anomalies found are:
+
+- several current versions of a url: a version with no active_end_date that isn't the latest;
+- overlapping versions: a version that ends after the next one starts;
+- inverted versions: a version that ends before it starts, which older imports made by ending the latest version
+  when an older one was imported, and which has no validity range;
+- stale validity ranges: a valid_during that doesn't match the version's start and end dates;
+- lost languages and geographies: a version with no tag set, when an earlier version of the url had one, which is
+  what the scraper used to do when it made new versions.
+
+Each kind of anomaly is found with one query using window functions over the versions of each url. With --repair,
+the versions are made to end when the next one starts (an inverted latest version becomes current again) and the
+validity ranges are recomputed, with one statement each, in one transaction.
+
+Languages and geographies can also be cleared on purpose through the site form, so versions that lost them are only
+repaired with --repair-tags: they get the tag set of the latest earlier version that had one.
+"""
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from openedxstats.apps.sites.models import Site
+
+SITES = Site._meta.db_table
+
+# Each version with the start date of the next version of its url
+VERSIONS_WITH_NEXT_START = f"""
+    SELECT id, url, active_start_date, active_end_date,
+        LEAD(active_start_date) OVER (PARTITION BY url ORDER BY active_start_date, id) AS next_start
+    FROM {SITES}
+"""
+
+# The versions that don't end when the next version of their url starts
+BROKEN_CHAIN = "next_start IS NOT NULL AND (active_end_date IS NULL OR active_end_date > next_start)"
+
+# The versions that end before they start
+INVERTED = "active_end_date < active_start_date"
+
+# The range each version's valid_during should be; inverted versions have none, and are repaired on their own
+EXPECTED_RANGE = "tstzrange(active_start_date, active_end_date, '[]')"
+STALE_RANGE = (
+    f"(active_end_date IS NULL OR active_end_date >= active_start_date) "
+    f"AND valid_during IS DISTINCT FROM {EXPECTED_RANGE}"
+)
+
+
+# The versions with no tag set after an earlier version of their url had one, with the tag set of the latest such
+# version. The versions are numbered by how many versions with tag sets came before them, so each one's source is
+# the first of its group.
+LOST_TAGS = f"""
+    SELECT id, url, source_tag_set_id FROM (
+        SELECT id, url, tag_set_id, tag_group,
+            FIRST_VALUE(tag_set_id) OVER (PARTITION BY url, tag_group ORDER BY active_start_date, id)
+                AS source_tag_set_id
+        FROM (
+            SELECT id, url, active_start_date, tag_set_id,
+                COUNT(tag_set_id) OVER (PARTITION BY url ORDER BY active_start_date, id) AS tag_group
+            FROM {SITES}
+        ) grouped
+    ) sourced
+    WHERE tag_set_id IS NULL AND tag_group > 0
+"""
+
+
+def find_anomalies():
+    """
+    Find the broken version chains, returning a dict mapping each kind of anomaly to a list of (url, version id).
+    """
+    anomalies = {
+        "several_current": [],
+        "overlapping": [],
+        "inverted": [],
+        "stale_range": [],
+        "lost_tags": [],
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT url, id, active_end_date IS NULL, {INVERTED} FROM ({VERSIONS_WITH_NEXT_START}) v
+            WHERE {BROKEN_CHAIN} OR {INVERTED} ORDER BY url, active_start_date
+        """)
+        for url, pk, is_current, is_inverted in cursor.fetchall():
+            if is_inverted:
+                anomalies["inverted"].append((url, pk))
+            else:
+                anomalies["several_current" if is_current else "overlapping"].append((url, pk))
+
+        cursor.execute(f"SELECT url, id FROM {SITES} WHERE {STALE_RANGE} ORDER BY url, active_start_date")
+        anomalies["stale_range"] = cursor.fetchall()
+
+        cursor.execute(f"SELECT url, id FROM ({LOST_TAGS}) lost ORDER BY url, id")
+        anomalies["lost_tags"] = cursor.fetchall()
+    return anomalies
+
+
+def repair_versions(chains=True, tags=False):
+    """
+    Repair the broken version chains, and if `tags`, the versions that lost their languages and geographies, in one
+    transaction, returning how many rows each statement changed.
+    """
+    now = datetime.now()
+    repaired = {}
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Keep the scraper and imports from changing versions part way through
+        cursor.execute(f"LOCK TABLE {SITES} IN SHARE ROW EXCLUSIVE MODE")
+
+        if chains:
+            for name, condition in [("ended", BROKEN_CHAIN), ("rechained", INVERTED)]:
+                # An inverted latest version has no next start, so it becomes current again
+                cursor.execute(f"""
+                    UPDATE {SITES} s
+                    SET active_end_date = v.next_start,
+                        valid_during = tstzrange(s.active_start_date, v.next_start, '[]'), last_modified = %s
+                    FROM (SELECT id, next_start FROM ({VERSIONS_WITH_NEXT_START}) v WHERE {condition}) v
+                    WHERE s.id = v.id
+                """, [now])
+                repaired[name] = cursor.rowcount
+
+            cursor.execute(
+                f"UPDATE {SITES} SET valid_during = {EXPECTED_RANGE}, last_modified = %s WHERE {STALE_RANGE}", [now]
+            )
+            repaired["ranges"] = cursor.rowcount
+
+        if tags:
+            cursor.execute(f"""
+                UPDATE {SITES} s SET tag_set_id = lost.source_tag_set_id, last_modified = %s
+                FROM ({LOST_TAGS}) lost
+                WHERE s.id = lost.id
+            """, [now])
+            repaired["tags"] = cursor.rowcount
+    return repaired
+
+
+class Command(BaseCommand):
+    help = 'Checks that the versions of each site form an unbroken chain, and optionally repairs them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair',
+                            dest='repair',
+                            action='store_true',
+                            default=False,
+                            help='Repair the broken chains and validity ranges found, in one transaction.')
+        parser.add_argument('--repair-tags',
+                            dest='repair_tags',
+                            action='store_true',
+                            default=False,
+                            help="Give versions that lost their languages and geographies those of the latest "
+                                 "earlier version that had them. They may have been cleared on purpose, so check "
+                                 "the versions listed first.")
+        parser.add_argument('--show',
+                            dest='show',
+                            type=int,
+                            default=10,
+                            help='How many of the urls with each kind of anomaly to list.')
+
+    def handle(self, *args, **options):
+        anomalies = find_anomalies()
+        for name, versions in anomalies.items():
+            urls = list(dict.fromkeys(url for url, _ in versions))
+            self.stdout.write(f"{name.replace('_', ' ').capitalize()}: {len(versions)} versions of {len(urls)} urls")
+            for url in urls[:options['show']]:
+                self.stdout.write(f"    {url}")
+
+        chains = options['repair'] and any(versions for name, versions in anomalies.items() if name != "lost_tags")
+        tags = options['repair_tags'] and bool(anomalies["lost_tags"])
+        if chains or tags:
+            repaired = repair_versions(chains=chains, tags=tags)
+            if chains:
+                self.stdout.write(
+                    "Repaired: {ended} versions ended, {rechained} inverted versions re-chained, {ranges} validity "
+                    "ranges recomputed".format(**repaired)
+                )
+            if tags:
+                self.stdout.write("Repaired: {tags} versions' languages and geographies restored".format(**repaired))
@@ -1,14 +1,19 @@
-import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import datetime
-import gzip
-import io
-from urllib import parse
+import itertools
+import multiprocessing
 
-import boto3
-from django.core.management.base import BaseCommand
-from django.db import IntegrityError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 
-from openedxstats.apps.sites.models import AccessLogAggregate, FilenameLog
+from openedxstats.apps.sites.bulk import chunked
+from openedxstats.apps.sites.hyperloglog import HyperLogLog
+from openedxstats.apps.sites.models import (
+    AccessLogAggregate, Domain, DomainDailyTraffic, FilenameLog, LogListingMark,
+)
+from openedxstats.apps.sites.referrer_logs import (
+    count_backfill_key, count_visitors, init_backfill_worker, key_hour, open_source,
+)
 
 """
 fetch_referrer_logs.py (based off load_logo_referrers_summary.py)
@@ -31,6 +36,26 @@ select domain, min(date) from access_log_aggregate where domain not like '%.amaz
 # 0 = mimimal output, 1 = verbose output
 DEBUG = 0
 
+DEFAULT_SOURCE = "s3:openedx-logs"
+LOG_PREFIX = "openedx-logos-cloudfront/"
+
+# With --workers, how many downloaded-but-unsaved files each worker may have outstanding. Workers hand back only
+# the per-(host, date) counts for a file, so this bounds memory to roughly workers * IN_FLIGHT_PER_WORKER files.
+IN_FLIGHT_PER_WORKER = 2
+
+# CloudFront log keys are named <distribution id>.<YYYY-MM-DD-HH>.<unique id>.gz, so within a distribution they list
+# in time order. Logs can be delivered late, so each run lists from this long before the last key it finished with.
+LISTING_LOOKBACK = datetime.timedelta(days=2)
+
+# How many listed keys to check against the FilenameLog with each query
+KEY_BATCH_SIZE = 1000
+
+# How many AccessLogAggregates to insert with each query, by default
+AGGREGATE_BATCH_SIZE = 5000
+
+# With --backfill, how many reprocessed log files to save, and rebuild the daily rollup for, in each transaction
+BACKFILL_FILES_PER_BATCH = 100
+
 
 class Command(BaseCommand):
     help = 'Fetches AWS Open edX logo referrer logs and save any new logs to a database.'
@@ -41,139 +66,231 @@ class Command(BaseCommand):
                             action='store_true',
                             default=False,
                             help='Enable verbose output, useful for debugging.')
-
+        parser.add_argument('--source',
+                            dest='source',
+                            default=DEFAULT_SOURCE,
+                            help='Where to read log files from: s3:<bucket>, local:<directory> laid out like the '
+                                 'bucket, or memory:<directory> to load the directory into memory first. '
+                                 'Default: %s.' % DEFAULT_SOURCE)
+        parser.add_argument('--workers',
+                            dest='workers',
+                            type=int,
+                            default=1,
+                            help='Download and parse this many log files at once. Results are saved by one writer.')
+        parser.add_argument('--rescan',
+                            dest='rescan',
+                            action='store_true',
+                            default=False,
+                            help='List every key in the bucket, not just those since shortly before the last run.')
+        parser.add_argument('--batch-size',
+                            dest='batch_size',
+                            type=int,
+                            default=AGGREGATE_BATCH_SIZE,
+                            help='Insert the aggregate counts for a log file this many rows at a time.')
+        parser.add_argument('--backfill',
+                            dest='backfill',
+                            action='store_true',
+                            default=False,
+                            help='Reprocess every log file from --since through --until, even ones already processed, '
+                                 'and rebuild the daily rollup for the days they cover.')
+        parser.add_argument('--processes',
+                            dest='processes',
+                            type=int,
+                            default=multiprocessing.cpu_count(),
+                            help='With --backfill, parse log files in this many processes.')
+        parser.add_argument('--since',
+                            dest='since',
+                            type=datetime.date.fromisoformat,
+                            default=None,
+                            help='With --backfill, the first day (YYYY-MM-DD) of log files to reprocess.')
+        parser.add_argument('--until',
+                            dest='until',
+                            type=datetime.date.fromisoformat,
+                            default=None,
+                            help='With --backfill, the last day (YYYY-MM-DD) of log files to reprocess.')
     def handle(self, *args, **options):
         if options['verbose']:
             global DEBUG
             DEBUG=1
-        run_command()
-
-
-class LogLine:
-    def __init__(self, line):
-        self.parts = line.split("\t")
-        self.parsed = parse.urlparse(self.parts[9])
-
-    @property
-    def host(self):
-        return self.parsed.netloc
-
-    @property
-    def client_ip(self):
-        return self.parts[4]
-
-    @property
-    def uri(self):
-        return self.parts[7]
-
-    @property
-    def date(self):
-        return self.parts[0]
-
-    @property
-    def time(self):
-        return self.parts[1]
-
-
-class HostInfo:
-    def __init__(self):
-        self.hits = 0
-        self.ips = set()
-
-    def add(self, logline):
-        self.hits += 1
-        self.ips.add(logline.client_ip)
-
-
-def is_in_filename_log(log_name):
-    file_exists = FilenameLog.objects.filter(filename=log_name).count()
-    if file_exists:
-        return True
-    else:
-        return False
-
-
-def add_to_filename_log(log_name):
-    file_to_add = FilenameLog(filename=log_name)
-    file_to_add.save() #FIXME: Change to commit=false until entire program runs through?
-
-
-def process_log_file(file_content, log_name):
+        try:
+            source = open_source(options['source'])
+        except ValueError as ex:
+            raise CommandError(str(ex))
+        if options['backfill']:
+            run_backfill(
+                source, processes=options['processes'], since=options['since'], until=options['until'],
+                batch_size=options['batch_size'],
+            )
+        else:
+            run_command(source, workers=options['workers'], rescan=options['rescan'], batch_size=options['batch_size'])
+
+
+def create_aggregates(line_counter, visitors=None, batch_size=AGGREGATE_BATCH_SIZE):
+    """
+    Insert an AccessLogAggregate for each (host, date, log_name) count, with its visitor sketch if `visitors` has
+    one, returning the Domains of the hosts.
+    """
+    visitors = visitors or {}
+    domains = Domain.for_names(host for host, _, _ in line_counter)
+    AccessLogAggregate.objects.bulk_create(
+        [
+            AccessLogAggregate(
+                domain=domains[host], access_date=date, filename=log_name, access_count=line_count,
+                visitor_sketch=(
+                    visitors[host, date, log_name].to_bytes() if (host, date, log_name) in visitors else None
+                ),
+            )
+            for (host, date, log_name), line_count in line_counter.items()
+        ],
+        batch_size=batch_size,
+        ignore_conflicts=True,
+    )
+    return domains
+
+
+def save_log_counts(line_counter, visitors=None, batch_size=AGGREGATE_BATCH_SIZE):
+    domains = create_aggregates(line_counter, visitors, batch_size=batch_size)
+
+    # Keep the per-day rollup used by site discovery in step with the aggregates
+    DomainDailyTraffic.add_counts(
+        {(domains[host], date): line_count for (host, date, _), line_count in line_counter.items()},
+        {(domains[host], date): sketch for (host, date, _), sketch in (visitors or {}).items()},
+    )
+
+
+def save_key_counts(key_name, line_counter, visitors=None, batch_size=AGGREGATE_BATCH_SIZE):
+    """
+    Save the counts for a log file in the same transaction as its FilenameLog entry, so that a file is either
+    recorded completely or not at all. Returns False, saving nothing, if the file had already been recorded.
+    """
+    with transaction.atomic():
+        _, created = FilenameLog.objects.get_or_create(filename=key_name)
+        if not created:
+            return False
+        save_log_counts(line_counter, visitors, batch_size=batch_size)
+    return True
+
+
+def process_log_file(lines, log_name, batch_size=AGGREGATE_BATCH_SIZE):
     if DEBUG:
         print("Processing %s ..." % log_name)
-    line_counter = collections.defaultdict(int)
-    aggregate_logs = []
-
-    for line in file_content.splitlines():
-        if line.startswith('#'):
-            continue
-
-        logline = LogLine(line)
-        line_key = (logline.host, logline.date, log_name)
-        line_counter[line_key] += 1
-
-    for (host, date, log_name), line_count in list(line_counter.items()):
-        new_aggregate_log = AccessLogAggregate(
-            domain=host,
-            access_date=date,
-            filename=log_name,
-            access_count=line_count
-        )
-        aggregate_logs.append(new_aggregate_log)
-    for log_to_save in aggregate_logs: #TODO: Change to commit=false until entire program runs through?
-        try:
-            log_to_save.save()
-        except IntegrityError as ex:
-            print(f"Ignoring {ex}")
-
+    return save_key_counts(log_name, *count_visitors(lines, log_name), batch_size=batch_size)
+
+
+def listing_start(listing_prefix, last_key):
+    """
+    The key to list after, LISTING_LOOKBACK before the hour of `last_key`. None (list everything) if `last_key`
+    doesn't have an hour in it.
+    """
+    last_hour = key_hour(last_key)
+    if last_hour is None:
+        return None
+    return listing_prefix + (last_hour - LISTING_LOOKBACK).strftime('%Y-%m-%d-%H')
+
+
+def get_recent_keys(source, prefix=LOG_PREFIX, rescan=False, last_keys=None):
+    """
+    Yield the names of the keys under `prefix`, starting each distribution's listing shortly before the last key a
+    previous run finished with, or from the beginning if `rescan`. The last key listed for each distribution is
+    recorded in `last_keys`, to be saved with save_listing_marks once the keys have been processed.
+    """
+    if last_keys is None:
+        last_keys = {}
+    for listing_prefix in source.listing_prefixes(prefix):
+        mark = LogListingMark.objects.filter(prefix=listing_prefix).first()
+        start_after = None if rescan or mark is None else listing_start(listing_prefix, mark.last_key)
+        if DEBUG:
+            print("Listing %s after %s" % (listing_prefix, start_after))
+        for key_name in source.list_keys(listing_prefix, start_after):
+            last_keys[listing_prefix] = key_name
+            yield key_name
 
-def get_accessible_keys(bucket, prefix="openedx-logos-cloudfront/"):
-    for key in bucket.objects.filter(Prefix=prefix):
-        if key.storage_class != "GLACIER":
-            yield key
 
+def save_listing_marks(last_keys):
+    for listing_prefix, last_key in last_keys.items():
+        mark, created = LogListingMark.objects.get_or_create(prefix=listing_prefix, defaults={'last_key': last_key})
+        if not created and last_key > mark.last_key:
+            mark.last_key = last_key
+            mark.save()
 
-def get_key_content(bucket, key):
-    s3_object = bucket.Object(key)
-    # Create an in-memory bytes IO buffer
-    with io.BytesIO() as in_memory_object:
-        s3_object.download_fileobj(in_memory_object)
-        in_memory_object.seek(0)
-        if key.endswith(".gz"):
-            in_memory_object = gzip.GzipFile(None, 'rb', fileobj=in_memory_object)
 
-        return in_memory_object.read().decode('utf-8')
+def fetch_log_counts(source, key_name):
+    """
+    Read and parse one log file, returning its line counts and visitor sketches. This is the part of processing a key
+    run by workers.
+    """
+    if DEBUG:
+        print("Processing %s ..." % key_name)
+    return count_visitors(source.open_lines(key_name), key_name)
+
+
+def new_key_names(key_names):
+    """
+    Yield the `key_names` not in the FilenameLog, checking them a batch at a time.
+    """
+    key_names = iter(key_names)
+    while True:
+        batch = list(itertools.islice(key_names, KEY_BATCH_SIZE))
+        if not batch:
+            return
+        processed = set(FilenameLog.objects.filter(filename__in=batch).values_list('filename', flat=True))
+        for key_name in batch:
+            if key_name not in processed:
+                if DEBUG:
+                    print("%s not found, adding!" % key_name)
+                yield key_name
+
+
+def process_keys(source, key_names, workers=1, batch_size=AGGREGATE_BATCH_SIZE):
+    """
+    Process every key not already in the FilenameLog, returning how many were processed.
+
+    With more than one worker, keys are downloaded and parsed in a thread pool while this thread, the only one that
+    uses the database, saves the results as they come in. At most IN_FLIGHT_PER_WORKER keys per worker are submitted
+    ahead of the writer.
+    """
+    if workers <= 1:
+        num_files_processed = 0
+        for key_name in new_key_names(key_names):
+            line_counter, visitors = fetch_log_counts(source, key_name)
+            num_files_processed += save_key_counts(key_name, line_counter, visitors, batch_size=batch_size)
+        return num_files_processed
 
-def process_keys(bucket, accessible_keys):
     num_files_processed = 0
-    for key in accessible_keys:
-        if DEBUG:
-            print("Processing %r" % (key,))
-        # Process in-memory file
-        key_name = key.key
-        if not is_in_filename_log(key_name):
-            file_content = get_key_content(bucket, key_name)
-            if DEBUG:
-                print("%s not found, adding!" % key_name)
-            process_log_file(file_content, key_name)
-            add_to_filename_log(key_name)
-            num_files_processed += 1
+    max_in_flight = workers * IN_FLIGHT_PER_WORKER
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        try:
+            for key_name in new_key_names(key_names):
+                if len(in_flight) >= max_in_flight:
+                    num_files_processed += save_finished(in_flight, batch_size)
+                in_flight[executor.submit(fetch_log_counts, source, key_name)] = key_name
+            while in_flight:
+                num_files_processed += save_finished(in_flight, batch_size)
+        except BaseException:
+            for future in in_flight:
+                future.cancel()
+            raise
     return num_files_processed
 
 
-# TODO: Get most recent date already in table, and start next search there - will save time searching
+def save_finished(in_flight, batch_size):
+    """
+    Wait for at least one of the `in_flight` downloads, save the ones that are done, and return how many were saved.
+    """
+    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+    return sum(save_key_counts(in_flight.pop(future), *future.result(), batch_size=batch_size) for future in done)
 
-def run_command():
-    try:
-        bucket_name = "openedx-logs"
-        s3 = boto3.resource("s3")
 
-        bucket = s3.Bucket(bucket_name)
+def run_command(source, workers=1, rescan=False, batch_size=AGGREGATE_BATCH_SIZE):
+    try:
         print("Gathering accessible keys...")
-        accessible_keys = get_accessible_keys(bucket)
+        last_keys = {}
+        key_names = get_recent_keys(source, rescan=rescan, last_keys=last_keys)
 
         print("Processing keys...")
-        num_files_processed = process_keys(bucket, accessible_keys)
+        num_files_processed = process_keys(source, key_names, workers=workers, batch_size=batch_size)
+        save_listing_marks(last_keys)
 
         print("Finished! New files processed: %s" % num_files_processed)
 
@@ -182,3 +299,95 @@ def run_command():
         print("Some error occured:", error_message)
 
 
+def get_backfill_keys(source, prefix=LOG_PREFIX, since=None, until=None):
+    """
+    Yield the names of the log keys under `prefix` for the hours from the start of the day `since` through the end
+    of the day `until`. Either may be None to leave that end open; if either is given, keys that aren't named like
+    CloudFront logs are left out.
+    """
+    key_names = (
+        key_name
+        for listing_prefix in source.listing_prefixes(prefix)
+        for key_name in source.list_keys(listing_prefix, backfill_start(listing_prefix, prefix, since))
+    )
+
+    first_hour = datetime.datetime.combine(since, datetime.time.min) if since else None
+    last_hour = datetime.datetime.combine(until, datetime.time.max) if until else None
+    for key_name in key_names:
+        if first_hour or last_hour:
+            hour = key_hour(key_name)
+            if hour is None or (first_hour and hour < first_hour) or (last_hour and hour > last_hour):
+                continue
+        yield key_name
+
+
+def backfill_start(listing_prefix, prefix, since):
+    """
+    The key to list a distribution's keys after, for logs since the day `since`. Keys that don't all belong to one
+    distribution aren't in time order, so those are listed from the beginning.
+    """
+    if since is None or listing_prefix == prefix:
+        return None
+    return listing_prefix + since.isoformat()
+
+
+def replace_key_counts(key_name, line_counter, visitors=None, batch_size=AGGREGATE_BATCH_SIZE):
+    """
+    Replace whatever was saved for a log file with `line_counter` and `visitors`, leaving the daily rollup alone.
+    Returns the access dates of the old and new aggregates, whose rollup needs rebuilding.
+    """
+    with transaction.atomic():
+        existing = AccessLogAggregate.objects.filter(filename=key_name)
+        access_dates = set(existing.values_list('access_date', flat=True))
+        existing.delete()
+        create_aggregates(line_counter, visitors, batch_size=batch_size)
+        FilenameLog.objects.get_or_create(filename=key_name)
+    access_dates.update(date for _, date, _ in line_counter)
+    return access_dates
+
+
+def backfill_keys(source, key_names, processes=1, batch_size=AGGREGATE_BATCH_SIZE):
+    """
+    Reprocess `key_names` from `source`, returning how many were processed.
+
+    Log files are parsed in `processes` worker processes, which hand back each file's counts and sketches. This
+    process saves them BACKFILL_FILES_PER_BATCH files at a time, rebuilding the daily rollup for the days a batch
+    touched in the same transaction as its aggregates, so an interrupted backfill never leaves the rollup behind the
+    files it replaced.
+    """
+    num_files_processed = 0
+    if processes <= 1:
+        init_backfill_worker(source)
+        results = map(count_backfill_key, key_names)
+        pool = None
+    else:
+        # Spawned rather than forked, so the workers don't share this process's database connection
+        pool = multiprocessing.get_context('spawn').Pool(
+            processes, initializer=init_backfill_worker, initargs=(source,)
+        )
+        results = pool.imap_unordered(count_backfill_key, key_names)
+    try:
+        for batch in chunked(results, BACKFILL_FILES_PER_BATCH):
+            access_dates = set()
+            with transaction.atomic():
+                for key_name, line_counts, sketches in batch:
+                    if DEBUG:
+                        print("Replacing counts for %s" % key_name)
+                    visitors = {line_key: HyperLogLog.from_bytes(sketch) for line_key, sketch in sketches.items()}
+                    access_dates |= replace_key_counts(key_name, line_counts, visitors, batch_size=batch_size)
+                DomainDailyTraffic.rebuild(access_dates)
+            num_files_processed += len(batch)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return num_files_processed
+
+
+def run_backfill(source, processes=1, since=None, until=None, batch_size=AGGREGATE_BATCH_SIZE):
+    print("Gathering keys from %s to %s..." % (since or "the beginning", until or "the end"))
+    key_names = get_backfill_keys(source, since=since, until=until)
+
+    print("Reprocessing keys in %s processes..." % processes)
+    num_files_processed = backfill_keys(source, key_names, processes=processes, batch_size=batch_size)
+    print("Finished! Files reprocessed: %s" % num_files_processed)
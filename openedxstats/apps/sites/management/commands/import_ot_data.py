@@ -1,32 +1,49 @@
 from django.core.management.base import BaseCommand, CommandError
 from ...models import SiteSummarySnapshot
 import csv
-import sys
-from dateutil import parser
+from django.db import transaction
 from django.db.models.fields import NOT_PROVIDED
 
+from openedxstats.apps.sites.bulk import chunked
+from openedxstats.apps.sites.models import AUTO_GENERATED_NOTES
+from openedxstats.apps.sites.utils import parse_date
+
 # Fields that the csv must have
 REQUIRED_COLS = ["when", "sites", "courses", "reasons for discrepencies"]
 # Columns to ignore
 IGNORED_COLS = ["courses-per-site",]
+# The fields of columns with other names
+COLUMN_FIELDS = {"when": "timestamp", "sites": "num_sites", "courses": "num_courses",
+                 "reasons for discrepencies": "notes"}
+# How many snapshots to save with each query
+CHUNK_SIZE = 1000
 
 
 class Command(BaseCommand):
     """
     Allows for import of over-time site and course data from a csv file to the app database.
     Example command input:  python manage.py import_ot_data test_data/over_time_data.csv
+
+    With --upsert, snapshots already imported with the same timestamps are updated rather than duplicated, so the
+    same csv can be imported again, e.g. on a schedule. The auto-generated daily snapshots are left alone.
     """
 
     help = 'Imports Open edX over-time data from a correctly formatted csv file.'
 
     def add_arguments(self, parser):
         parser.add_argument('csv_file', type=str, help='Specify file to use as source for input data.')
+        parser.add_argument('--upsert',
+                            dest='upsert',
+                            action='store_true',
+                            default=False,
+                            help='Update the snapshots with the same timestamps instead of adding new ones.')
 
     def handle(self, *args, **options):
-        db_check()
+        if not options['upsert']:
+            db_check()
         # Open the csv file
-        with open(options['csv_file'], 'r+') as csvfile:
-            result_string = import_data(csvfile)
+        with open(options['csv_file'], 'r') as csvfile:
+            result_string = import_data(csvfile, upsert=options['upsert'])
             return result_string
 
 
@@ -55,28 +72,95 @@ def check_for_required_cols(header_row):
 
 def db_check():
     """
-    Raise a warning prompt if there are already records in the SiteSummarySnapshot DB table.
+    Warn if there are already records in the SiteSummarySnapshot DB table, since importing without upsert appends.
     :return:
     """
-    if SiteSummarySnapshot.objects.count() > 0:
-        try:
-            print("Rows already detected in SiteSummarySnapshot DB table, importing new data could/"
-                  " result in errors or duplicates.")
-            user_input = str(eval(input("Continue with import? Enter 'yes' or 'no': ")))
-            if user_input.lower().strip() != "yes":
-                print("Exiting...")
-                sys.exit()
-        except ValueError:
-            print("Unrecognized input, cancelling import...")
-
-
-def import_data(csvfile):
+    if SiteSummarySnapshot.objects.exists():
+        print("Rows already detected in SiteSummarySnapshot DB table, importing new data could result in duplicates;"
+              " use --upsert to update the snapshots with the same timestamps instead.")
+
+
+def resolve_columns(header_row):
+    """
+    Work out once per column of the header_row which SiteSummarySnapshot field its values go in: returns the field
+    for each column, or None for ignored columns. Raises FieldDoesNotExist for a column that isn't a field.
+    """
+    columns = []
+    for col in header_row:
+        col_name = col.lower().strip()
+        if col_name in IGNORED_COLS:
+            columns.append(None)
+            continue
+        columns.append(SiteSummarySnapshot._meta.get_field(COLUMN_FIELDS.get(col_name, col_name)))
+    return columns
+
+
+def parse_row(columns, row):
+    """
+    Make an unsaved SiteSummarySnapshot from a csv row.
     """
-    Iterates through each row of the provided csv, creating the a SiteSummarySnapshot object and saving to the DB
+    new_snapshot = SiteSummarySnapshot()
+    for field, col in zip(columns, row):
+        if field is None:
+            continue
+
+        # Prevent blank fields from being interpreted as null
+        if field.blank and not field.null and col is None:
+            col = ""
+        # If field is blank, and attribute has default value, use default value
+        elif (col is None or col == "" or col.isspace()) and field.default != NOT_PROVIDED:
+            col = field.get_default()
+
+        # If date, format to datetime object
+        if field.name == 'timestamp' and isinstance(col, str):
+            col = parse_date(col)
+
+        setattr(new_snapshot, field.name, field.to_python(col))
+    return new_snapshot
+
+
+def upsert_snapshots(snapshots):
+    """
+    Save the `snapshots`, updating the imported snapshots with the same timestamps instead of adding new ones. If a
+    timestamp is in `snapshots` more than once, the last one wins, and if it's in the DB more than once, the extra
+    snapshots are deleted. Returns counts of what was done.
+    """
+    stats = {"created": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+    by_timestamp = {snapshot.timestamp: snapshot for snapshot in snapshots}
+
+    to_update = []
+    to_delete = []
+    for existing in SiteSummarySnapshot.objects.filter(timestamp__in=by_timestamp).exclude(
+        notes=AUTO_GENERATED_NOTES
+    ).order_by('timestamp', 'pk'):
+        snapshot = by_timestamp.get(existing.timestamp)
+        if snapshot.pk is not None:
+            to_delete.append(existing.pk)
+            continue
+        snapshot.pk = existing.pk
+        if (existing.num_sites, existing.num_courses, existing.notes) != (
+                snapshot.num_sites, snapshot.num_courses, snapshot.notes):
+            to_update.append(snapshot)
+        else:
+            stats["unchanged"] += 1
+    to_create = [snapshot for snapshot in by_timestamp.values() if snapshot.pk is None]
+
+    SiteSummarySnapshot.objects.filter(pk__in=to_delete).delete()
+    SiteSummarySnapshot.objects.bulk_update(to_update, ['num_sites', 'num_courses', 'notes'])
+    SiteSummarySnapshot.objects.bulk_create(to_create)
+    stats.update(created=len(to_create), updated=len(to_update), deleted=len(to_delete))
+    return stats
+
+
+def import_data(csvfile, upsert=False, chunk_size=CHUNK_SIZE):
+    """
+    Reads the rows of the provided csv a chunk at a time, creating a SiteSummarySnapshot for each and saving them
+    to the DB in one transaction. With `upsert`, the imported snapshots with the same timestamps are updated
+    instead, so importing the same csv again changes nothing.
     :param csvfile:
     :return:
     """
-    total_count_stats = {"snapshots": 0}
+    total_count_stats = {"snapshots": 0, "created": 0, "updated": 0, "unchanged": 0, "deleted": 0}
     reader = csv.reader(csvfile)
     iter_reader = iter(reader)
     try:
@@ -85,53 +169,26 @@ def import_data(csvfile):
         raise CommandError("Empty or improperly configured csv")
 
     check_for_required_cols(header_row)
-
-    input_rows = []
-    for row in iter_reader:
-        input_rows.append(row)
+    columns = resolve_columns(header_row)
 
     print("Begin import... ")
 
-    # Now, insert data and generate relationships
-    for irow,row in enumerate(input_rows):
-        new_snapshot = SiteSummarySnapshot()
-
-        for icol,col in enumerate(row):
-            col_name = header_row[icol].lower().strip()
-            if col_name in IGNORED_COLS:
-                continue
-            if col_name == 'when':
-                col_name = 'timestamp'
-            if col_name == 'sites':
-                col_name = 'num_sites'
-            if col_name == 'courses':
-                col_name = 'num_courses'
-            if col_name == 'reasons for discrepencies':
-                col_name = 'notes'
-
-            is_blankable_field = SiteSummarySnapshot._meta.get_field(col_name).blank
-            is_nullable_field = SiteSummarySnapshot._meta.get_field(col_name).null
-            field_default_value = SiteSummarySnapshot._meta.get_field(col_name).default
-
-            # Prevent blank fields from being interpreted as null
-            if is_blankable_field and not is_nullable_field and col is None:
-                col = ""
-            # If field is blank, and attribute has default value, use default value
-            elif (col is None or col == "" or col.isspace()) and field_default_value != NOT_PROVIDED:
-                col = field_default_value
-
-            # If date, format to datetime object
-            if col_name == 'timestamp':
-                col = parser.parse(col)
-
-            setattr(new_snapshot,col_name,col)
-
-        # Save object
-        total_count_stats["snapshots"] += 1
-        new_snapshot.save()
-
+    with transaction.atomic():
+        for chunk in chunked((parse_row(columns, row) for row in iter_reader), chunk_size):
+            if upsert:
+                for name, count in upsert_snapshots(chunk).items():
+                    total_count_stats[name] += count
+            else:
+                SiteSummarySnapshot.objects.bulk_create(chunk)
+            total_count_stats["snapshots"] += len(chunk)
+            print("Imported %s snapshots..." % total_count_stats["snapshots"])
 
     print("Finished!")
     report_string = "Number of snapshots imported: %s\n" % total_count_stats["snapshots"]
+    if upsert:
+        report_string += "Number of snapshots created: %s\n" % total_count_stats["created"]
+        report_string += "Number of snapshots updated: %s\n" % total_count_stats["updated"]
+        report_string += "Number of snapshots unchanged: %s\n" % total_count_stats["unchanged"]
+        report_string += "Number of duplicate snapshots deleted: %s\n" % total_count_stats["deleted"]
 
     return report_string
@@ -1,17 +1,29 @@
 from django.core.management.base import BaseCommand, CommandError
-from ...models import *
+from datetime import datetime
 import csv
-from dateutil import parser
+import heapq
+import itertools
+import pickle
+import tempfile
+from django.db import transaction
 from django.db.models.fields import NOT_PROVIDED
 
+from openedxstats.apps.sites.bulk import chunked
+from openedxstats.apps.sites.models import GeoZone, Language, Site, TagSet, tag_set_digest
+from openedxstats.apps.sites.utils import parse_date
+
 # Fields that the csv must have
 REQUIRED_COLS = ["url"]
 # Fields that we allow to be imported from the csv
 HEADER_NAMES = ["site_type", "name", "url", "course_count", "last_checked", "org_type", "github_fork", "notes",
                 "course_type", "registered_user_count", "active_learner_count", "active_start_date", "active_end_date",
                 "is_private_instance"]
-# Fields that represent m2m relationships (and may have more than one value)
+# Columns of names that make up the site's TagSet (and may have more than one value)
 M2M_HEADER_NAMES = ["geography", "language"]
+# How many sites to insert with each query
+CHUNK_SIZE = 1000
+# How many parsed rows to hold in memory while sorting them; larger files are sorted in runs of this many on disk
+SORT_RUN_SIZE = 50000
 
 
 class Command(BaseCommand):
@@ -31,6 +43,12 @@ class Command(BaseCommand):
       an error
     - If no value is provided for site_type, course_type, or active_start_date, they will default to values of
       'General', 'Unknown', and the current datetime, respectively.
+    - Several rows may have the same url, as versions of one site, in any order: each version ends when the next one
+      starts, and the latest version already in the DB ends when the first newer one in the csv starts. Nothing is
+      imported if any row has the same url and start date as another row or an existing version.
+    - Rows are sorted by url and start date in runs of SORT_RUN_SIZE, written to temporary files and merged, so
+      memory use doesn't grow with the size of the csv, but a large import needs about as much temporary disk space
+      as the csv.
     """
 
     help = 'Imports Open edX site data from a correctly formatted csv file.'
@@ -73,9 +91,161 @@ def check_for_required_cols(header_row):
         return
 
 
-def import_data(csvfile):
+def resolve_columns(header_row):
+    """
+    Work out once per column of the header_row how its values are imported: returns a (field name, field, kind)
+    for each column, kind being 'date', 'field', 'm2m' (with no field), or None for fields that aren't imported.
+    Raises FieldDoesNotExist for a column that isn't a Site field.
+    """
+    columns = []
+    for col in header_row:
+        col_name = str.lower(col).strip()
+        if col_name == 'last_checked':
+            col_name = 'active_start_date'
+        if col_name in M2M_HEADER_NAMES:
+            columns.append((col_name, None, 'm2m'))
+            continue
+        field = Site._meta.get_field(col_name)
+        if col_name in ['active_start_date', 'active_end_date']:
+            kind = 'date'
+        elif col_name in HEADER_NAMES:
+            kind = 'field'
+        else:
+            kind = None
+        columns.append((col_name, field, kind))
+    return columns
+
+
+def parse_row(columns, row):
+    """
+    Make an unsaved Site from a csv row, returning it with the names of its languages and geozones.
+    """
+    new_site = Site()
+    m2m_names = {"language": [], "geography": []}
+
+    for (col_name, field, kind), col in zip(columns, row):
+        if kind is None:
+            continue
+        if kind == 'm2m':
+            m2m_names[col_name].extend(item for item in (col or "").split(',') if len(item.strip()) > 0)
+            continue
+
+        # Prevent blank fields from being interpreted as null
+        if field.blank and not field.null and col is None:
+            col = ""
+        # If field is blank, and attribute has default value, use default value
+        elif (col is None or col == "" or col.isspace()) and field.default != NOT_PROVIDED:
+            col = field.get_default()
+
+        # If date, format to datetime object
+        if kind == 'date' and isinstance(col, str):
+            col = parse_date(col)
+        setattr(new_site, col_name, col)
+
+    return new_site, list(dict.fromkeys(m2m_names["language"])), list(dict.fromkeys(m2m_names["geography"]))
+
+
+def version_key(version):
+    site, _, _ = version
+    return site.url, site.active_start_date
+
+
+def write_run(versions):
+    """
+    Sort `versions` and pickle them to a temporary file, returning it.
+    """
+    versions.sort(key=version_key)
+    run = tempfile.TemporaryFile()
+    for version in versions:
+        pickle.dump(version, run, pickle.HIGHEST_PROTOCOL)
+    return run
+
+
+def read_run(run):
+    """
+    Yield the versions pickled to the temporary file `run`.
+    """
+    run.seek(0)
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
+
+
+def sorted_versions(versions, run_size=SORT_RUN_SIZE):
+    """
+    Yield the parsed `versions` sorted by (url, active_start_date), holding at most `run_size` of them in memory:
+    if there are more, each run of `run_size` is sorted and pickled to a temporary file, and the runs are merged.
+    """
+    versions = iter(versions)
+    first_run = list(itertools.islice(versions, run_size))
+    next_version = next(versions, None)
+    if next_version is None:
+        yield from sorted(first_run, key=version_key)
+        return
+
+    files = []
+    try:
+        files.append(write_run(first_run))
+        del first_run
+        files.extend(write_run(run) for run in chunked(itertools.chain([next_version], versions), run_size))
+        yield from heapq.merge(*(read_run(run) for run in files), key=version_key)
+    finally:
+        for run in files:
+            run.close()
+
+
+def url_chunks(versions, chunk_size):
+    """
+    Yield lists of at least `chunk_size` of the sorted `versions` (fewer for the last), keeping each url's versions
+    in the same list.
+    """
+    chunk = []
+    for _, url_versions in itertools.groupby(versions, key=lambda version: version[0].url):
+        chunk.extend(url_versions)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def chain_versions(versions):
+    """
+    Link the new `versions` of each url, sorted by (url, active_start_date), into a chain with the versions already
+    in the database: each version ends when the next one starts. Returns the existing versions whose end dates
+    changed. Raises CommandError if a version has the same url and start date as another.
+    """
+    existing = {}
+    for urls in chunked(sorted({site.url for site, _, _ in versions}), CHUNK_SIZE):
+        for pk, url, start in Site.objects.filter(url__in=urls).values_list('pk', 'url', 'active_start_date'):
+            existing.setdefault(url, []).append(Site(pk=pk, url=url, active_start_date=start))
+
+    ended = []
+    for url, url_versions in itertools.groupby((site for site, _, _ in versions), key=lambda site: site.url):
+        chain = sorted(
+            [*existing.get(url, []), *url_versions], key=lambda site: (site.active_start_date, site.pk is None)
+        )
+        for version, next_version in zip(chain, chain[1:]):
+            if version.active_start_date == next_version.active_start_date:
+                raise CommandError(
+                    "Cannot insert duplicate records. Key (url, active_start_date)=(%s, %s) already exists." % (
+                    url, next_version.active_start_date))
+            # Versions already in the database only change if a new one comes straight after them
+            if version.pk is None or next_version.pk is None:
+                version.active_end_date = next_version.active_start_date
+                if version.pk is not None:
+                    ended.append(version)
+    return ended
+
+
+def import_data(csvfile, chunk_size=CHUNK_SIZE, run_size=SORT_RUN_SIZE):
     """
-    Iterates through each row of the provided csv, creating the appropriate models and saving them to the DB
+    Reads the rows of the provided csv, creating the appropriate models and saving them to the DB in one
+    transaction. The rows are sorted by url and start date (on disk, if there are more than run_size), then saved
+    chunk_size sites at a time, each chunk holding whole urls, so that its versions are chained together and onto
+    the versions already in the DB in memory with a handful of queries.
     :param csvfile:
     :return:
     """
@@ -88,88 +258,48 @@ def import_data(csvfile):
         raise CommandError("Empty or improperly configured csv")
 
     check_for_required_cols(header_row)
-
-    input_rows = []
-    for row in iter_reader:
-        input_rows.append(row)
+    columns = resolve_columns(header_row)
 
     print("Begin import... ")
 
-    # Now, insert data and generate relationships
-    for irow,row in enumerate(input_rows):
-        new_site = Site()
-        lang_list = []
-        gz_list = []
-
-        for icol,col in enumerate(row):
-            col_name = str.lower(header_row[icol]).strip()
-            if col_name == 'last_checked':
-                col_name = 'active_start_date'
-            is_blankable_field = Site._meta.get_field(col_name).blank
-            is_nullable_field = Site._meta.get_field(col_name).null
-            field_default_value = Site._meta.get_field(col_name).default
-
-            # Prevent blank fields from being interpreted as null
-            if is_blankable_field and not is_nullable_field and col is None:
-                col = ""
-            # If field is blank, and attribute has default value, use default value
-            elif (col is None or col == "" or col.isspace()) and field_default_value != NOT_PROVIDED:
-                col = field_default_value
-
-            if col_name in HEADER_NAMES:
-                # If date, format to datetime object
-                if col_name in ['active_start_date', 'active_end_date']:
-                    col = parser.parse(col)
-
-                setattr(new_site,col_name,col)
-
-            elif col_name in M2M_HEADER_NAMES:
-                items = col.split(',')
-
-                for item in items:
-                    if len(item.strip()) > 0:
-                        if col_name == "language":
-                            language = Language(name=item)
-                            if not Language.objects.filter(name=item).exists():
-                                total_count_stats["languages"] += 1
-                            language.save()
-                            lang_list.append(language)
-
-                        elif col_name == "geography":
-                            geo_zone = GeoZone(name=item)
-                            if not GeoZone.objects.filter(name=item).exists():
-                                total_count_stats["geozones"] += 1
-                            geo_zone.save()
-                            gz_list.append(geo_zone)
-
-        # Save objects
-        # Check if an old version exists
-        if Site.objects.filter(url=new_site.url).exists():
-            old_version = Site.objects.filter(url=new_site.url).latest('active_start_date')
-            if old_version.active_start_date == new_site.active_start_date:
-                raise CommandError(
-                    "Cannot insert duplicate records. Key (url, active_start_date)=(%s, %s) already exists." % (
-                    new_site.url, new_site.active_start_date))
-            else:
-                old_version.active_end_date = new_site.active_start_date
-                old_version.save()
-
-        total_count_stats["sites"] += 1
-        new_site.save()
-
-        for lang in lang_list:
-            # Insert record into junction table to associate with site
-            if not SiteLanguage.objects.filter(site_id=new_site.pk, language_id=lang.name).exists():
-                total_count_stats["site_languages"] += 1
-                site_language = SiteLanguage(site_id=new_site.pk, language_id=lang.name)
-                site_language.save()
-
-        for gz in gz_list:
-            # Insert record into junction table to associate with site
-            if not SiteGeoZone.objects.filter(site_id=new_site.pk, geo_zone_id=gz.name).exists():
-                total_count_stats["site_geozones"] += 1
-                site_geozone = SiteGeoZone(site_id=new_site.pk, geo_zone_id=gz.name)
-                site_geozone.save()
+    versions = sorted_versions((parse_row(columns, row) for row in iter_reader), run_size)
+
+    with transaction.atomic():
+        # Languages and geozones are looked up once, and the missing ones created with each chunk
+        languages = set(Language.objects.values_list('name', flat=True))
+        geozones = set(GeoZone.objects.values_list('name', flat=True))
+
+        for chunk in url_chunks(versions, chunk_size):
+            ended = chain_versions(chunk)
+
+            new_languages = {name for _, site_languages, _ in chunk for name in site_languages} - languages
+            new_geozones = {name for _, _, site_geozones in chunk for name in site_geozones} - geozones
+            Language.objects.bulk_create([Language(name=name) for name in sorted(new_languages)])
+            GeoZone.objects.bulk_create([GeoZone(name=name) for name in sorted(new_geozones)])
+            languages |= new_languages
+            geozones |= new_geozones
+            total_count_stats["languages"] += len(new_languages)
+            total_count_stats["geozones"] += len(new_geozones)
+
+            # bulk_update doesn't call pre_save, so recompute the validity ranges of the versions that now end
+            valid_during = Site._meta.get_field('valid_during')
+            for version in ended:
+                valid_during.pre_save(version, False)
+                version.last_modified = datetime.now()
+            Site.objects.bulk_update(ended, ['active_end_date', 'valid_during', 'last_modified'])
+
+            # There are far fewer distinct sets of tags than sites, so a chunk's are found or created at once
+            tag_set_ids = TagSet.ids_for(
+                (site_languages, site_geozones) for _, site_languages, site_geozones in chunk
+            )
+            for new_site, site_languages, site_geozones in chunk:
+                new_site.tag_set_id = tag_set_ids.get(tag_set_digest(site_languages, site_geozones))
+                total_count_stats["site_languages"] += len(site_languages)
+                total_count_stats["site_geozones"] += len(site_geozones)
+
+            Site.objects.bulk_create([new_site for new_site, _, _ in chunk])
+            total_count_stats["sites"] += len(chunk)
+            print("Imported %s sites..." % total_count_stats["sites"])
 
     print("Finished!")
     report_string = "\nReport:\n"
@@ -0,0 +1,162 @@
+"""
+Keep one auto-generated SiteSummarySnapshot per day, from the day after the last imported snapshot through today.
+
+Each run only recomputes the days that could have changed: those from the earliest start date of any Site or
+OverCount modified since the previous run, or deleted since then, plus today, which is still in progress. Rows are
+matched to days by date, so re-running is idempotent, and any duplicate rows left by older versions of the OT chart
+are removed.
+
+A row's last_modified is stamped when it's saved, not when its transaction commits, so a bulk update or import still
+running when a run starts can commit rows stamped before it. Each run therefore also looks at rows modified in the
+MODIFIED_MARGIN before the previous run started.
+
+This command should be run on a scheduled basis, e.g. hourly.
+"""
+from datetime import date, datetime, time, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min, Q
+from psycopg2.extras import DateTimeTZRange
+
+from openedxstats.apps.sites.models import (
+    AUTO_GENERATED_NOTES, DailySummaryRun, OverCount, Site, SiteSummarySnapshot,
+)
+from openedxstats.apps.sites.timeseries import interval_sums
+from openedxstats.apps.sites.views import valid_sites_query
+
+# How long before a run started a row could be stamped and still not be committed when the run read it
+MODIFIED_MARGIN = timedelta(hours=1)
+
+
+class Command(BaseCommand):
+    help = 'Brings the daily site and course totals used by the OT chart up to date.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full',
+                            dest='full',
+                            action='store_true',
+                            default=False,
+                            help='Recompute every day, not just the ones affected by changes since the last run.')
+
+    def handle(self, *args, **options):
+        stats = materialize_daily_summaries(full=options['full'])
+        self.stdout.write(
+            "Days computed: {computed}, created: {created}, updated: {updated}, deleted: {deleted}".format(**stats)
+        )
+
+
+def end_of_day(day):
+    """
+    Daily snapshots are taken at the last second of the day.
+    """
+    return datetime.combine(day, time(23, 59, 59))
+
+
+def daily_totals(days):
+    """
+    Return a (num_sites, num_courses) pair for each datetime in the ascending list `days`, counting the site
+    versions active at that moment. We only count public sites with > 0 courses, and count all private sites.
+    Over-counted courses are subtracted.
+    """
+    if not days:
+        return []
+    date_select = Q(valid_during__overlap=DateTimeTZRange(days[0], days[-1], bounds='[]'))
+    site_versions = list(Site.objects.filter(valid_sites_query() & date_select).values_list(
+        'active_start_date', 'active_end_date', 'course_count'
+    ))
+    over_counts = list(OverCount.objects.filter(date_select).values_list(
+        'active_start_date', 'active_end_date', 'course_count'
+    ))
+
+    daily_sites = interval_sums(days, [(start, end, 1) for start, end, _ in site_versions])
+    daily_courses = interval_sums(days, site_versions)
+    daily_over_counts = interval_sums(days, over_counts)
+    return [
+        (num_sites, num_courses - over_count)
+        for num_sites, num_courses, over_count in zip(daily_sites, daily_courses, daily_over_counts)
+    ]
+
+
+def first_summary_date():
+    """
+    Auto-generated summaries start the day after the last imported snapshot, or on the day of the first site.
+    """
+    last_imported = SiteSummarySnapshot.objects.exclude(notes=AUTO_GENERATED_NOTES).order_by('-timestamp').first()
+    if last_imported is not None:
+        return last_imported.timestamp.date() + timedelta(days=1)
+    first_site_start = Site.objects.aggregate(first=Min('active_start_date'))['first']
+    return first_site_start.date() if first_site_start is not None else None
+
+
+def first_changed_date(since):
+    """
+    The earliest date whose totals could have been changed by Site or OverCount rows modified after `since`.
+    """
+    starts = [
+        model.objects.filter(last_modified__gte=since).aggregate(first=Min('active_start_date'))['first']
+        for model in (Site, OverCount)
+    ]
+    starts = [start.date() for start in starts if start is not None]
+    return min(starts) if starts else None
+
+
+def materialize_daily_summaries(full=False):
+    """
+    Upsert the auto-generated daily SiteSummarySnapshots, returning counts of what was done.
+    """
+    stats = {"computed": 0, "created": 0, "updated": 0, "deleted": 0}
+    with transaction.atomic():
+        run, _ = DailySummaryRun.objects.select_for_update().get_or_create(pk=1)
+        started = datetime.now()
+
+        first_date = first_summary_date()
+        if first_date is None:
+            return stats
+        today = started.date()
+        if not full and run.last_run is not None:
+            changed_dates = [first_changed_date(run.last_run - MODIFIED_MARGIN), run.changed_from, today]
+            first_date = max(first_date, min(changed for changed in changed_dates if changed is not None))
+
+        days = [end_of_day(date.fromordinal(n)) for n in range(first_date.toordinal(), today.toordinal() + 1)]
+        totals = dict(zip((day.date() for day in days), daily_totals(days)))
+        stats["computed"] = len(days)
+
+        existing = SiteSummarySnapshot.objects.filter(
+            notes=AUTO_GENERATED_NOTES, timestamp__gte=datetime.combine(first_date, time.min)
+        ).order_by('timestamp', 'pk')
+        to_update = []
+        to_delete = []
+        seen = set()
+        for snapshot in existing:
+            day = snapshot.timestamp.date()
+            if day in seen or day not in totals:
+                to_delete.append(snapshot.pk)
+                continue
+            seen.add(day)
+            num_sites, num_courses = totals[day]
+            timestamp = end_of_day(day)
+            if (snapshot.timestamp, snapshot.num_sites, snapshot.num_courses) != (timestamp, num_sites, num_courses):
+                snapshot.timestamp = timestamp
+                snapshot.num_sites = num_sites
+                snapshot.num_courses = num_courses
+                to_update.append(snapshot)
+
+        to_create = [
+            SiteSummarySnapshot(
+                timestamp=end_of_day(day), num_sites=num_sites, num_courses=num_courses, notes=AUTO_GENERATED_NOTES
+            )
+            for day, (num_sites, num_courses) in totals.items()
+            if day not in seen
+        ]
+
+        SiteSummarySnapshot.objects.filter(pk__in=to_delete).delete()
+        SiteSummarySnapshot.objects.bulk_update(to_update, ['timestamp', 'num_sites', 'num_courses'])
+        SiteSummarySnapshot.objects.bulk_create(to_create)
+        stats.update(created=len(to_create), updated=len(to_update), deleted=len(to_delete))
+
+        run.last_run = started
+        run.changed_from = None
+        run.save()
+
+    return stats
@@ -0,0 +1,70 @@
+"""
+Process the BulkJobs queued by bulk_update and bulk_create with `async`, a chunk at a time.
+
+Several of these can run at once: each chunk is locked while it's processed, and the others skip it. A chunk that
+raises an error is tried again after --retry-delay seconds, then twice that, and so on, up to --max-attempts times,
+and then left as failed; use --retry-failed to queue the failed chunks again, e.g. once whatever made them fail is
+fixed. The chunks behind a failing one aren't held up while it waits.
+
+Run it continuously as a worker process, or on a schedule with --once.
+"""
+from datetime import timedelta
+import time
+
+from django.core.management.base import BaseCommand
+
+from openedxstats.apps.sites.bulk import MAX_ATTEMPTS, RETRY_DELAY, retry_failed_chunks, run_next_chunk
+from openedxstats.apps.sites.models import BulkJobChunk
+
+
+class Command(BaseCommand):
+    help = 'Processes queued bulk_update and bulk_create jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once',
+                            dest='once',
+                            action='store_true',
+                            default=False,
+                            help='Stop when there are no more chunks to process, instead of waiting for more.')
+        parser.add_argument('--sleep',
+                            dest='sleep',
+                            type=float,
+                            default=5.0,
+                            help='How many seconds to wait before checking an empty queue again.')
+        parser.add_argument('--max-attempts',
+                            dest='max_attempts',
+                            type=int,
+                            default=MAX_ATTEMPTS,
+                            help='How many times to try a chunk before marking it as failed.')
+        parser.add_argument('--retry-delay',
+                            dest='retry_delay',
+                            type=float,
+                            default=RETRY_DELAY.total_seconds(),
+                            help='How many seconds to wait before trying a chunk again after its first failure.')
+        parser.add_argument('--retry-failed',
+                            dest='retry_failed',
+                            action='store_true',
+                            default=False,
+                            help='Queue the chunks that have failed again before starting.')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            self.stdout.write("Chunks queued again: %s" % retry_failed_chunks())
+
+        while True:
+            chunk = run_next_chunk(
+                max_attempts=options['max_attempts'], retry_delay=timedelta(seconds=options['retry_delay'])
+            )
+            if chunk is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            if chunk.status == BulkJobChunk.DONE:
+                outcome = "done"
+            elif chunk.status == BulkJobChunk.FAILED:
+                outcome = "failed after %s attempts" % chunk.attempts
+            else:
+                outcome = "failed, will retry"
+            self.stdout.write("Job %s chunk %s (%s sites): %s" % (chunk.job_id, chunk.index, chunk.num_sites, outcome))
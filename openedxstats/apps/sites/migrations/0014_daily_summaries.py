@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0013_auto_20210103_1829'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySummaryRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_run', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='overcount',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='sitesummarysnapshot',
+            index=models.Index(fields=['timestamp'], name='sites_sites_timesta_4d6180_idx'),
+        ),
+    ]
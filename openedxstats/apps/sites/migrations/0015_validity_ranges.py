@@ -0,0 +1,42 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:44
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+import openedxstats.apps.sites.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0014_daily_summaries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='overcount',
+            name='valid_during',
+            field=openedxstats.apps.sites.models.ValidityRangeField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='valid_during',
+            field=openedxstats.apps.sites.models.ValidityRangeField(editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            [
+                "UPDATE sites_site SET valid_during = CASE WHEN active_end_date < active_start_date THEN NULL "
+                "ELSE tstzrange(active_start_date, active_end_date, '[]') END",
+                "UPDATE sites_overcount SET valid_during = CASE WHEN active_end_date < active_start_date THEN NULL "
+                "ELSE tstzrange(active_start_date, active_end_date, '[]') END",
+            ],
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='overcount',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['valid_during'], name='sites_overc_valid_d_bfe33c_gist'),
+        ),
+        migrations.AddIndex(
+            model_name='site',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['valid_during'], name='sites_site_valid_d_67d82e_gist'),
+        ),
+    ]
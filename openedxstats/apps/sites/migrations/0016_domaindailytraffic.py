@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:46
+
+from django.db import migrations, models
+from django.db.models import Q, Sum
+
+
+def fill_domain_daily_traffic(apps, schema_editor):
+    """
+    Roll up the referrer logs already fetched, with the same filters site discovery used to apply.
+    """
+    AccessLogAggregate = apps.get_model('sites', 'AccessLogAggregate')
+    DomainDailyTraffic = apps.get_model('sites', 'DomainDailyTraffic')
+    daily_counts = AccessLogAggregate.objects.filter(
+        ~Q(domain__endswith='.amazonaws.com') & ~Q(domain__endswith='.edx.org') & ~Q(domain='') &
+        ~Q(domain__regex=r'^[0-9]+(?:\.[0-9]+){3}$') & ~Q(domain__regex=r':[0-9]+'),
+        domain__isnull=False,
+        access_date__isnull=False,
+    ).values('domain', 'access_date').annotate(count=Sum('access_count')).order_by()
+    DomainDailyTraffic.objects.bulk_create(
+        (
+            DomainDailyTraffic(domain=row['domain'], access_date=row['access_date'], access_count=row['count'] or 0)
+            for row in daily_counts.iterator()
+        ),
+        batch_size=5000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0015_validity_ranges'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DomainDailyTraffic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('domain', models.CharField(max_length=255)),
+                ('access_date', models.DateField()),
+                ('access_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='domaindailytraffic',
+            index=models.Index(fields=['access_date'], name='sites_domai_access__440a61_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='domaindailytraffic',
+            unique_together={('domain', 'access_date')},
+        ),
+        migrations.RunPython(fill_domain_daily_traffic, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,134 @@
+import re
+from urllib import parse
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+
+# The classification as it was when Domain was added, frozen here so later changes to Domain.classify don't change
+# what this migration does
+AWS_DOMAIN_SUFFIX = '.amazonaws.com'
+EDX_DOMAIN_SUFFIX = '.edx.org'
+IP_ADDRESS_DOMAIN = re.compile(r'^[0-9]+(?:\.[0-9]+){3}$')
+PORT_DOMAIN = re.compile(r':[0-9]+')
+CHAFF_SUBDOMAINS = ('www', 'studio', 'staging', 'preview', 'stage', 'cms')
+
+
+def classify(Domain, name):
+    """
+    An unsaved Domain for the host `name`, with its canonical and short forms and its classification.
+    """
+    netloc = parse.urlparse(name).netloc if '//' in name else name
+    netloc = netloc.rstrip(".")
+    return Domain(
+        name=name,
+        netloc=netloc,
+        short_netloc=".".join(part for part in netloc.split(".") if part not in CHAFF_SUBDOMAINS),
+        is_ip_address=bool(IP_ADDRESS_DOMAIN.match(name)),
+        has_port=bool(PORT_DOMAIN.search(name)),
+        is_aws=name.endswith(AWS_DOMAIN_SUFFIX),
+        is_edx=name.endswith(EDX_DOMAIN_SUFFIX),
+    )
+
+
+def fill_domains(apps, schema_editor):
+    """
+    Make a Domain for every referrer host already recorded, and point the aggregates and rollup at them.
+    """
+    AccessLogAggregate = apps.get_model('sites', 'AccessLogAggregate')
+    DomainDailyTraffic = apps.get_model('sites', 'DomainDailyTraffic')
+    Domain = apps.get_model('sites', 'Domain')
+
+    names = set(AccessLogAggregate.objects.exclude(domain_name=None).values_list('domain_name', flat=True).distinct())
+    names.update(DomainDailyTraffic.objects.values_list('domain_name', flat=True).distinct())
+    Domain.objects.bulk_create((classify(Domain, name) for name in names), batch_size=5000)
+
+    domain_id = Subquery(Domain.objects.filter(name=OuterRef('domain_name')).values('pk')[:1])
+    AccessLogAggregate.objects.exclude(domain_name=None).update(domain=domain_id)
+    DomainDailyTraffic.objects.update(domain=domain_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0016_domaindailytraffic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Domain',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('netloc', models.CharField(max_length=255)),
+                ('short_netloc', models.CharField(max_length=255)),
+                ('is_ip_address', models.BooleanField(default=False)),
+                ('has_port', models.BooleanField(default=False)),
+                ('is_aws', models.BooleanField(default=False)),
+                ('is_edx', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='domain',
+            index=models.Index(
+                condition=models.Q(
+                    models.Q(('name', ''), _negated=True),
+                    ('has_port', False), ('is_aws', False), ('is_edx', False), ('is_ip_address', False),
+                ),
+                fields=['id'],
+                name='sites_domain_discoverable',
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name='accesslogaggregate',
+            unique_together=set(),
+        ),
+        migrations.AlterUniqueTogether(
+            name='domaindailytraffic',
+            unique_together=set(),
+        ),
+        migrations.RenameField(
+            model_name='accesslogaggregate',
+            old_name='domain',
+            new_name='domain_name',
+        ),
+        migrations.RenameField(
+            model_name='domaindailytraffic',
+            old_name='domain',
+            new_name='domain_name',
+        ),
+        migrations.AddField(
+            model_name='accesslogaggregate',
+            name='domain',
+            field=models.ForeignKey(
+                blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='sites.domain'
+            ),
+        ),
+        migrations.AddField(
+            model_name='domaindailytraffic',
+            name='domain',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='sites.domain'),
+        ),
+        migrations.RunPython(fill_domains, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='accesslogaggregate',
+            name='domain_name',
+        ),
+        migrations.RemoveField(
+            model_name='domaindailytraffic',
+            name='domain_name',
+        ),
+        migrations.AlterField(
+            model_name='domaindailytraffic',
+            name='domain',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sites.domain'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='accesslogaggregate',
+            unique_together={('domain', 'access_date', 'filename')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='domaindailytraffic',
+            unique_together={('domain', 'access_date')},
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0017_domain'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogListingMark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=255, unique=True)),
+                ('last_key', models.CharField(max_length=1024)),
+            ],
+        ),
+    ]
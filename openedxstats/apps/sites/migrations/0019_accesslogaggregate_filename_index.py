@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0018_loglistingmark'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='accesslogaggregate',
+            name='filename',
+            field=models.CharField(blank=True, db_index=True, default=None, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0019_accesslogaggregate_filename_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accesslogaggregate',
+            name='visitor_sketch',
+            field=models.BinaryField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='domaindailytraffic',
+            name='visitor_sketch',
+            field=models.BinaryField(blank=True, default=None, null=True),
+        ),
+    ]
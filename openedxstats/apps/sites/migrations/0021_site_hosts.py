@@ -0,0 +1,67 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:39
+
+import itertools
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import openedxstats.apps.sites.models
+
+# How many site versions to fill in with each query
+BATCH_SIZE = 1000
+
+
+def normalized_host(url):
+    """
+    A site url or alias normalized as SiteHostsField did when it was added, frozen here so later changes to it
+    don't change what this migration writes.
+    """
+    if '//' in url:
+        url = url.split('//', 1)[1]
+    return url.strip().rstrip('/').rstrip('.').lower()
+
+
+def site_hosts(site):
+    """
+    The distinct normalized hosts of a site version's url and aliases, url first.
+    """
+    hosts = []
+    for url in [site.url, *site.aliases]:
+        host = normalized_host(url)
+        if host and host not in hosts:
+            hosts.append(host)
+    return hosts
+
+
+def fill_hosts(apps, schema_editor):
+    """
+    Compute the hosts of every existing site version, a batch at a time.
+    """
+    Site = apps.get_model('sites', 'Site')
+    sites = Site.objects.only('url', 'aliases').order_by('pk').iterator(chunk_size=BATCH_SIZE)
+    while True:
+        batch = list(itertools.islice(sites, BATCH_SIZE))
+        if not batch:
+            break
+        for site in batch:
+            site.hosts = site_hosts(site)
+        Site.objects.bulk_update(batch, ['hosts'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0020_visitor_sketches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='hosts',
+            field=openedxstats.apps.sites.models.SiteHostsField(base_field=models.CharField(max_length=255), default=list, editable=False, size=None),
+        ),
+        migrations.RunPython(fill_hosts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='site',
+            index=django.contrib.postgres.indexes.GinIndex(condition=models.Q(('active_end_date', None)), fields=['hosts'], name='sites_site_current_hosts'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0021_site_hosts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteCheck',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=255, unique=True)),
+                ('last_checked', models.DateTimeField()),
+            ],
+        ),
+    ]
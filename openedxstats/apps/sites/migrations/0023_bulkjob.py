@@ -0,0 +1,48 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:44
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0022_sitecheck'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('update', 'bulk_update'), ('create', 'bulk_create')], max_length=10)),
+                ('num_sites', models.IntegerField()),
+                ('created', models.DateTimeField(default=datetime.datetime.now)),
+                ('finished', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BulkJobChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('payload', models.JSONField()),
+                ('num_sites', models.IntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('results', models.JSONField(null=True)),
+                ('error', models.TextField(blank=True)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='sites.bulkjob')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='bulkjobchunk',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['id'], name='sites_bulkjobchunk_pending'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='bulkjobchunk',
+            unique_together={('job', 'index')},
+        ),
+    ]
@@ -0,0 +1,110 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:09
+
+import hashlib
+import json
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def tag_set_digest(languages, geozones):
+    """
+    The content address of a set of language and geozone names, as TagSet computed it when it was added.
+    """
+    canonical = json.dumps([sorted(set(languages)), sorted(set(geozones))])
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def fill_tag_sets(apps, schema_editor):
+    """
+    Point every site version with languages or geographies at the TagSet of their names, creating one TagSet per
+    distinct set.
+    """
+    Site = apps.get_model('sites', 'Site')
+    SiteLanguage = apps.get_model('sites', 'SiteLanguage')
+    SiteGeoZone = apps.get_model('sites', 'SiteGeoZone')
+    TagSet = apps.get_model('sites', 'TagSet')
+
+    tags = {}
+    for site_id, name in SiteLanguage.objects.values_list('site_id', 'language_id').iterator():
+        tags.setdefault(site_id, (set(), set()))[0].add(name)
+    for site_id, name in SiteGeoZone.objects.values_list('site_id', 'geo_zone_id').iterator():
+        tags.setdefault(site_id, (set(), set()))[1].add(name)
+
+    digests = {site_id: tag_set_digest(languages, geozones) for site_id, (languages, geozones) in tags.items()}
+    tag_sets = {}
+    for site_id, digest in digests.items():
+        languages, geozones = tags[site_id]
+        tag_sets.setdefault(digest, TagSet(digest=digest, languages=sorted(languages), geozones=sorted(geozones)))
+    TagSet.objects.bulk_create(tag_sets.values(), batch_size=1000)
+
+    Site.objects.bulk_update(
+        [Site(pk=site_id, tag_set_id=tag_sets[digest].pk) for site_id, digest in digests.items()],
+        ['tag_set'], batch_size=1000,
+    )
+
+
+def fill_junction_tables(apps, schema_editor):
+    """
+    Give every site version a SiteLanguage and SiteGeoZone row for each of the names in its TagSet.
+    """
+    Site = apps.get_model('sites', 'Site')
+    SiteLanguage = apps.get_model('sites', 'SiteLanguage')
+    SiteGeoZone = apps.get_model('sites', 'SiteGeoZone')
+    site_languages = []
+    site_geozones = []
+    for site_id, languages, geozones in Site.objects.exclude(tag_set=None).values_list(
+        'pk', 'tag_set__languages', 'tag_set__geozones'
+    ).iterator():
+        site_languages.extend(SiteLanguage(site_id=site_id, language_id=name) for name in languages)
+        site_geozones.extend(SiteGeoZone(site_id=site_id, geo_zone_id=name) for name in geozones)
+    SiteLanguage.objects.bulk_create(site_languages, batch_size=5000)
+    SiteGeoZone.objects.bulk_create(site_geozones, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0023_bulkjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagSet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=40, unique=True)),
+                ('languages', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=255), default=list, size=None)),
+                ('geozones', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=255), default=list, size=None)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='tag_set',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='sites.tagset'),
+        ),
+        migrations.RunPython(fill_tag_sets, fill_junction_tables),
+        migrations.RemoveField(
+            model_name='sitelanguage',
+            name='language',
+        ),
+        migrations.RemoveField(
+            model_name='sitelanguage',
+            name='site',
+        ),
+        migrations.RemoveField(
+            model_name='site',
+            name='geography',
+        ),
+        migrations.RemoveField(
+            model_name='site',
+            name='language',
+        ),
+        migrations.DeleteModel(
+            name='SiteGeoZone',
+        ),
+        migrations.DeleteModel(
+            name='SiteLanguage',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0024_tag_sets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailysummaryrun',
+            name='changed_from',
+            field=models.DateField(null=True),
+        ),
+    ]
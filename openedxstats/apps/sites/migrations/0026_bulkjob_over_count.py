@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0025_dailysummaryrun_changed_from'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkjob',
+            name='over_count',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='bulkjob',
+            name='over_count_set',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_tag_sets(apps, schema_editor):
+    """
+    Make the junction rows for the names in every TagSet. Languages and geozones deleted since the sets were made are
+    created again, so that no site loses its tags.
+    """
+    TagSet = apps.get_model('sites', 'TagSet')
+    Language = apps.get_model('sites', 'Language')
+    GeoZone = apps.get_model('sites', 'GeoZone')
+    TagSetLanguage = apps.get_model('sites', 'TagSetLanguage')
+    TagSetGeoZone = apps.get_model('sites', 'TagSetGeoZone')
+
+    tag_set_languages = []
+    tag_set_geozones = []
+    for pk, languages, geozones in TagSet.objects.values_list('pk', 'languages', 'geozones').iterator():
+        tag_set_languages.extend(TagSetLanguage(tag_set_id=pk, language_id=name) for name in languages)
+        tag_set_geozones.extend(TagSetGeoZone(tag_set_id=pk, geo_zone_id=name) for name in geozones)
+
+    Language.objects.bulk_create(
+        [Language(name=name) for name in {row.language_id for row in tag_set_languages}], ignore_conflicts=True
+    )
+    GeoZone.objects.bulk_create(
+        [GeoZone(name=name) for name in {row.geo_zone_id for row in tag_set_geozones}], ignore_conflicts=True
+    )
+    TagSetLanguage.objects.bulk_create(tag_set_languages, batch_size=5000)
+    TagSetGeoZone.objects.bulk_create(tag_set_geozones, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0026_bulkjob_over_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagSetLanguage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='sites.language')),
+                ('tag_set', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sites.tagset')),
+            ],
+            options={
+                'unique_together': {('tag_set', 'language')},
+            },
+        ),
+        migrations.CreateModel(
+            name='TagSetGeoZone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('geo_zone', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='sites.geozone')),
+                ('tag_set', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sites.tagset')),
+            ],
+            options={
+                'unique_together': {('tag_set', 'geo_zone')},
+            },
+        ),
+        migrations.AddField(
+            model_name='tagset',
+            name='geography',
+            field=models.ManyToManyField(related_name='tag_sets', through='sites.TagSetGeoZone', to='sites.GeoZone'),
+        ),
+        migrations.AddField(
+            model_name='tagset',
+            name='language',
+            field=models.ManyToManyField(related_name='tag_sets', through='sites.TagSetLanguage', to='sites.Language'),
+        ),
+        migrations.RunPython(link_tag_sets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0027_tag_set_links'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkjobchunk',
+            name='retry_after',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
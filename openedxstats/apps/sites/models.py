@@ -1,7 +1,19 @@
-from datetime import datetime
-
-from django.db import models
-from django.contrib.postgres.fields import ArrayField
+from datetime import date, datetime
+import hashlib
+import json
+import re
+from urllib import parse
+
+from django.db import connection, models, transaction
+from django.db.models import Q, Sum, Value
+from django.db.models.functions import Least
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.contrib.postgres.fields import ArrayField, DateTimeRangeField
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from psycopg2.extras import DateTimeTZRange, execute_values
+
+from openedxstats.apps.sites.hyperloglog import HyperLogLog
 
 COURSE_TYPE_CHOICES = (
     ('MOOC', 'MOOC'),
@@ -10,6 +22,75 @@ COURSE_TYPE_CHOICES = (
     ('Unknown', 'Unknown'),
 )
 
+
+class ValidityRangeField(DateTimeRangeField):
+    """
+    The closed interval [active_start_date, active_end_date] of a versioned row, recomputed whenever the row is
+    saved. A null active_end_date gives a range with no upper bound. A row that ends before it starts has no range
+    (check_site_versions reports it), since Postgres can't store an inverted one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('null', True)
+        super().__init__(*args, **kwargs)
+
+    def pre_save(self, model_instance, add):
+        opts = model_instance._meta
+        start = opts.get_field('active_start_date').to_python(model_instance.active_start_date)
+        end = opts.get_field('active_end_date').to_python(model_instance.active_end_date)
+        if end is not None and end < start:
+            value = None
+        else:
+            value = DateTimeTZRange(start, end, bounds='[]')
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+def normalized_host(url):
+    """
+    A site url or alias without its scheme, trailing slash or trailing dot, lowercased, so that urls written
+    differently can be matched exactly: "https://Foo.org/" and "foo.org" are both "foo.org". Any path is kept.
+    """
+    if '//' in url:
+        url = url.split('//', 1)[1]
+    return url.strip().rstrip('/').rstrip('.').lower()
+
+
+class SiteHostsField(ArrayField):
+    """
+    The normalized hosts of a site's url and its aliases, url first, recomputed whenever the row is saved so that
+    sites can be looked up by any of them with an index.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('base_field', models.CharField(max_length=255))
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('default', list)
+        super().__init__(*args, **kwargs)
+
+    def pre_save(self, model_instance, add):
+        value = []
+        for url in [model_instance.url, *model_instance.aliases]:
+            host = normalized_host(url)
+            if host and host not in value:
+                value.append(host)
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+class VersionedQuerySet(models.QuerySet):
+    """
+    QuerySet for models whose rows are versions valid from active_start_date until active_end_date.
+    """
+
+    def as_of(self, when):
+        """
+        The versions that were active at the datetime `when`, found with the GiST index on valid_during.
+        """
+        return self.filter(valid_during__contains=when)
+
+
 # Models
 
 class GeoZone(models.Model):
@@ -46,6 +127,15 @@ class OverCount(models.Model):
     course_count = models.IntegerField()
     active_start_date = models.DateTimeField(default=datetime.now, unique=True)
     active_end_date = models.DateTimeField(null=True)
+    valid_during = ValidityRangeField()
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = VersionedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            GistIndex(fields=["valid_during"]),
+        ]
 
     @classmethod
     def set_latest(cls, over_count):
@@ -67,6 +157,119 @@ class OverCount(models.Model):
 
 
 
+def tag_set_digest(languages, geozones):
+    """
+    The content address of a set of language and geozone names: a hash of the sorted, distinct names.
+    """
+    canonical = json.dumps([sorted(set(languages)), sorted(set(geozones))])
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class TagSet(models.Model):
+    """
+    A distinct set of language and geozone names, stored once and shared by every Site version that has it, so a
+    new version of a site only needs the set's id. Sets are content-addressed by tag_set_digest of their names.
+
+    The names are kept in arrays so a site's tags can be read without joins, and in the TagSetLanguage and
+    TagSetGeoZone junction tables, which keep a Language or GeoZone from being deleted while a set uses it.
+    """
+    digest = models.CharField(max_length=40, unique=True)
+    languages = ArrayField(models.CharField(max_length=255), default=list)
+    geozones = ArrayField(models.CharField(max_length=255), default=list)
+    language = models.ManyToManyField(Language, through='TagSetLanguage', related_name='tag_sets')
+    geography = models.ManyToManyField(GeoZone, through='TagSetGeoZone', related_name='tag_sets')
+
+    def __str__(self):
+        return ", ".join(self.languages) + ' --- ' + ", ".join(self.geozones)
+
+    @classmethod
+    def ids_for(cls, tag_sets):
+        """
+        Find or create the TagSets with the (language names, geozone names) pairs in `tag_sets`, in one upsert.
+        Returns a dict mapping their digests to their ids; an empty set has no TagSet, and sites without tags have
+        a null tag_set.
+
+        Raises ValueError if a new set has a name that isn't a Language or GeoZone.
+        """
+        rows = {}
+        for languages, geozones in tag_sets:
+            if languages or geozones:
+                rows.setdefault(tag_set_digest(languages, geozones), (sorted(set(languages)), sorted(set(geozones))))
+        if not rows:
+            return {}
+        # No savepoint: a bad name is an error for the whole of the caller's transaction
+        with transaction.atomic(savepoint=False), connection.cursor() as cursor:
+            # The no-op update makes existing sets come back from RETURNING too; only new rows have no xmax
+            found = execute_values(
+                cursor,
+                f"""
+                INSERT INTO {cls._meta.db_table} (digest, languages, geozones) VALUES %s
+                ON CONFLICT (digest) DO UPDATE SET digest = EXCLUDED.digest
+                RETURNING digest, id, xmax = 0
+                """,
+                [(digest, languages, geozones) for digest, (languages, geozones) in sorted(rows.items())],
+                template="(%s, %s::varchar[], %s::varchar[])",
+                page_size=5000,
+                fetch=True,
+            )
+            created = {digest: pk for digest, pk, inserted in found if inserted}
+            if created:
+                cls._link_names(created, rows)
+        return {digest: pk for digest, pk, _ in found}
+
+    @classmethod
+    def _link_names(cls, created, rows):
+        """
+        Make the junction rows of the `created` sets, a dict mapping digests to ids, whose names are in `rows`.
+        """
+        new_languages = {name for digest in created for name in rows[digest][0]}
+        new_geozones = {name for digest in created for name in rows[digest][1]}
+        missing = sorted(
+            (new_languages - set(Language.objects.filter(name__in=new_languages).values_list('name', flat=True)))
+            | (new_geozones - set(GeoZone.objects.filter(name__in=new_geozones).values_list('name', flat=True)))
+        )
+        if missing:
+            raise ValueError(f"No such languages or geozones: {', '.join(missing)}")
+        TagSetLanguage.objects.bulk_create([
+            TagSetLanguage(tag_set_id=pk, language_id=name)
+            for digest, pk in created.items() for name in rows[digest][0]
+        ], batch_size=5000)
+        TagSetGeoZone.objects.bulk_create([
+            TagSetGeoZone(tag_set_id=pk, geo_zone_id=name)
+            for digest, pk in created.items() for name in rows[digest][1]
+        ], batch_size=5000)
+
+    @classmethod
+    def id_for(cls, languages, geozones):
+        """
+        The id of the TagSet with these language and geozone names, creating it if need be, or None if both are
+        empty.
+        """
+        return cls.ids_for([(languages, geozones)]).get(tag_set_digest(languages, geozones))
+
+
+class TagSetLanguage(models.Model):
+    """
+    Junction table for a TagSet and the Languages named in it.
+    """
+    tag_set = models.ForeignKey(TagSet, on_delete=models.CASCADE)
+    language = models.ForeignKey(Language, on_delete=models.PROTECT)
+
+    class Meta:
+        unique_together = ("tag_set", "language")
+
+
+class TagSetGeoZone(models.Model):
+    """
+    Junction table for a TagSet and the GeoZones named in it.
+    """
+    tag_set = models.ForeignKey(TagSet, on_delete=models.CASCADE)
+    geo_zone = models.ForeignKey(GeoZone, on_delete=models.PROTECT)
+
+    class Meta:
+        unique_together = ("tag_set", "geo_zone")
+
+
 class Site(models.Model):
     """
     A model describing an open edX website.
@@ -85,55 +288,122 @@ class Site(models.Model):
     active_start_date = models.DateTimeField(default=datetime.now)
     active_end_date = models.DateTimeField(null=True)
     org_type = models.CharField(max_length=255, blank=True)
-    language = models.ManyToManyField(Language, through='SiteLanguage', blank=True)
-    geography = models.ManyToManyField(GeoZone, through='SiteGeoZone', blank=True)
+    tag_set = models.ForeignKey(TagSet, null=True, blank=True, on_delete=models.PROTECT)
     github_fork = models.CharField(max_length=255, blank=True)
     notes = models.TextField(blank=True)
     course_type = models.CharField(max_length=10, choices=COURSE_TYPE_CHOICES, default='Unknown')
     registered_user_count = models.IntegerField(blank=True, null=True)
     active_learner_count = models.IntegerField(blank=True, null=True)
     aliases = ArrayField(models.CharField(max_length=255), default=list, blank=True)
+    hosts = SiteHostsField()
+    valid_during = ValidityRangeField()
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = VersionedQuerySet.as_manager()
 
     def __str__(self):
         return self.name + ' --- ' + self.url
 
+    @classmethod
+    def current_by_host(cls, urls):
+        """
+        Look up the current versions of the sites with `urls` as their url or one of their aliases, in one query
+        using the index on hosts. Returns a dict mapping each url found to its Site; a site's own url takes
+        precedence over another site's alias. The sites found are locked for update, so call it in a transaction.
+        """
+        hosts = {url: normalized_host(url) for url in urls}
+        sites = list(
+            cls.objects.select_for_update().filter(active_end_date=None, hosts__overlap=sorted(set(hosts.values())))
+            .order_by('pk')
+        )
+        by_host = {}
+        for site in sites:
+            by_host.setdefault(site.hosts[0], site)
+        for site in sites:
+            for host in site.hosts[1:]:
+                by_host.setdefault(host, site)
+        return {url: by_host[host] for url, host in hosts.items() if host in by_host}
+
+    @classmethod
+    def start_new_versions(cls, changes, when=None):
+        """
+        End the current versions in `changes`, a dict mapping Sites to dicts of new field values, at `when` (default
+        now), and start new versions with the changes applied and the same tag set. Runs in one transaction with a
+        fixed number of bulk queries however many sites change. Returns the new versions.
+        """
+        when = when or datetime.now()
+        fields = [field for field in cls._meta.concrete_fields if not field.primary_key]
+        new_versions = []
+        for site, values in changes.items():
+            new_version = cls(**{field.attname: getattr(site, field.attname) for field in fields})
+            for name, value in values.items():
+                setattr(new_version, name, value)
+            new_version.active_start_date = when
+            new_version.active_end_date = None
+            new_versions.append(new_version)
+
+            # bulk_update doesn't call pre_save, so recompute the derived fields here
+            site.active_end_date = when
+            site.last_modified = when
+            cls._meta.get_field('valid_during').pre_save(site, False)
+
+        # The new versions share the old versions' tag sets, so there are no languages or geographies to copy
+        with transaction.atomic():
+            cls.objects.bulk_update(
+                list(changes), ['active_end_date', 'valid_during', 'last_modified'], batch_size=1000
+            )
+            cls.objects.bulk_create(new_versions, batch_size=1000)
+        return new_versions
+
     # Used for displaying values in admin view
     def get_languages(self):
-        return ", ".join(l.name for l in self.language.all())
+        return ", ".join(self.tag_set.languages) if self.tag_set_id else ""
     get_languages.short_description = "Languages"
 
     # Used for displaying values in admin view
     def get_geographies(self):
-        return ", ".join(g.name for g in self.geography.all())
+        return ", ".join(self.tag_set.geozones) if self.tag_set_id else ""
     get_geographies.short_description = "Geographies"
 
     class Meta:
         unique_together = ("url", "active_start_date")
         indexes = [
             models.Index(fields=["active_end_date"]),
+            GistIndex(fields=["valid_during"]),
+            GinIndex(fields=["hosts"], name="sites_site_current_hosts", condition=Q(active_end_date=None)),
         ]
 
 
-class SiteGeoZone(models.Model):
+class SiteCheck(models.Model):
     """
-    Junction table for a site and GeoZones.
+    When the scraper last checked a site, kept apart from the Site versions so that checking a site that hasn't
+    changed doesn't need a new version.
     """
-    site = models.ForeignKey('Site', on_delete=models.CASCADE)
-    geo_zone = models.ForeignKey('GeoZone', on_delete=models.CASCADE)
+    url = models.CharField(max_length=255, unique=True)
+    last_checked = models.DateTimeField()
 
-    def __str__(self):
-        return self.site.url + '---' + self.geo_zone.name
-
-
-class SiteLanguage(models.Model):
-    """
-    Junction table for a site and Languages.
-    """
-    site = models.ForeignKey('Site', on_delete=models.CASCADE)
-    language = models.ForeignKey('Language', on_delete=models.CASCADE)
-
-    def __str__(self):
-        return self.site.url + '---' + self.language.name
+    @classmethod
+    def touch(cls, urls, when=None):
+        """
+        Record that the sites with `urls` were checked at `when` (default now), in one upsert.
+        """
+        if not urls:
+            return
+        when = when or datetime.now()
+        with connection.cursor() as cursor:
+            execute_values(
+                cursor,
+                f"""
+                INSERT INTO {cls._meta.db_table} (url, last_checked) VALUES %s
+                ON CONFLICT (url) DO UPDATE SET last_checked = EXCLUDED.last_checked
+                """,
+                [(url, when) for url in sorted(set(urls))],
+                page_size=5000,
+            )
+
+
+# The notes of the SiteSummarySnapshots made by materialize_daily_summaries rather than imported
+AUTO_GENERATED_NOTES = "Auto-generated day summary"
 
 
 class SiteSummarySnapshot(models.Model):
@@ -145,28 +415,365 @@ class SiteSummarySnapshot(models.Model):
     num_courses = models.IntegerField()
     notes = models.TextField(blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["timestamp"]),
+        ]
+
     def __str__(self):
         return str(self.timestamp) + '---' + str(self.num_sites) + '---' + str(self.num_courses)
 
 
+class DailySummaryRun(models.Model):
+    """
+    When the materialize_daily_summaries command last brought the daily SiteSummarySnapshots up to date.
+    There is at most one row, which the command locks so that runs don't overlap.
+    """
+    last_run = models.DateTimeField(null=True)
+    # The earliest day changed since the last run in a way last_modified can't show, by deleting a version
+    changed_from = models.DateField(null=True)
+
+    @classmethod
+    def record_deletion(cls, instance):
+        """
+        Make the next run recompute the days from the start of the deleted Site or OverCount version.
+        """
+        # Postgres' LEAST ignores nulls
+        start = Value(instance.active_start_date.date(), output_field=models.DateField())
+        cls.objects.filter(pk=1).update(changed_from=Least('changed_from', start))
+
+
+@receiver(post_delete, sender=Site)
+@receiver(post_delete, sender=OverCount)
+def record_version_deletion(sender, instance, **kwargs):
+    DailySummaryRun.record_deletion(instance)
+
+
+class BulkJob(models.Model):
+    """
+    A bulk_update or bulk_create payload queued for the run_bulk_jobs command, which processes it a BulkJobChunk at
+    a time. The job is finished once none of its chunks are pending. A bulk_update payload's over-count is only
+    recorded once every chunk is done, so the OT chart never shows it against site counts the job hasn't updated.
+    """
+    UPDATE = 'update'
+    CREATE = 'create'
+    KIND_CHOICES = (
+        (UPDATE, 'bulk_update'),
+        (CREATE, 'bulk_create'),
+    )
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    num_sites = models.IntegerField()
+    created = models.DateTimeField(default=datetime.now)
+    finished = models.DateTimeField(null=True)
+    over_count = models.IntegerField(null=True)
+    # When the over-count was recorded with OverCount.set_latest
+    over_count_set = models.DateTimeField(null=True)
+
+    def finish_if_done(self):
+        with transaction.atomic():
+            # Lock the job first, so that of two workers finishing its last chunks at once, the later sees the other's
+            job = BulkJob.objects.select_for_update().get(pk=self.pk)
+            if self.chunks.filter(status=BulkJobChunk.PENDING).exists():
+                return
+            job.finished = datetime.now()
+            if (job.over_count is not None and job.over_count_set is None
+                    and not self.chunks.filter(status=BulkJobChunk.FAILED).exists()):
+                OverCount.set_latest(job.over_count)
+                job.over_count_set = job.finished
+            job.save(update_fields=['finished', 'over_count_set'])
+        self.finished = job.finished
+        self.over_count_set = job.over_count_set
+
+    def status(self):
+        """
+        The job's progress, and the results of its chunks so far: lists of urls or messages are concatenated and
+        counts are summed, in chunk order.
+        """
+        chunks = list(self.chunks.order_by('index'))
+        results = {}
+        for chunk in chunks:
+            for name, value in (chunk.results or {}).items():
+                results[name] = results.get(name, type(value)()) + value
+        failed = [chunk for chunk in chunks if chunk.status == BulkJobChunk.FAILED]
+        if self.finished is None:
+            state = 'pending' if all(chunk.status == BulkJobChunk.PENDING for chunk in chunks) else 'running'
+        else:
+            state = 'failed' if failed else 'done'
+        return {
+            'id': self.pk,
+            'kind': self.kind,
+            'status': state,
+            'created': self.created.isoformat(),
+            'finished': self.finished and self.finished.isoformat(),
+            'num_sites': self.num_sites,
+            'over_count': self.over_count,
+            'updated_over_count': self.over_count_set is not None,
+            'sites_done': sum(chunk.num_sites for chunk in chunks if chunk.status == BulkJobChunk.DONE),
+            'chunks': {
+                status: sum(chunk.status == status for chunk in chunks) for status, _ in BulkJobChunk.STATUS_CHOICES
+            },
+            'results': results,
+            'errors': [{'chunk': chunk.index, 'error': chunk.error} for chunk in failed],
+        }
+
+
+class BulkJobChunk(models.Model):
+    """
+    Part of a BulkJob's payload, processed in one transaction. A chunk whose processing raises an error is tried
+    again once retry_after has passed, up to a limit, and then marked as failed until it's retried by hand.
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    job = models.ForeignKey(BulkJob, on_delete=models.CASCADE, related_name='chunks')
+    index = models.IntegerField()
+    payload = models.JSONField()
+    num_sites = models.IntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    results = models.JSONField(null=True)
+    error = models.TextField(blank=True)
+    # When a chunk that raised an error may be tried again
+    retry_after = models.DateTimeField(null=True)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("job", "index")
+        indexes = [
+            models.Index(fields=["id"], name="sites_bulkjobchunk_pending", condition=Q(status='pending')),
+        ]
+
+
 # Models for referrer logs
 
+# Referrer domains that can't be Open edX sites we don't know about
+AWS_DOMAIN_SUFFIX = '.amazonaws.com'
+EDX_DOMAIN_SUFFIX = '.edx.org'
+IP_ADDRESS_DOMAIN = re.compile(r'^[0-9]+(?:\.[0-9]+){3}$')
+PORT_DOMAIN = re.compile(r':[0-9]+')
+
+# Subdomains that don't distinguish one site from another
+CHAFF_SUBDOMAINS = ('www', 'studio', 'staging', 'preview', 'stage', 'cms')
+
+
+def get_netloc(url):
+    """
+    Return domain of url if parseable
+    """
+    if '//' in url:
+        netloc = parse.urlparse(url).netloc
+    else:
+        netloc = url
+    return netloc.rstrip(".")
+
+
+def discoverable_domains_query(prefix=''):
+    """
+    Query for referrer Domains that could be Open edX sites: not blank, AWS or edX owned, an IP address, or on a
+    custom port. Use `prefix` to query through a relation, e.g. 'domain__'.
+    """
+    return ~Q(**{prefix + 'name': ''}) & Q(**{
+        prefix + 'is_ip_address': False,
+        prefix + 'has_port': False,
+        prefix + 'is_aws': False,
+        prefix + 'is_edx': False,
+    })
+
+
+class Domain(models.Model):
+    """
+    A referrer host seen in the logo access logs, classified once when it is first seen.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    netloc = models.CharField(max_length=255)
+    short_netloc = models.CharField(max_length=255)
+    is_ip_address = models.BooleanField(default=False)
+    has_port = models.BooleanField(default=False)
+    is_aws = models.BooleanField(default=False)
+    is_edx = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["id"], condition=discoverable_domains_query(), name="sites_domain_discoverable"),
+        ]
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def classify(cls, name):
+        """
+        An unsaved Domain for the host `name`, with its canonical and short forms and its classification.
+        """
+        netloc = get_netloc(name)
+        return cls(
+            name=name,
+            netloc=netloc,
+            short_netloc=".".join(part for part in netloc.split(".") if part not in CHAFF_SUBDOMAINS),
+            is_ip_address=bool(IP_ADDRESS_DOMAIN.match(name)),
+            has_port=bool(PORT_DOMAIN.search(name)),
+            is_aws=name.endswith(AWS_DOMAIN_SUFFIX),
+            is_edx=name.endswith(EDX_DOMAIN_SUFFIX),
+        )
+
+    @classmethod
+    def for_names(cls, names):
+        """
+        Return a dict mapping each host in `names` to its Domain, creating the ones we haven't seen before.
+        """
+        names = set(names)
+        domains = {domain.name: domain for domain in cls.objects.filter(name__in=names)}
+        missing = names - domains.keys()
+        if missing:
+            cls.objects.bulk_create([cls.classify(name) for name in missing], ignore_conflicts=True)
+            domains.update((domain.name, domain) for domain in cls.objects.filter(name__in=missing))
+        return domains
+
+    @property
+    def is_discoverable(self):
+        return bool(self.name) and not (self.is_ip_address or self.has_port or self.is_aws or self.is_edx)
+
+
 class AccessLogAggregate(models.Model):
     """
     A model representing an aggregate access log entry of S3 Open edX logo referrals.
     """
-    domain = models.CharField(max_length=255, null=True, blank=True, default=None)
+    domain = models.ForeignKey(Domain, on_delete=models.CASCADE, null=True, blank=True, default=None)
     access_date = models.DateField(null=True, blank=True, default=None)
-    filename = models.CharField(max_length=255, null=True, blank=True, default=None)
+    filename = models.CharField(max_length=255, null=True, blank=True, default=None, db_index=True)
     access_count = models.IntegerField(null=True, blank=True, default=None)
+    # HyperLogLog.to_bytes() of the client IPs of the counted lines
+    visitor_sketch = models.BinaryField(null=True, blank=True, default=None)
     create_dt = models.DateTimeField(default=datetime.now)
 
     class Meta:
         unique_together = ("domain", "access_date", "filename")
 
 
+class DomainDailyTraffic(models.Model):
+    """
+    Referrals per discoverable domain per day, summed over all log files. This is the rollup of AccessLogAggregate
+    that site discovery reads, kept up to date as log files are fetched. The visitor sketch is the merge of the
+    aggregates' sketches, so the unique visitors of any range of days can be estimated by merging its rows.
+    """
+    domain = models.ForeignKey(Domain, on_delete=models.CASCADE)
+    access_date = models.DateField()
+    access_count = models.IntegerField(default=0)
+    visitor_sketch = models.BinaryField(null=True, blank=True, default=None)
+
+    class Meta:
+        unique_together = ("domain", "access_date")
+        indexes = [
+            models.Index(fields=["access_date"]),
+        ]
+
+    @classmethod
+    def rebuild(cls, access_dates):
+        """
+        Recompute the totals for `access_dates` from the AccessLogAggregates, e.g. after log files are reprocessed.
+        """
+        with transaction.atomic():
+            cls.objects.filter(access_date__in=access_dates).delete()
+            aggregates = AccessLogAggregate.objects.filter(
+                discoverable_domains_query('domain__'), access_date__in=access_dates
+            )
+            totals = aggregates.values('domain', 'access_date').annotate(count=Sum('access_count')).order_by()
+            sketches = {}
+            for domain_id, access_date, sketch in aggregates.exclude(visitor_sketch=None).values_list(
+                'domain', 'access_date', 'visitor_sketch'
+            ).iterator():
+                sketches.setdefault((domain_id, access_date), HyperLogLog()).update(HyperLogLog.from_bytes(sketch))
+            cls.objects.bulk_create([
+                cls(
+                    domain_id=row['domain'], access_date=row['access_date'], access_count=row['count'],
+                    visitor_sketch=_sketch_bytes(sketches.get((row['domain'], row['access_date']))),
+                )
+                for row in totals
+            ], batch_size=5000)
+
+    @classmethod
+    def add_counts(cls, counts, visitors=None):
+        """
+        Add `counts`, a dict mapping (Domain, access_date) to a number of referrals, to the daily totals, and merge
+        `visitors`, a dict with the same keys mapping to HyperLogLogs of the client IPs, into the visitor sketches.
+        Undiscoverable domains are skipped. Dates may be date objects or YYYY-MM-DD strings.
+        """
+        totals = {}
+        sketches = {}
+        for (domain, access_date), count in counts.items():
+            if domain is not None and domain.is_discoverable:
+                sketch = (visitors or {}).get((domain, access_date))
+                if isinstance(access_date, str):
+                    access_date = date.fromisoformat(access_date)
+                totals[domain.pk, access_date] = totals.get((domain.pk, access_date), 0) + count
+                if sketch is not None:
+                    sketches.setdefault((domain.pk, access_date), HyperLogLog()).update(sketch)
+        if not totals:
+            return
+
+        with transaction.atomic():
+            if sketches:
+                # Sketches are merged here rather than in SQL, so lock the rows being merged into first
+                existing = cls.objects.select_for_update().filter(
+                    domain__in={domain_id for domain_id, _ in sketches},
+                    access_date__in={access_date for _, access_date in sketches},
+                ).exclude(visitor_sketch=None).order_by('domain', 'access_date')
+                for domain_id, access_date, sketch in existing.values_list('domain', 'access_date', 'visitor_sketch'):
+                    if (domain_id, access_date) in sketches:
+                        sketches[domain_id, access_date].update(HyperLogLog.from_bytes(sketch))
+
+            # One upsert rather than a read, bulk_update and bulk_create; rows are sorted so that concurrent runs lock
+            # them in the same order
+            with connection.cursor() as cursor:
+                execute_values(
+                    cursor,
+                    f"""
+                    INSERT INTO {cls._meta.db_table} (domain_id, access_date, access_count, visitor_sketch) VALUES %s
+                    ON CONFLICT (domain_id, access_date)
+                    DO UPDATE SET access_count = {cls._meta.db_table}.access_count + EXCLUDED.access_count,
+                    visitor_sketch = COALESCE(EXCLUDED.visitor_sketch, {cls._meta.db_table}.visitor_sketch)
+                    """,
+                    sorted(
+                        (domain_id, access_date, count, _sketch_bytes(sketches.get((domain_id, access_date))))
+                        for (domain_id, access_date), count in totals.items()
+                    ),
+                    page_size=5000,
+                )
+
+    @classmethod
+    def unique_visitors(cls, queryset):
+        """
+        Estimate the unique visitors per domain name over the rows of `queryset`, merging each domain's sketches.
+        """
+        sketches = {}
+        for name, sketch in queryset.exclude(visitor_sketch=None).values_list('domain__name', 'visitor_sketch') \
+                .iterator():
+            sketches.setdefault(name, HyperLogLog()).update(HyperLogLog.from_bytes(sketch))
+        return {name: sketch.estimate() for name, sketch in sketches.items()}
+
+
+def _sketch_bytes(sketch):
+    return None if sketch is None else sketch.to_bytes()
+
+
 class FilenameLog(models.Model):
     """
     A model representing a file name.
     """
     filename = models.CharField(max_length=255, unique=True)
+
+
+class LogListingMark(models.Model):
+    """
+    The last log key fetch_referrer_logs has finished with under a listing prefix (one per CloudFront distribution),
+    so later runs can list only the keys around and after it instead of the whole bucket.
+    """
+    prefix = models.CharField(max_length=255, unique=True)
+    last_key = models.CharField(max_length=1024)
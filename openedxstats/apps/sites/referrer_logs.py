@@ -0,0 +1,250 @@
+"""
+Reading CloudFront logo access logs and counting their referrers.
+
+Nothing here uses Django, so that the worker processes of fetch_referrer_logs --backfill can import it without
+setting Django up. Logs are read from a log source: the S3 bucket, a local directory laid out like the bucket (a key
+is a file's path relative to the directory), or files held in memory. Sources are picklable so they can be handed
+to worker processes.
+"""
+from abc import ABC, abstractmethod
+import collections
+import datetime
+import functools
+import gzip
+import io
+import os
+import re
+from urllib import parse
+
+import boto3
+
+from openedxstats.apps.sites.hyperloglog import HyperLogLog
+
+# Positions of the tab-separated CloudFront log fields we count by
+DATE_FIELD = 0
+CLIENT_IP_FIELD = 4
+REFERRER_FIELD = 9
+
+# CloudFront log keys are named <distribution id>.<YYYY-MM-DD-HH>.<unique id>.gz
+LOG_KEY_HOUR = re.compile(r'\.(\d{4}-\d{2}-\d{2}-\d{2})\.')
+
+
+@functools.lru_cache(maxsize=10000)
+def referrer_host(referrer):
+    """
+    The host part of a referrer url. The same few thousand referrers make up most of the log lines, so the results
+    are cached.
+    """
+    return parse.urlparse(referrer).netloc
+
+
+def count_log_lines(lines, log_name, visitors=None):
+    """
+    Count the `lines` of a log file per (host, date, log_name). `lines` can be any iterable of str, with or without
+    line endings, and is consumed one line at a time. Doesn't touch the database, so it's safe in a worker.
+
+    If `visitors` is given, the client IP of each line is also added to `visitors[host, date, log_name]`, so it
+    should be a defaultdict(HyperLogLog).
+    """
+    line_counter = collections.defaultdict(int)
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+
+        # Split only as far as the referrer, the last field we need
+        fields = line.split('\t', REFERRER_FIELD + 1)
+        line_key = (referrer_host(fields[REFERRER_FIELD]), fields[DATE_FIELD], log_name)
+        line_counter[line_key] += 1
+        if visitors is not None:
+            visitors[line_key].add(fields[CLIENT_IP_FIELD])
+    return line_counter
+
+
+def count_visitors(lines, log_name):
+    """
+    Count the `lines` of a log file with count_log_lines, returning the counts and the visitor sketches.
+    """
+    visitors = collections.defaultdict(HyperLogLog)
+    line_counter = count_log_lines(lines, log_name, visitors)
+    return line_counter, visitors
+
+
+def key_hour(key):
+    """
+    The hour a CloudFront log key covers, or None if `key` isn't named like one.
+    """
+    match = LOG_KEY_HOUR.search(key.rsplit('/', 1)[-1])
+    if match is None:
+        return None
+    return datetime.datetime.strptime(match.group(1), '%Y-%m-%d-%H')
+
+
+def read_lines(raw, key):
+    """
+    Yield the lines of the binary file object `raw`, decompressing it if `key` is gzipped.
+    """
+    if key.endswith(".gz"):
+        raw = gzip.GzipFile(None, 'rb', fileobj=raw)
+    yield from io.TextIOWrapper(raw, encoding='utf-8')
+
+
+class LogSource(ABC):
+    """
+    Somewhere to list and read log files from. Keys list in the order S3 would list them.
+    """
+
+    @abstractmethod
+    def list_keys(self, prefix="", start_after=None):
+        """
+        Yield the names of the readable keys starting with `prefix`, in order, after `start_after` if given.
+        """
+
+    @abstractmethod
+    def open_lines(self, key):
+        """
+        Yield the lines of the log file `key`, reading it a buffer at a time.
+        """
+
+    def listing_prefixes(self, prefix):
+        """
+        Return the prefixes under `prefix` whose keys list in time order: one per CloudFront distribution. If there
+        are keys that aren't named like CloudFront logs, the whole of `prefix` is listed in one go.
+        """
+        prefixes = set()
+        for key in self.list_keys(prefix):
+            # A "folder" object named after the prefix itself isn't a log
+            if key == prefix:
+                continue
+            distribution, dot, _ = key[len(prefix):].partition('.')
+            if not dot:
+                return [prefix]
+            prefixes.add(prefix + distribution + dot)
+        return sorted(prefixes)
+
+
+class S3LogSource(LogSource):
+    """
+    Log files in an S3 bucket. Keys in the Glacier storage class can't be read, so they aren't listed.
+    """
+
+    def __init__(self, bucket_name=None, bucket=None):
+        self.bucket_name = bucket.name if bucket is not None else bucket_name
+        self._bucket = bucket
+
+    def __getstate__(self):
+        # boto3 resources can't be pickled, so each process makes its own
+        return {'bucket_name': self.bucket_name, '_bucket': None}
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = boto3.resource("s3").Bucket(self.bucket_name)
+        return self._bucket
+
+    def list_keys(self, prefix="", start_after=None):
+        for key in self.bucket.objects.filter(Prefix=prefix, Marker=start_after or ''):
+            if key.storage_class != "GLACIER":
+                yield key.key
+
+    def open_lines(self, key):
+        # Read through the client rather than a bucket.Object, since clients can be shared between threads
+        body = self.bucket.meta.client.get_object(Bucket=self.bucket_name, Key=key)['Body']
+        try:
+            yield from read_lines(body, key)
+        finally:
+            body.close()
+
+    def listing_prefixes(self, prefix):
+        # Let S3 group the keys by distribution, rather than listing them all
+        prefixes = []
+        paginator = self.bucket.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, Delimiter='.'):
+            # A "folder" object named after the prefix itself isn't a log
+            if any(key['Key'] != prefix for key in page.get('Contents', [])):
+                return [prefix]
+            prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+        return prefixes
+
+
+class LocalLogSource(LogSource):
+    """
+    Log files in a local directory laid out like the bucket, e.g. archived logs.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def list_keys(self, prefix="", start_after=None):
+        keys = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), self.directory).replace(os.sep, '/')
+                if key.startswith(prefix) and (start_after is None or key > start_after):
+                    keys.append(key)
+        return iter(sorted(keys))
+
+    def open_lines(self, key):
+        with open(os.path.join(self.directory, *key.split('/')), 'rb') as raw:
+            yield from read_lines(raw, key)
+
+
+class MemoryLogSource(LogSource):
+    """
+    Log files held in memory, as a dict mapping keys to their (gzipped, if the key ends in .gz) contents.
+    """
+
+    def __init__(self, files=None):
+        self.files = dict(files or {})
+
+    @classmethod
+    def from_source(cls, source, prefix=""):
+        """
+        A copy of the files under `prefix` in another source, e.g. to time parsing without disk or network reads.
+        """
+        files = {}
+        for key in source.list_keys(prefix):
+            data = "".join(source.open_lines(key)).encode('utf-8')
+            files[key] = gzip.compress(data) if key.endswith(".gz") else data
+        return cls(files)
+
+    def list_keys(self, prefix="", start_after=None):
+        return iter(sorted(
+            key for key in self.files if key.startswith(prefix) and (start_after is None or key > start_after)
+        ))
+
+    def open_lines(self, key):
+        yield from read_lines(io.BytesIO(self.files[key]), key)
+
+
+def open_source(spec):
+    """
+    The log source described by `spec`: "s3:<bucket name>", "local:<directory>", or "memory:<directory>" to load a
+    directory's files into memory first.
+    """
+    kind, _, location = spec.partition(':')
+    if kind == "s3" and location:
+        return S3LogSource(location)
+    if kind == "local" and location:
+        return LocalLogSource(location)
+    if kind == "memory" and location:
+        return MemoryLogSource.from_source(LocalLogSource(location))
+    raise ValueError(f"Unknown log source {spec!r}: use s3:<bucket>, local:<directory> or memory:<directory>")
+
+
+# The log source of a backfill worker process, set up once per process by init_backfill_worker
+_worker_source = None
+
+
+def init_backfill_worker(source):
+    global _worker_source
+    _worker_source = source
+
+
+def count_backfill_key(key):
+    """
+    Count the lines of one log file in a backfill worker, returning the key, a plain dict of its counts and a dict
+    of its visitor sketches as bytes, which are more compact to send back than the sketches.
+    """
+    line_counter, visitors = count_visitors(_worker_source.open_lines(key), key)
+    return key, dict(line_counter), {line_key: sketch.to_bytes() for line_key, sketch in visitors.items()}
@@ -0,0 +1,47 @@
+import pickle
+
+from django.test import SimpleTestCase
+
+from openedxstats.apps.sites.hyperloglog import REGISTERS, HyperLogLog
+
+
+def sketch_of(values):
+    sketch = HyperLogLog()
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+class HyperLogLogTestCase(SimpleTestCase):
+    """
+    Tests for the unique visitor sketches kept by fetch_referrer_logs.
+    """
+
+    def test_small_sets_are_counted_exactly(self):
+        self.assertEqual(HyperLogLog().estimate(), 0)
+        self.assertEqual(sketch_of(["10.0.0.1"] * 100).estimate(), 1)
+        self.assertEqual(sketch_of(f"10.0.0.{i}" for i in range(20)).estimate(), 20)
+
+    def test_large_sets_are_estimated_within_a_few_percent(self):
+        for num_values in [5000, 200000]:
+            estimate = sketch_of(f"10.{i >> 16}.{(i >> 8) & 255}.{i & 255}" for i in range(num_values)).estimate()
+            self.assertAlmostEqual(estimate, num_values, delta=num_values * 0.1)
+
+    def test_merging_counts_the_union(self):
+        first = sketch_of(str(i) for i in range(3000))
+        second = sketch_of(str(i) for i in range(2000, 6000))
+        union = sketch_of(str(i) for i in range(6000))
+        self.assertEqual(HyperLogLog().update(first).update(second), union)
+        # Merging is order-independent and idempotent
+        self.assertEqual(HyperLogLog().update(second).update(first).update(second), union)
+
+    def test_round_trip_through_bytes(self):
+        for values in [[], ["10.0.0.1"], [str(i) for i in range(100)], [str(i) for i in range(100000)]]:
+            sketch = sketch_of(values)
+            data = sketch.to_bytes()
+            self.assertEqual(HyperLogLog.from_bytes(data), sketch)
+            self.assertEqual(HyperLogLog.from_bytes(memoryview(data)), sketch)
+            self.assertLessEqual(len(data), REGISTERS + 1)
+            self.assertEqual(pickle.loads(pickle.dumps(sketch)), sketch)
+        # Sparse sketches take a few bytes per visitor
+        self.assertEqual(len(sketch_of(["10.0.0.1"]).to_bytes()), 4)
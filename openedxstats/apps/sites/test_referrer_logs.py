@@ -0,0 +1,89 @@
+from datetime import datetime
+import gzip
+import os
+import pickle
+import tempfile
+
+from django.test import SimpleTestCase
+
+from openedxstats.apps.sites.referrer_logs import (
+    LocalLogSource, LogSource, MemoryLogSource, S3LogSource, key_hour, open_source,
+)
+
+LOG_FILES = {
+    "logs/EAAA.2020-01-01-00.a.gz": gzip.compress(b"#Version: 1.0\nline one\r\nline two"),
+    "logs/EAAA.2020-01-02-00.b.gz": gzip.compress(b"line three\n"),
+    "logs/EBBB.2020-01-01-12.c.gz": gzip.compress(b""),
+    "logs/notes.txt": b"plain text\n",
+    "other/EAAA.2020-01-01-00.d.gz": gzip.compress(b"elsewhere\n"),
+}
+
+
+class LogSourceTestCase(SimpleTestCase):
+    """
+    Tests for the local and in-memory log sources, which should behave like the bucket.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        for key, data in LOG_FILES.items():
+            path = os.path.join(self.directory.name, *key.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as log_file:
+                log_file.write(data)
+        self.sources = [LocalLogSource(self.directory.name), MemoryLogSource(LOG_FILES)]
+
+    def test_listing_keys(self):
+        for source in self.sources:
+            self.assertEqual(list(source.list_keys("logs/")), [
+                "logs/EAAA.2020-01-01-00.a.gz", "logs/EAAA.2020-01-02-00.b.gz", "logs/EBBB.2020-01-01-12.c.gz",
+                "logs/notes.txt",
+            ])
+            self.assertEqual(
+                list(source.list_keys("logs/EAAA.", start_after="logs/EAAA.2020-01-01-00.a.gz")),
+                ["logs/EAAA.2020-01-02-00.b.gz"],
+            )
+
+    def test_listing_prefixes_are_per_distribution(self):
+        for source in self.sources:
+            self.assertEqual(source.listing_prefixes("other/"), ["other/EAAA."])
+            # notes.txt is also split at its '.', as S3 would with the '.' delimiter
+            self.assertEqual(source.listing_prefixes("logs/"), ["logs/EAAA.", "logs/EBBB.", "logs/notes."])
+
+    def test_reading_lines(self):
+        for source in self.sources:
+            self.assertEqual(
+                list(source.open_lines("logs/EAAA.2020-01-01-00.a.gz")), ["#Version: 1.0\n", "line one\n", "line two"]
+            )
+            self.assertEqual(list(source.open_lines("logs/notes.txt")), ["plain text\n"])
+
+    def test_memory_copy_of_a_source(self):
+        source = MemoryLogSource.from_source(LocalLogSource(self.directory.name), "logs/")
+        self.assertEqual(len(source.files), 4)
+        self.assertEqual(list(source.open_lines("logs/EAAA.2020-01-02-00.b.gz")), ["line three\n"])
+
+    def test_opening_sources(self):
+        self.assertEqual(open_source("s3:openedx-logs").bucket_name, "openedx-logs")
+        self.assertEqual(open_source(f"local:{self.directory.name}").directory, self.directory.name)
+        self.assertEqual(len(open_source(f"memory:{self.directory.name}").files), len(LOG_FILES))
+        for spec in ["s3", "local:", "ftp:somewhere"]:
+            with self.assertRaises(ValueError):
+                open_source(spec)
+
+    def test_s3_source_pickles_without_its_bucket(self):
+        source = pickle.loads(pickle.dumps(S3LogSource("openedx-logs")))
+        self.assertEqual(source.bucket_name, "openedx-logs")
+        self.assertIsNone(source._bucket)
+
+    def test_incomplete_source_fails_when_made(self):
+        class ListingOnlySource(LogSource):
+            def list_keys(self, prefix="", start_after=None):
+                return iter([])
+
+        with self.assertRaises(TypeError):
+            ListingOnlySource()
+
+    def test_key_hour(self):
+        self.assertEqual(key_hour("logs/EAAA.2020-01-02-13.b.gz"), datetime(2020, 1, 2, 13))
+        self.assertIsNone(key_hour("logs/notes.txt"))
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+import random
+from unittest import mock, skipIf
+
+from django.test import SimpleTestCase
+
+from openedxstats.apps.sites import timeseries
+from openedxstats.apps.sites.timeseries import interval_sums
+
+
+def naive_interval_sums(days, intervals):
+    """
+    The obvious per-day scan, as a reference for the sweep line.
+    """
+    return [
+        sum(value or 0 for start, end, value in intervals if start <= day and (end is None or end >= day))
+        for day in days
+    ]
+
+
+class IntervalSumsTestCase(SimpleTestCase):
+    """
+    Tests for the sweep line interval totals, with and without NumPy.
+    """
+
+    def setUp(self):
+        start = datetime(2016, 1, 1, 23, 59, 59)
+        self.days = [start + timedelta(days=n) for n in range(30)]
+        rnd = random.Random(1234)
+        self.intervals = []
+        for _ in range(200):
+            begin = start + timedelta(days=rnd.randint(-10, 40), hours=rnd.randint(0, 23))
+            end = rnd.choice([None, begin + timedelta(days=rnd.randint(0, 20), hours=rnd.randint(0, 23))])
+            self.intervals.append((begin, end, rnd.choice([None, 0, 1, 17])))
+        # Boundaries landing exactly on a day are inclusive at both ends
+        self.intervals.append((self.days[3], self.days[5], 100))
+
+    def check_matches_naive(self):
+        self.assertEqual(interval_sums(self.days, self.intervals), naive_interval_sums(self.days, self.intervals))
+        self.assertEqual(interval_sums(self.days, []), [0] * len(self.days))
+        self.assertEqual(interval_sums([], self.intervals), [])
+
+    def test_pure_python(self):
+        with mock.patch.object(timeseries, 'numpy', None):
+            self.check_matches_naive()
+
+    @skipIf(timeseries.numpy is None, "NumPy is not installed")
+    def test_numpy(self):
+        self.check_matches_naive()
@@ -1,9 +1,14 @@
+import collections
+import csv
 import unittest
 from datetime import datetime, date, timedelta
 import gzip
 from io import StringIO
 import json
 import os.path
+import tempfile
+import tracemalloc
+from unittest import mock
 
 
 import boto3
@@ -12,19 +17,27 @@ from django.core.exceptions import FieldDoesNotExist
 from django.core.management import call_command
 from django.core.management.base import CommandError
 from django.core.serializers import serialize
+from django.db import transaction
+from django.db.models import Count, ProtectedError, Q, Sum
 from django.test import TestCase
 from django.urls import reverse
 from moto import mock_s3
 
 
 from openedxstats.apps.sites.forms import SiteForm, GeoZoneForm, LanguageForm
+from openedxstats.apps.sites.hyperloglog import HyperLogLog
+from openedxstats.apps.sites import bulk, referrer_logs
 from openedxstats.apps.sites.management.commands import fetch_referrer_logs
+from openedxstats.apps.sites.management.commands.check_site_versions import find_anomalies
+from openedxstats.apps.sites.management.commands.import_ot_data import import_data as import_data_ot
 from openedxstats.apps.sites.management.commands.import_sites import import_data
+from openedxstats.apps.sites.management.commands.materialize_daily_summaries import MODIFIED_MARGIN
 from openedxstats.apps.sites.models import (
-    Site, GeoZone, Language, SiteGeoZone, SiteLanguage, SiteSummarySnapshot,
-    FilenameLog, AccessLogAggregate
+    AUTO_GENERATED_NOTES, Site, SiteCheck, BulkJob, BulkJobChunk, DailySummaryRun, GeoZone, Language, SiteSummarySnapshot, TagSet, tag_set_digest,
+    FilenameLog, AccessLogAggregate, OverCount, DomainDailyTraffic, Domain, LogListingMark,
+    discoverable_domains_query,
 )
-from openedxstats.apps.sites.views import OTChartView
+from openedxstats.apps.sites.views import valid_sites_query
 
 
 BASE = os.path.dirname(os.path.abspath(__file__))
@@ -104,6 +117,63 @@ class ImportScriptTestCase(TestCase):
         self.assertEqual(Site.objects.filter(url='https://test3.com').count(), 2)
         self.assertEqual(Site.objects.count(), 6)
 
+        older = Site.objects.filter(url='https://test3.com').earliest('active_start_date')
+        self.assertEqual(older.active_end_date, datetime(2016, 4, 15, 0, 0))
+        self.assertEqual(older.valid_during.upper, datetime(2016, 4, 15, 0, 0))
+
+    def test_import_version_chains(self):
+        # The versions of each url are chained together however the rows are ordered
+        csvfile = StringIO(
+            "url,active_start_date,course_count,language\n"
+            "https://a.com,03/01/16,3,English\n"
+            "https://b.com,01/01/16,1,\"English,French\"\n"
+            "https://a.com,01/01/16,1,English\n"
+            "https://a.com,02/01/16,2,French\n"
+        )
+        self.assertIn("Number of site_languages created: 5\n", import_data(csvfile, chunk_size=2))
+        versions = Site.objects.filter(url='https://a.com').order_by('active_start_date')
+        self.assertEqual(
+            [(site.course_count, site.active_end_date) for site in versions],
+            [(1, datetime(2016, 2, 1)), (2, datetime(2016, 3, 1)), (3, None)],
+        )
+        self.assertEqual(Site.objects.get(url='https://b.com').active_end_date, None)
+
+    def test_import_sorts_large_files_in_runs(self):
+        rows = [(f"https://site{i % 7}.com", f"{i // 7 + 1:02d}/01/16", i) for i in range(70)]
+        rows.reverse()
+        csvfile = StringIO("url,active_start_date,course_count\n" + "".join("%s,%s,%s\n" % row for row in rows))
+        self.assertIn("Number of sites imported: 70\n", import_data(csvfile, chunk_size=4, run_size=8))
+        for i in range(7):
+            versions = Site.objects.filter(url=f"https://site{i}.com").order_by('active_start_date')
+            self.assertEqual([site.course_count for site in versions], list(range(i, 70, 7)))
+            self.assertEqual(
+                [site.active_end_date for site in versions],
+                [site.active_start_date for site in versions[1:]] + [None],
+            )
+
+    def test_import_queries_per_chunk(self):
+        def import_rows(num_rows, year, num_queries):
+            rows = "".join(
+                "https://site%s.com,01/01/%s,English,%s\n" % (i, year, "US" if i % 2 else "China")
+                for i in range(num_rows)
+            )
+            with self.assertNumQueries(num_queries):
+                import_data(StringIO("url,active_start_date,language,geography\n" + rows), chunk_size=1000)
+
+        import_rows(10, 16, 13)
+        # The second import has no new languages or geozones, but ends the first import's versions
+        import_rows(1000, 17, 8)
+        self.assertEqual(Site.objects.filter(active_end_date=datetime(2017, 1, 1)).count(), 10)
+        self.assertEqual(Site.objects.exclude(tag_set=None).count(), 1010)
+        # The sites share the two distinct sets of tags
+        self.assertEqual(TagSet.objects.count(), 2)
+
+    def test_import_duplicate_rows_imports_nothing(self):
+        csvfile = StringIO("url,active_start_date\nhttps://a.com,01/01/16\nhttps://a.com,01/01/16\n")
+        with self.assertRaises(CommandError):
+            import_data(csvfile)
+        self.assertEqual(Site.objects.count(), 0)
+
 
 class ImportOTDataTestCase(TestCase):
     """
@@ -116,6 +186,56 @@ class ImportOTDataTestCase(TestCase):
         call_command('import_ot_data', source)
         self.assertEqual(SiteSummarySnapshot.objects.count(), 3)
 
+    def test_import_into_non_empty_table_does_not_prompt(self):
+        source = os.path.join(BASE, "test_data/over_time_data.csv")
+
+        call_command('import_ot_data', source)
+        with mock.patch('builtins.input', side_effect=AssertionError("prompted")):
+            call_command('import_ot_data', source, stdout=StringIO())
+        self.assertEqual(SiteSummarySnapshot.objects.count(), 6)
+
+    def test_upsert(self):
+        source = os.path.join(BASE, "test_data/over_time_data.csv")
+        SiteSummarySnapshot.objects.create(
+            timestamp=datetime(2016, 6, 7), num_sites=1, num_courses=1, notes=AUTO_GENERATED_NOTES
+        )
+
+        call_command('import_ot_data', source, upsert=True)
+        out = StringIO()
+        call_command('import_ot_data', source, upsert=True, stdout=out)
+        self.assertIn("Number of snapshots created: 0\nNumber of snapshots updated: 0\n"
+                      "Number of snapshots unchanged: 3\n", out.getvalue())
+        self.assertEqual(SiteSummarySnapshot.objects.count(), 4)
+
+        csvfile = StringIO("when,sites,courses,reasons for discrepencies\n"
+                           "06/14/16,155,1500,recounted\n"
+                           "06/28/16,180,2100,\n"
+                           "06/28/16,190,2200,\n")
+        report = import_data_ot(csvfile, upsert=True, chunk_size=2)
+        self.assertIn("Number of snapshots created: 1\nNumber of snapshots updated: 2\n", report)
+        self.assertEqual(
+            list(SiteSummarySnapshot.objects.exclude(notes=AUTO_GENERATED_NOTES).order_by('timestamp')
+                 .values_list('timestamp', 'num_sites', 'notes')),
+            [
+                (datetime(2016, 6, 7), 100, ''),
+                (datetime(2016, 6, 14), 155, 'recounted'),
+                (datetime(2016, 6, 21), 175, ''),
+                (datetime(2016, 6, 28), 190, ''),
+            ],
+        )
+        # The auto-generated snapshot at the same time as an imported one is left alone
+        self.assertEqual(SiteSummarySnapshot.objects.get(notes=AUTO_GENERATED_NOTES).num_sites, 1)
+
+    def test_upsert_removes_duplicates(self):
+        source = os.path.join(BASE, "test_data/over_time_data.csv")
+
+        call_command('import_ot_data', source)
+        call_command('import_ot_data', source, stdout=StringIO())
+        out = StringIO()
+        call_command('import_ot_data', source, upsert=True, stdout=out)
+        self.assertIn("Number of duplicate snapshots deleted: 3\n", out.getvalue())
+        self.assertEqual(SiteSummarySnapshot.objects.count(), 3)
+
 
 class SubmitSiteFormTestCase(TestCase):
     """
@@ -255,8 +375,8 @@ class SubmitSiteFormTestCase(TestCase):
         self.assertEqual(saved_site.url, form_data['url'])
         self.assertEqual(saved_site.course_count, 1337)
         self.assertEqual(saved_site.active_start_date, datetime(2016, 3, 24, 0, 0))
-        self.assertCountEqual(saved_site.language.all(), [lang1, lang2])
-        self.assertCountEqual(saved_site.geography.all(), [geozone1, geozone2])
+        self.assertEqual(saved_site.tag_set.languages, [lang2.name, lang1.name])
+        self.assertEqual(saved_site.tag_set.geozones, [geozone1.name, geozone2.name])
         self.assertEqual(saved_site.course_type, form_data['course_type'])
 
         self.assertEqual(response.status_code, 302)
@@ -342,7 +462,7 @@ class SubmitSiteFormTestCase(TestCase):
     def test_page_is_accessible_url(self):
         """verify all page urls are working fine."""
         for urls in [
-            'sites:sites_list', 'sites:sites_list_json', 'sites:sites_map',
+            'sites:sites_list', 'sites:sites_list_json', 'sites:sites_list_json_v2', 'sites:sites_map',
             'sites:add_site',
             'sites:add_language', 'sites:add_geozone', 'login'
         ]:
@@ -362,16 +482,14 @@ class ModelsTestCase(TestCase):
         lang2 = Language(name="lang2")
         lang1.save()
         lang2.save()
-        sitelang1 = SiteLanguage(site_id=new_site.pk, language_id=lang1.pk)
-        sitelang2 = SiteLanguage(site_id=new_site.pk, language_id=lang2.pk)
-
-        sitelang1.save()
-        sitelang2.save()
+        self.assertEqual(new_site.get_languages(), "")
+        new_site.tag_set_id = TagSet.id_for([lang2.pk, lang1.pk], [])
+        new_site.save()
 
         # Renamed from assertItemsEqual in python 2
         self.assertCountEqual(new_site.get_languages(), "lang1, lang2")
         self.assertEqual(str(new_site), " --- ")
-        self.assertEqual(str(sitelang2), "---lang2")
+        self.assertEqual(str(new_site.tag_set), "lang1, lang2 --- ")
 
     def test_site_get_geographies_method_with_unicode(self):
         new_site = Site()
@@ -381,17 +499,233 @@ class ModelsTestCase(TestCase):
         geozone2 = GeoZone(name="\\u00e9")
         geozone1.save()
         geozone2.save()
-        sitegeozone1 = SiteGeoZone(site_id=new_site.pk, geo_zone_id=geozone1.pk)
-        sitegeozone2 = SiteGeoZone(site_id=new_site.pk, geo_zone_id=geozone2.pk)
-
-        sitegeozone1.save()
-        sitegeozone2.save()
+        new_site.tag_set_id = TagSet.id_for([], [geozone1.pk, geozone2.pk])
+        new_site.save()
 
         # Renamed from assertItemsEqual in python 2
         self.assertCountEqual(new_site.get_geographies(), "Greece, \\u00e9")
-        self.assertEqual(str(sitegeozone1), "https://www.κόσμε.co---Greece")
+        self.assertEqual(str(new_site.tag_set), " --- Greece, \\u00e9")
         self.assertEqual(str(geozone2), "\\u00e9")
 
+    def test_tag_sets_are_content_addressed(self):
+        for name in ['English', 'French', 'German']:
+            Language.objects.create(name=name)
+        GeoZone.objects.create(name='Canada')
+        first = TagSet.id_for(['French', 'English', 'French'], ['Canada'])
+        self.assertEqual(TagSet.id_for(['English', 'French'], ['Canada']), first)
+        self.assertNotEqual(TagSet.id_for(['English'], ['Canada']), first)
+        self.assertIsNone(TagSet.id_for([], []))
+        self.assertEqual(TagSet.objects.get(pk=first).languages, ['English', 'French'])
+
+        # An upsert, then for the new set, a lookup of its names and an insert of its links to them
+        with self.assertNumQueries(3):
+            ids = TagSet.ids_for([(['English'], ['Canada']), (['German'], []), (['German'], [])])
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(ids[tag_set_digest(['English'], ['Canada'])], TagSet.id_for(['English'], ['Canada']))
+        self.assertEqual(TagSet.objects.count(), 3)
+        with self.assertNumQueries(1):
+            TagSet.ids_for([(['English'], ['Canada']), (['German'], [])])
+        self.assertEqual(list(TagSet.objects.get(pk=first).language.values_list('name', flat=True)),
+                         ['English', 'French'])
+
+    def test_tag_sets_only_name_existing_languages_and_geozones(self):
+        Language.objects.create(name='English')
+        with self.assertRaisesMessage(ValueError, "No such languages or geozones: Atlantis, Klingon"):
+            with transaction.atomic():
+                TagSet.id_for(['English', 'Klingon'], ['Atlantis'])
+        self.assertFalse(TagSet.objects.exists())
+
+    def test_languages_in_use_cannot_be_deleted(self):
+        english = Language.objects.create(name='English')
+        french = Language.objects.create(name='French')
+        Site.objects.create(url='https://a.com', tag_set_id=TagSet.id_for(['English'], []))
+        with self.assertRaises(ProtectedError):
+            english.delete()
+        french.delete()
+        self.assertEqual(list(Language.objects.values_list('name', flat=True)), ['English'])
+
+    def test_site_as_of(self):
+        old = Site.objects.create(url='https://a.com', active_start_date='2016-01-01',
+                                  active_end_date='2017-01-01 12:00')
+        new = Site.objects.create(url='https://a.com', active_start_date='2017-01-01 12:00')
+        Site.objects.create(url='https://b.com', active_start_date=datetime(2018, 1, 1))
+
+        self.assertCountEqual(Site.objects.as_of(datetime(2015, 1, 1)), [])
+        self.assertCountEqual(Site.objects.as_of(datetime(2016, 6, 1)), [old])
+        # Both ends are inclusive, as with active_start_date__lte and active_end_date__gte
+        self.assertCountEqual(Site.objects.as_of(datetime(2017, 1, 1, 12, 0)), [old, new])
+        self.assertCountEqual(Site.objects.as_of(datetime(2019, 1, 1)).values_list('url', flat=True),
+                              ['https://a.com', 'https://b.com'])
+
+    def test_valid_during_follows_end_date_on_save(self):
+        site = Site.objects.create(url='https://a.com', active_start_date=datetime(2016, 1, 1))
+        self.assertEqual(Site.objects.as_of(datetime(2020, 1, 1)).count(), 1)
+        site.active_end_date = datetime(2017, 1, 1)
+        site.save()
+        self.assertEqual(Site.objects.as_of(datetime(2020, 1, 1)).count(), 0)
+        self.assertEqual(Site.objects.as_of(datetime(2016, 6, 1)).count(), 1)
+
+    def test_inverted_version_has_no_range(self):
+        # Left for check_site_versions to report rather than failing the save
+        site = Site.objects.create(url='https://a.com', active_start_date=datetime(2017, 1, 1),
+                                   active_end_date=datetime(2016, 1, 1))
+        site.refresh_from_db()
+        self.assertIsNone(site.valid_during)
+        self.assertEqual(Site.objects.as_of(datetime(2016, 6, 1)).count(), 0)
+
+    def test_over_count_as_of(self):
+        first = OverCount.objects.create(course_count=3, active_start_date=datetime(2016, 1, 1),
+                                         active_end_date=datetime(2017, 1, 1))
+        OverCount.objects.create(course_count=5, active_start_date=datetime(2017, 1, 1))
+        self.assertEqual(list(OverCount.objects.as_of(datetime(2016, 6, 1))), [first])
+        self.assertEqual(OverCount.objects.as_of(datetime(2018, 1, 1)).get().course_count, 5)
+
+
+class SiteJSONTestCase(TestCase):
+    """
+    Tests for the sites list JSON endpoints.
+    """
+
+    def setUp(self):
+        User.objects.create_user('testuser', 'testuser@edx.com', 'password')
+        self.client.login(username='testuser', password='password')
+        self.english = Language.objects.create(name='English')
+        self.french = Language.objects.create(name='French')
+        self.canada = GeoZone.objects.create(name='Canada')
+
+    def make_site(self, url, geozones=('Canada',), **kwargs):
+        tag_set_id = TagSet.id_for(['French', 'English'], list(geozones))
+        return Site.objects.create(url=url, name=url, tag_set_id=tag_set_id, **kwargs)
+
+    def get_sites(self, query=''):
+        response = self.client.get(reverse('sites:sites_list_json_v2') + query)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b''.join(response.streaming_content).decode())['sites']
+
+    def test_v2_rows_are_flat_with_tags_inlined(self):
+        site = self.make_site('https://a.com', course_count=3)
+        Site.objects.create(url='https://b.com', course_count=5)
+
+        sites = self.get_sites()
+
+        self.assertEqual([s['url'] for s in sites], ['https://a.com', 'https://b.com'])
+        self.assertEqual(sites[0]['id'], site.pk)
+        self.assertEqual(sites[0]['languages'], ['English', 'French'])
+        self.assertEqual(sites[0]['geographies'], ['Canada'])
+        self.assertEqual(sites[1]['languages'], [])
+        self.assertEqual(sites[1]['geographies'], [])
+
+    def test_v2_current_only_unless_all(self):
+        self.make_site('https://old.com', course_count=3, active_start_date=datetime(2016, 1, 1),
+                       active_end_date=datetime(2017, 1, 1))
+        self.make_site('https://new.com', course_count=3)
+        self.make_site('https://empty.com', course_count=0)
+
+        self.assertEqual([s['url'] for s in self.get_sites()], ['https://new.com'])
+        self.assertEqual(len(self.get_sites('?all=1')), 3)
+
+    def test_v2_query_count_is_constant(self):
+        for i in range(20):
+            self.make_site(f'https://site{i}.com', course_count=i + 1)
+        # One query for the session, one for the user, one for the sites.
+        with self.assertNumQueries(3):
+            self.assertEqual(len(self.get_sites('?all=1')), 20)
+
+    def test_v2_as_of(self):
+        self.make_site('https://a.com', course_count=3, active_start_date=datetime(2016, 1, 1),
+                       active_end_date=datetime(2017, 1, 1))
+        self.make_site('https://a.com', course_count=0, active_start_date=datetime(2017, 1, 1))
+        self.make_site('https://b.com', course_count=3, active_start_date=datetime(2016, 6, 1))
+
+        self.assertEqual([s['url'] for s in self.get_sites('?as_of=2016-03-01')], ['https://a.com'])
+        self.assertEqual([s['url'] for s in self.get_sites('?as_of=2016-12-31 23:00')],
+                         ['https://a.com', 'https://b.com'])
+        # Versions with no courses are only listed with all=1
+        self.assertEqual([s['url'] for s in self.get_sites('?as_of=2018-01-01')], ['https://b.com'])
+        self.assertEqual([s['course_count'] for s in self.get_sites('?as_of=2018-01-01&all=1')], [0, 3])
+
+    def test_as_of_must_be_a_date(self):
+        for url in ('sites:sites_list_json', 'sites:sites_list_json_v2', 'sites:sites_stats', 'sites:sites_csv'):
+            response = self.client.get(reverse(url) + '?as_of=yesterday')
+            self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('sites:sites_stats') + '?as_of=2016-02-30')
+        self.assertEqual(response.status_code, 400)
+
+    def test_stats_and_csv_as_of(self):
+        self.make_site('https://a.com', course_count=3, active_start_date=datetime(2016, 1, 1),
+                       active_end_date=datetime(2017, 1, 1))
+        self.make_site('https://a.com', course_count=10, active_start_date=datetime(2017, 1, 1))
+        OverCount.objects.create(course_count=1, active_start_date=datetime(2016, 1, 1),
+                                 active_end_date=datetime(2017, 1, 1))
+        OverCount.objects.create(course_count=2, active_start_date=datetime(2017, 1, 1))
+
+        response = self.client.get(reverse('sites:sites_stats') + '?as_of=2016-06-01')
+        self.assertEqual((response.context['sites'], response.context['courses']), (1, 2))
+        response = self.client.get(reverse('sites:sites_stats'))
+        self.assertEqual((response.context['sites'], response.context['courses']), (1, 8))
+
+        rows = self.get_csv('?as_of=2016-06-01')
+        self.assertEqual([(row['url'], row['course_count']) for row in rows], [('https://a.com', '3')])
+
+    def get_csv(self, query=''):
+        response = self.client.get(reverse('sites:sites_csv') + query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="sites.csv"')
+        return list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+
+    def test_csv_columns(self):
+        self.make_site('https://a.com', course_count=3, active_start_date=datetime(2017, 1, 1, 12, 0, 0, 5000))
+        Site.objects.create(url='https://b.com', name='B', is_private_instance=True)
+        self.make_site('https://gone.com', course_count=3, is_gone=True)
+
+        rows = self.get_csv()
+        self.assertEqual([row['url'] for row in rows], ['https://a.com', 'https://b.com'])
+        self.assertEqual(rows[0], {
+            'name': 'https://a.com', 'url': 'https://a.com', 'course_count': '3', 'languages': 'English, French',
+            'geographies': 'Canada', 'updated': '2017-01-01 12:00:00',
+        })
+        self.assertEqual((rows[1]['course_count'], rows[1]['languages'], rows[1]['geographies']), ('', '', ''))
+
+        rows = self.get_csv('?include_gone=1&skip_lang_geo=1')
+        self.assertEqual(list(rows[0]), ['name', 'url', 'course_count', 'is_private_instance', 'is_gone', 'updated'])
+        self.assertEqual([(row['url'], row['is_gone']) for row in rows],
+                         [('https://a.com', 'False'), ('https://b.com', 'False'), ('https://gone.com', 'True')])
+
+    def test_csv_query_count_is_constant(self):
+        for num_sites in (1, 25):
+            for i in range(num_sites):
+                self.make_site(f'https://site{num_sites}-{i}.com', course_count=1)
+            # One query for the session, one for the user, one for the sites and their tags.
+            with self.assertNumQueries(3):
+                rows = self.get_csv()
+            self.assertEqual(len(rows), Site.objects.count())
+
+    def get_geo_counts(self):
+        response = self.client.get(reverse('sites:sites_geo_counts_json'))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())['activeSitesCount']
+
+    def test_geo_counts(self):
+        france = GeoZone.objects.create(name='France')
+        self.make_site('https://a.com', course_count=3)
+        self.make_site('https://b.com', course_count=None)
+        self.make_site('https://empty.com', course_count=0)
+        self.make_site('https://old.com', course_count=3, active_start_date=datetime(2016, 1, 1),
+                       active_end_date=datetime(2017, 1, 1), geozones=('Canada', france.name))
+
+        self.assertEqual(self.get_geo_counts(), {'Canada': 2, 'France': 0})
+        response = self.client.get(reverse('sites:sites_list_json') + '?active_counts=1')
+        self.assertEqual(json.loads(response.content.decode())['activeSitesCount'], {'Canada': 2, 'France': 0})
+
+    def test_geo_counts_query_count_is_constant(self):
+        for num_sites in (1, 25):
+            for i in range(num_sites):
+                self.make_site(f'https://site{num_sites}-{i}.com', course_count=1)
+            # One query for the session, one for the user, one for the counts.
+            with self.assertNumQueries(3):
+                counts = self.get_geo_counts()
+            self.assertEqual(counts, {'Canada': Site.objects.count()})
+
 
 class OTChartTestCase(TestCase):
     """
@@ -410,23 +744,14 @@ class OTChartTestCase(TestCase):
         self.assertEqual(response.content.decode(), json.dumps([]))
 
     def test_json_data_returned_after_ajax_call(self):
-        snapshot_list = []
         snapshot = SiteSummarySnapshot(
             timestamp=datetime(2016, 7, 1, 0, 0, 0),
             num_sites=100,
             num_courses=1000,
             notes="test"
         )
-        snapshot_list.append(snapshot)
         snapshot.save()
-        for date in OTChartView.daterange(OTChartView(), snapshot.timestamp, datetime.now() + timedelta(days=1)):
-            empty_snapshot = SiteSummarySnapshot(
-                timestamp=date,
-                num_sites=0,
-                num_courses=None,
-                notes="Auto-generated day summary"
-            )
-            snapshot_list.append(empty_snapshot)
+        Site.objects.create(url='https://test.com', course_count=3)
 
         # Ajax request
         response = self.client.post(
@@ -436,8 +761,215 @@ class OTChartTestCase(TestCase):
         expected_json = json.loads(serialize('json', [snapshot]))
         response_json = json.loads(response.content.decode())
 
-        for i, item in enumerate(expected_json):
-            self.assertEqual(expected_json[i], response_json[i])
+        self.assertEqual(expected_json, response_json)
+        # Daily summaries are made by materialize_daily_summaries, not by viewing the chart
+        self.assertEqual(SiteSummarySnapshot.objects.count(), 1)
+
+    def test_date_range(self):
+        for day in range(1, 5):
+            SiteSummarySnapshot.objects.create(timestamp=datetime(2016, 7, day), num_sites=day, num_courses=day)
+
+        response = self.client.post('/sites/ot_chart/', {'start_date': '2016-07-02', 'end_date': '2016-07-03'})
+        response_json = json.loads(response.content.decode())
+        self.assertEqual([s['fields']['num_sites'] for s in response_json], [2, 3])
+
+
+class MaterializeDailySummariesTestCase(TestCase):
+    """
+    Tests for the materialize_daily_summaries management command.
+    """
+
+    def setUp(self):
+        self.today = date.today()
+        self.start = datetime.combine(self.today, datetime.min.time()) - timedelta(days=10)
+        SiteSummarySnapshot.objects.create(timestamp=self.start - timedelta(days=1), num_sites=1, num_courses=1)
+
+    def per_day_queries(self):
+        """
+        The totals the OT chart used to compute with two queries per day.
+        """
+        expected = []
+        for n in range(11):
+            day = self.start + timedelta(days=n + 1, seconds=-1)
+            date_select = Q(active_start_date__lte=day) & (Q(active_end_date__gte=day) | Q(active_end_date=None))
+            day_stats = Site.objects.filter(valid_sites_query() & date_select).aggregate(
+                sites=Count('*'), courses=Sum('course_count')
+            )
+            try:
+                over_count = OverCount.objects.get(date_select).course_count
+            except OverCount.DoesNotExist:
+                over_count = 0
+            expected.append((day, day_stats['sites'], (day_stats['courses'] or 0) - over_count))
+        return expected
+
+    def daily_summaries(self):
+        return list(SiteSummarySnapshot.objects.filter(notes="Auto-generated day summary").order_by(
+            'timestamp'
+        ).values_list('timestamp', 'num_sites', 'num_courses'))
+
+    def materialize(self, *args):
+        out = StringIO()
+        call_command('materialize_daily_summaries', *args, stdout=out)
+        return out.getvalue().strip()
+
+    def test_matches_per_day_queries(self):
+        start = self.start
+        Site.objects.create(url='https://a.com', course_count=5, active_start_date=start - timedelta(days=30),
+                            active_end_date=start + timedelta(days=3, hours=5))
+        Site.objects.create(url='https://a.com', course_count=8, active_start_date=start + timedelta(days=3, hours=5))
+        Site.objects.create(url='https://b.com', course_count=None, is_private_instance=True,
+                            active_start_date=start + timedelta(days=1, seconds=-1))
+        Site.objects.create(url='https://c.com', course_count=0, active_start_date=start)
+        Site.objects.create(url='https://d.com', course_count=4, is_gone=True, active_start_date=start)
+        Site.objects.create(url='https://e.com', course_count=2, active_start_date=start + timedelta(days=6),
+                            active_end_date=start + timedelta(days=6, hours=1))
+        OverCount.objects.create(course_count=1, active_start_date=start - timedelta(days=100),
+                                 active_end_date=start + timedelta(days=5))
+        OverCount.objects.create(course_count=2, active_start_date=start + timedelta(days=5))
+
+        self.assertEqual(self.materialize(), "Days computed: 11, created: 11, updated: 0, deleted: 0")
+        self.assertEqual(self.daily_summaries(), self.per_day_queries())
+
+    def test_rerun_is_idempotent_and_incremental(self):
+        site = Site.objects.create(url='https://a.com', course_count=5, active_start_date=self.start)
+        Site.objects.update(last_modified=datetime.now() - MODIFIED_MARGIN - timedelta(minutes=1))
+        self.materialize()
+        before = self.daily_summaries()
+
+        # Nothing changed, so only today is recomputed, and nothing is written
+        self.assertEqual(self.materialize(), "Days computed: 1, created: 0, updated: 0, deleted: 0")
+        self.assertEqual(self.daily_summaries(), before)
+
+        # Ending the old version recomputes every day since it started, but only days from the new version change
+        site.active_end_date = self.start + timedelta(days=6)
+        site.save()
+        Site.objects.create(url='https://a.com', course_count=7, active_start_date=self.start + timedelta(days=6))
+        self.assertEqual(self.materialize(), "Days computed: 11, created: 0, updated: 5, deleted: 0")
+        self.assertEqual(self.daily_summaries(), self.per_day_queries())
+
+    def test_rows_committed_after_a_run_that_were_stamped_before_it(self):
+        self.materialize()
+        last_run = DailySummaryRun.objects.get().last_run
+        # As if saved in a transaction still open when the last run read the sites
+        Site.objects.create(url='https://a.com', course_count=5, active_start_date=self.start)
+        Site.objects.update(last_modified=last_run - timedelta(minutes=5))
+        self.assertEqual(self.materialize(), "Days computed: 11, created: 0, updated: 11, deleted: 0")
+        self.assertEqual(self.daily_summaries(), self.per_day_queries())
+
+    def test_deleted_versions_are_recomputed(self):
+        Site.objects.create(url='https://a.com', course_count=5, active_start_date=self.start)
+        deleted = Site.objects.create(url='https://b.com', course_count=3,
+                                      active_start_date=self.start + timedelta(days=4))
+        Site.objects.update(last_modified=datetime.now() - MODIFIED_MARGIN - timedelta(minutes=1))
+        self.materialize()
+
+        User.objects.create_user('testuser', 'testuser@edx.com', 'password')
+        self.client.login(username='testuser', password='password')
+        self.client.post(reverse('sites:delete_site', args=[deleted.pk]))
+        self.assertEqual(DailySummaryRun.objects.get().changed_from, (self.start + timedelta(days=4)).date())
+        self.assertEqual(self.materialize(), "Days computed: 7, created: 0, updated: 7, deleted: 0")
+        self.assertEqual(self.daily_summaries(), self.per_day_queries())
+        self.assertIsNone(DailySummaryRun.objects.get().changed_from)
+
+    def test_cleans_up_duplicate_and_future_rows(self):
+        Site.objects.create(url='https://a.com', course_count=5, active_start_date=self.start)
+        for timestamp in (self.start + timedelta(hours=3), self.start + timedelta(hours=4),
+                          self.start + timedelta(days=20)):
+            SiteSummarySnapshot.objects.create(
+                timestamp=timestamp, num_sites=0, num_courses=0, notes="Auto-generated day summary"
+            )
+
+        self.assertEqual(self.materialize(), "Days computed: 11, created: 10, updated: 1, deleted: 2")
+        self.assertEqual(self.daily_summaries(), self.per_day_queries())
+
+    def test_no_sites_or_snapshots(self):
+        SiteSummarySnapshot.objects.all().delete()
+        self.assertEqual(self.materialize(), "Days computed: 0, created: 0, updated: 0, deleted: 0")
+
+
+class CheckSiteVersionsTestCase(TestCase):
+    """
+    Tests for the check_site_versions management command.
+    """
+
+    def setUp(self):
+        jan, feb, mar, apr = (datetime(2020, month, 1) for month in range(1, 5))
+        Language.objects.create(name='English')
+        GeoZone.objects.create(name='US')
+
+        # Two current versions
+        Site.objects.create(url='https://a.com', active_start_date=jan)
+        Site.objects.create(url='https://a.com', active_start_date=feb)
+        # Overlapping versions
+        Site.objects.create(url='https://b.com', active_start_date=jan, active_end_date=mar)
+        Site.objects.create(url='https://b.com', active_start_date=feb)
+        # The later versions lost their languages and geographies
+        Site.objects.create(url='https://c.com', active_start_date=jan, active_end_date=feb,
+                            tag_set_id=TagSet.id_for(['English'], ['US']))
+        Site.objects.create(url='https://c.com', active_start_date=feb, active_end_date=mar)
+        Site.objects.create(url='https://c.com', active_start_date=mar)
+        # A stale validity range, and a version that never had languages
+        d = Site.objects.create(url='https://d.com', active_start_date=jan)
+        Site.objects.filter(pk=d.pk).update(active_end_date=apr)
+        # An older version imported after the latest one, which was ended when the older one started
+        Site.objects.create(url='https://e.com', active_start_date=feb)
+        Site.objects.create(url='https://e.com', active_start_date=mar, active_end_date=feb)
+        # A version in the middle of the chain that ends before it starts
+        Site.objects.create(url='https://f.com', active_start_date=jan, active_end_date=feb)
+        Site.objects.create(url='https://f.com', active_start_date=feb, active_end_date=jan)
+        Site.objects.create(url='https://f.com', active_start_date=mar)
+
+    def test_check_and_repair(self):
+        with self.assertNumQueries(3):
+            anomalies = find_anomalies()
+        self.assertEqual(
+            {name: sorted(url for url, _ in versions) for name, versions in anomalies.items()},
+            {
+                "several_current": ['https://a.com', 'https://e.com'],
+                "overlapping": ['https://b.com'],
+                "inverted": ['https://e.com', 'https://f.com'],
+                "stale_range": ['https://d.com'],
+                "lost_tags": ['https://c.com', 'https://c.com'],
+            },
+        )
+
+        out = StringIO()
+        call_command('check_site_versions', stdout=out)
+        self.assertIn("Several current: 2 versions of 2 urls\n    https://a.com\n    https://e.com\n", out.getvalue())
+        self.assertNotIn("Repaired", out.getvalue())
+
+        # Languages and geographies may have been cleared on purpose, so --repair leaves them alone
+        out = StringIO()
+        call_command('check_site_versions', repair=True, stdout=out)
+        self.assertIn("Repaired: 3 versions ended, 2 inverted versions re-chained, 1 validity ranges recomputed\n",
+                      out.getvalue())
+        self.assertNotIn("restored", out.getvalue())
+        self.assertEqual({name: len(versions) for name, versions in find_anomalies().items() if versions},
+                         {"lost_tags": 2})
+
+        out = StringIO()
+        call_command('check_site_versions', repair_tags=True, stdout=out)
+        self.assertIn("Repaired: 2 versions' languages and geographies restored", out.getvalue())
+
+        self.assertEqual({name: versions for name, versions in find_anomalies().items() if versions}, {})
+        self.assertEqual(Site.objects.filter(active_end_date=None).count(), 5)
+        for site in Site.objects.all():
+            self.assertEqual((site.valid_during.lower, site.valid_during.upper),
+                             (site.active_start_date, site.active_end_date))
+        self.assertEqual(
+            Site.objects.get(url='https://b.com', active_end_date__isnull=False).active_end_date,
+            datetime(2020, 2, 1),
+        )
+        self.assertEqual(
+            [site.get_languages() for site in Site.objects.filter(url='https://c.com')], ['English'] * 3
+        )
+        self.assertEqual(Site.objects.as_of(datetime(2020, 3, 15)).filter(url='https://d.com').count(), 1)
+        self.assertEqual(
+            list(Site.objects.filter(url='https://f.com').order_by('active_start_date').values_list(
+                'active_end_date', flat=True
+            )),
+            [datetime(2020, 2, 1), datetime(2020, 3, 1), None],
+        )
 
 
 class UpdateSiteTestCase(TestCase):
@@ -475,6 +1007,24 @@ class UpdateSiteTestCase(TestCase):
         self.assertEqual(updated_site.active_start_date, old_site.active_end_date)
         self.assertIsNone(updated_site.active_end_date)
 
+    def test_update_form_shows_and_keeps_tags(self):
+        Language.objects.create(name='English')
+        GeoZone.objects.create(name='US')
+        site = Site.objects.create(name='TEST', url='https://test.com', active_start_date=datetime(2015, 10, 10),
+                                   tag_set_id=TagSet.id_for(['English'], ['US']))
+
+        response = self.client.get('/sites/update_site/' + str(site.pk) + '/')
+        self.assertEqual(response.context['form'].initial['language'], ['English'])
+        self.assertEqual(response.context['form'].initial['geography'], ['US'])
+
+        self.client.post('/sites/update_site/' + str(site.pk) + '/', {
+            'name': 'TEST', 'site_type': 'General', 'url': 'https://test.com', 'active_start_date': datetime.now(),
+            'language': ['English'], 'geography': ['US'],
+        })
+        updated_site = Site.objects.get(url='https://test.com', active_end_date=None)
+        self.assertEqual(updated_site.tag_set_id, site.tag_set_id)
+        self.assertEqual(TagSet.objects.count(), 1)
+
     def test_updating_with_valid_changes(self):
         new_site = Site(
             name='TEST', url='https://test.com',
@@ -561,6 +1111,565 @@ class UpdateSiteTestCase(TestCase):
         self.assertEqual(response.status_code, 404)
 
 
+class BulkUpdateTestCase(TestCase):
+    """
+    Tests for the bulk_update endpoint the scraper posts course counts to.
+    """
+
+    def setUp(self):
+        User.objects.create_user('testuser', 'testuser@edx.com', 'password')
+        self.client.login(username='testuser', password='password')
+        self.english = Language.objects.create(name='English')
+        self.canada = GeoZone.objects.create(name='Canada')
+
+    def make_site(self, url, **kwargs):
+        tag_set_id = TagSet.id_for([self.english.name], [self.canada.name])
+        return Site.objects.create(url=url, name=url, active_start_date=datetime(2020, 1, 1), tag_set_id=tag_set_id,
+                                   **kwargs)
+
+    def post_updates(self, sites, **payload):
+        response = self.client.post(
+            '/sites/bulk_update/', json.dumps({'sites': sites, **payload}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def test_sites_are_matched_by_normalized_url_or_alias(self):
+        self.make_site('https://courses.a.com/', course_count=1)
+        self.make_site('https://b.com', aliases=['https://learn.b.com'], course_count=2)
+        self.make_site('https://nota.com', course_count=3)
+        self.assertEqual(Site.objects.get(url='https://b.com').hosts, ['b.com', 'learn.b.com'])
+
+        resp = self.post_updates({
+            'HTTPS://Courses.A.com': {'course_count': 10, 'is_gone': False},
+            'learn.b.com/': {'course_count': 20, 'is_gone': True},
+            'a.com': {'course_count': 30, 'is_gone': False},
+        }, overcount=4)
+
+        self.assertEqual(resp, {
+            'updated': ['HTTPS://Courses.A.com', 'learn.b.com/'], 'unchanged': [], 'not_found': ['a.com'],
+            'updated_over_count': True,
+        })
+        current = {site.url: site for site in Site.objects.filter(active_end_date=None)}
+        self.assertEqual(current['https://courses.a.com/'].course_count, 10)
+        self.assertTrue(current['https://b.com'].is_gone)
+        self.assertEqual(current['https://b.com'].aliases, ['https://learn.b.com'])
+        self.assertEqual(current['https://nota.com'].course_count, 3)
+        self.assertEqual(OverCount.objects.get(active_end_date=None).course_count, 4)
+
+        # The old versions end when the new ones start, and the new ones keep their languages and geographies
+        old = Site.objects.get(url='https://b.com', course_count=2)
+        new = current['https://b.com']
+        self.assertEqual(old.active_end_date, new.active_start_date)
+        self.assertEqual(Site.objects.as_of(old.active_end_date - timedelta(seconds=1)).get(url='https://b.com'), old)
+        self.assertGreaterEqual(old.last_modified, old.active_end_date)
+        self.assertEqual(new.get_languages(), 'English')
+        self.assertEqual(new.get_geographies(), 'Canada')
+
+    def test_unchanged_sites_get_no_new_version(self):
+        self.make_site('https://a.com', course_count=5)
+        self.make_site('https://b.com', course_count=7, is_gone=True)
+
+        resp = self.post_updates({
+            'a.com': {'course_count': 5, 'is_gone': False},
+            'b.com': {'course_count': 7, 'is_gone': False},
+        })
+        self.assertEqual(resp['updated'], ['b.com'])
+        self.assertEqual(resp['unchanged'], ['a.com'])
+        self.assertEqual(Site.objects.filter(url='https://a.com').count(), 1)
+        self.assertEqual(Site.objects.filter(url='https://b.com').count(), 2)
+        self.assertEqual(Site.objects.filter(tag_set__languages=['English']).count(), 3)
+        first_check = SiteCheck.objects.get(url='https://a.com').last_checked
+
+        # Scraping again without changes adds nothing but the check times
+        resp = self.post_updates({
+            'a.com': {'course_count': 5, 'is_gone': False},
+            'b.com': {'course_count': 7, 'is_gone': False},
+        })
+        self.assertEqual(resp['updated'], [])
+        self.assertEqual(resp['unchanged'], ['a.com', 'b.com'])
+        self.assertEqual(Site.objects.count(), 3)
+        self.assertEqual(SiteCheck.objects.count(), 2)
+        self.assertGreater(SiteCheck.objects.get(url='https://a.com').last_checked, first_check)
+
+    def test_query_count_does_not_grow_with_the_payload(self):
+        for i in range(20):
+            self.make_site(f'https://site{i}.org')
+
+        def update(count):
+            return {f'site{i}.org': {'course_count': count + i, 'is_gone': False} for i in range(count)}
+
+        with self.assertNumQueries(10):
+            self.assertEqual(len(self.post_updates(update(2))['updated']), 2)
+        with self.assertNumQueries(10):
+            self.assertEqual(len(self.post_updates(update(20))['updated']), 20)
+        self.assertEqual(Site.objects.count(), 42)
+        # The new versions share the old versions' tag set
+        self.assertEqual(Site.objects.filter(tag_set__languages=['English']).count(), 42)
+        self.assertEqual(TagSet.objects.count(), 1)
+
+
+class BulkCreateTestCase(TestCase):
+    """
+    Tests for the bulk_create endpoint.
+    """
+
+    def setUp(self):
+        User.objects.create_user('testuser', 'testuser@edx.com', 'password')
+        self.client.login(username='testuser', password='password')
+        Language.objects.create(name='French')
+        GeoZone.objects.create(name='Canada')
+
+    def post_sites(self, payload):
+        response = self.client.post('/sites/bulk_create/', payload, content_type='application/yaml')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode().splitlines()
+
+    def test_nothing_is_created_if_any_site_is_invalid(self):
+        Site.objects.create(url='https://old.org/', name='Old')
+        resp = self.post_sites(
+            "- url: https://OLD.org\n"
+            "- url: https://new.org\n  language: Klingon\n"
+            "- url: https://other.org\n  geography: Atlantis\n"
+            "- url: https://fine.org\n  language: French\n"
+        )
+        self.assertEqual(resp, [
+            "Error: https://OLD.org already exists: Old --- https://old.org/",
+            "Error: Language 'Klingon' doesn't exist",
+            "Error: GeoZone 'Atlantis' doesn't exist",
+        ])
+        self.assertEqual(Site.objects.count(), 1)
+
+    def test_sites_are_created_with_a_fixed_number_of_queries(self):
+        def payload(prefix, count):
+            return "".join(
+                f"- url: https://{prefix}{i}.org\n  name: Site {i}\n  course_count: {i}\n"
+                f"  language: French\n  geography: Canada\n"
+                for i in range(count)
+            )
+
+        # Session and user lookups, a savepoint, three lookups, the tag set upsert, the insert and the release, and
+        # the first time, the new tag set's links to its language and geozone
+        with self.assertNumQueries(13):
+            self.assertEqual(self.post_sites(payload('small', 2)), ["Created 2 sites"])
+        with self.assertNumQueries(9):
+            self.assertEqual(self.post_sites(payload('large', 200)), ["Created 200 sites"])
+
+        site = Site.objects.get(url='https://large7.org')
+        self.assertEqual((site.name, site.course_count), ('Site 7', 7))
+        self.assertEqual(site.get_languages(), 'French')
+        self.assertEqual(site.get_geographies(), 'Canada')
+        self.assertEqual(site.hosts, ['large7.org'])
+        self.assertEqual(Site.objects.filter(tag_set__languages=['French']).count(), 202)
+        self.assertEqual(TagSet.objects.count(), 1)
+
+
+class BulkNDJSONTestCase(TestCase):
+    """
+    Tests for sending the bulk endpoints NDJSON bodies, which are processed and answered a chunk at a time.
+    """
+
+    def setUp(self):
+        User.objects.create_user('testuser', 'testuser@edx.com', 'password')
+        self.client.login(username='testuser', password='password')
+        for i in range(3):
+            Site.objects.create(url=f'https://site{i}.org', course_count=1)
+
+    def post_ndjson(self, path, records, gzipped=False):
+        body = "".join(json.dumps(record) + "\n" for record in records).encode()
+        headers = {}
+        if gzipped:
+            body = gzip.compress(body)
+            headers['HTTP_CONTENT_ENCODING'] = 'gzip'
+        return self.client.post(path, body, content_type='application/x-ndjson', **headers)
+
+    def streamed_lines(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_updates_are_streamed(self):
+        for gzipped in [False, True]:
+            with mock.patch.object(bulk, 'STREAM_CHUNK_SIZE', 2):
+                response = self.post_ndjson('/sites/bulk_update/', [
+                    {'url': 'site0.org', 'course_count': 1, 'is_gone': False},
+                    {'overcount': 6},
+                    {'url': 'site1.org', 'course_count': 2 if gzipped else 3, 'is_gone': False},
+                    {'url': 'missing.org', 'course_count': 1, 'is_gone': False},
+                ], gzipped=gzipped)
+                lines = self.streamed_lines(response)
+            self.assertEqual(lines, [
+                {'url': 'site0.org', 'result': 'unchanged'},
+                {'url': 'site1.org', 'result': 'updated'},
+                {'url': 'missing.org', 'result': 'not_found'},
+                {'updated_over_count': True},
+            ])
+        self.assertEqual(Site.objects.get(url='https://site1.org', active_end_date=None).course_count, 2)
+        self.assertEqual(OverCount.objects.get(active_end_date=None).course_count, 6)
+
+    def test_malformed_update_lines_are_rejected(self):
+        with mock.patch.object(bulk, 'STREAM_CHUNK_SIZE', 1):
+            response = self.post_ndjson('/sites/bulk_update/', [
+                {'url': 'site0.org', 'course_count': 5, 'is_gone': False},
+                {'overcount': 6},
+                {'URL': 'site1.org', 'course_count': 5, 'is_gone': False},
+                {'url': 'site2.org', 'course_count': 5, 'is_gone': False},
+            ])
+            lines = self.streamed_lines(response)
+        self.assertEqual(lines, [
+            {'url': 'site0.org', 'result': 'updated'},
+            {'error': 'Line 3 is neither a site nor an over-count: '
+                      '{"URL": "site1.org", "course_count": 5, "is_gone": false}'},
+        ])
+        self.assertEqual(Site.objects.get(url='https://site2.org', active_end_date=None).course_count, 1)
+        self.assertFalse(OverCount.objects.exists())
+
+        response = self.post_ndjson('/sites/bulk_update/?async=1', [
+            {'url': 'site0.org', 'course_count': 7, 'is_gone': False}, ['site1.org'],
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(BulkJob.objects.exists())
+
+    def test_creates_are_streamed(self):
+        with mock.patch.object(bulk, 'STREAM_CHUNK_SIZE', 2):
+            response = self.post_ndjson('/sites/bulk_create/', [
+                {'url': 'https://new0.org', 'name': 'New 0'},
+                {'url': 'https://new1.org'},
+                {'url': 'https://site0.org'},
+            ], gzipped=True)
+            lines = self.streamed_lines(response)
+        # Chunks are checked on their own, so the first was created even though the second had an existing site
+        self.assertEqual(lines, [
+            {'message': 'Created 2 sites'},
+            {'message': 'Error: https://site0.org already exists:  --- https://site0.org'},
+        ])
+        self.assertEqual(Site.objects.get(url='https://new0.org').name, 'New 0')
+
+    def test_malformed_create_lines_are_rejected(self):
+        with mock.patch.object(bulk, 'STREAM_CHUNK_SIZE', 1):
+            response = self.post_ndjson('/sites/bulk_create/', [
+                {'url': 'https://new0.org'},
+                {'name': 'No url'},
+                {'url': 'https://new2.org'},
+            ])
+            lines = self.streamed_lines(response)
+        self.assertEqual(lines, [
+            {'message': 'Created 1 sites'},
+            {'error': 'Line 2 is not a site: {"name": "No url"}'},
+        ])
+        self.assertFalse(Site.objects.filter(url='https://new2.org').exists())
+
+        body = b'{"url": "https://new3.org"}\n{"url": "https://new4.org",\n'
+        response = self.client.post('/sites/bulk_create/', body, content_type='application/x-ndjson')
+        lines = self.streamed_lines(response)
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0]['error'].startswith("Line 2 isn't valid JSON: "))
+        self.assertFalse(Site.objects.filter(url='https://new3.org').exists())
+
+        for body in [b'{"url": "https://new5.org"}\n["https://new6.org"]\n', b'{"url": "https://new5.org"}\nnot json\n']:
+            response = self.client.post('/sites/bulk_create/?async=1', body, content_type='application/x-ndjson')
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(BulkJob.objects.exists())
+
+    def test_ndjson_jobs_are_queued_a_chunk_at_a_time(self):
+        with mock.patch.object(bulk, 'JOB_CHUNK_SIZE', 2):
+            response = self.post_ndjson('/sites/bulk_update/?async=1', [
+                {'url': f'site{i}.org', 'course_count': 5, 'is_gone': False} for i in range(3)
+            ] + [{'overcount': 2}])
+        self.assertEqual(response.status_code, 202)
+        queued = json.loads(response.content.decode())
+        self.assertFalse(queued['updated_over_count'])
+        job = BulkJob.objects.get(pk=queued['job'])
+        self.assertEqual(job.num_sites, 3)
+        self.assertEqual(job.chunks.count(), 2)
+        self.assertEqual(job.over_count, 2)
+
+        call_command('run_bulk_jobs', '--once', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status()['results']['updated'], ['site0.org', 'site1.org', 'site2.org'])
+        self.assertTrue(job.status()['updated_over_count'])
+        self.assertEqual(OverCount.objects.get(active_end_date=None).course_count, 2)
+
+    def test_memory_does_not_grow_with_the_body(self):
+        def peak_memory_updating(num_sites):
+            body = "".join(
+                json.dumps({'url': f'missing{i}.org', 'course_count': i, 'is_gone': False}) + "\n"
+                for i in range(num_sites)
+            ).encode()
+            tracemalloc.start()
+            try:
+                response = self.client.post('/sites/bulk_update/', body, content_type='application/x-ndjson')
+                num_lines = sum(1 for _ in response.streaming_content)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(num_lines, num_sites + 1)
+            # The test client keeps its own copy of the body
+            return peak - len(body)
+
+        peak_memory_updating(100)
+        small_peak = peak_memory_updating(2000)
+        large_peak = peak_memory_updating(20000)
+        self.assertLess(large_peak, small_peak * 1.5)
+
+
+class BulkJobTestCase(TestCase):
+    """
+    Tests for queueing bulk_update and bulk_create payloads as jobs for the run_bulk_jobs command.
+    """
+
+    def setUp(self):
+        User.objects.create_user('testuser', 'testuser@edx.com', 'password')
+        self.client.login(username='testuser', password='password')
+        for i in range(5):
+            Site.objects.create(url=f'https://site{i}.org', course_count=1)
+
+    def queue_updates(self, sites, **payload):
+        with mock.patch.object(bulk, 'JOB_CHUNK_SIZE', 2):
+            response = self.client.post(
+                '/sites/bulk_update/?async=1', json.dumps({'sites': sites, **payload}), content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 202)
+        return json.loads(response.content.decode())
+
+    def job_status(self, job_id):
+        response = self.client.get(reverse('sites:bulk_job_status', args=[job_id]))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def run_jobs(self, *args):
+        out = StringIO()
+        call_command('run_bulk_jobs', '--once', *args, stdout=out)
+        return out.getvalue()
+
+    def test_updates_are_queued_and_run_in_chunks(self):
+        queued = self.queue_updates({
+            f'site{i}.org': {'course_count': 1 if i == 0 else 10, 'is_gone': False} for i in range(5)
+        } | {'missing.org': {'course_count': 1, 'is_gone': False}}, overcount=3)
+        self.assertEqual(queued['updated_over_count'], False)
+        self.assertTrue(queued['status_url'].endswith(f"/sites/bulk_jobs/{queued['job']}/"))
+
+        # Nothing is updated until the worker runs, not even the over-count
+        self.assertEqual(Site.objects.count(), 5)
+        self.assertFalse(OverCount.objects.exists())
+        status = self.job_status(queued['job'])
+        self.assertEqual(status['status'], 'pending')
+        self.assertEqual(status['chunks'], {'pending': 3, 'done': 0, 'failed': 0})
+        self.assertEqual((status['over_count'], status['updated_over_count']), (3, False))
+
+        output = self.run_jobs()
+        self.assertEqual(output.count(": done"), 3)
+        status = self.job_status(queued['job'])
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['sites_done'], 6)
+        self.assertEqual(status['results'], {
+            'updated': ['site1.org', 'site2.org', 'site3.org', 'site4.org'],
+            'unchanged': ['site0.org'],
+            'not_found': ['missing.org'],
+        })
+        self.assertEqual(Site.objects.filter(active_end_date=None, course_count=10).count(), 4)
+        self.assertTrue(status['updated_over_count'])
+        self.assertEqual(OverCount.objects.get().course_count, 3)
+
+    def test_failed_chunks_are_retried(self):
+        queued = self.queue_updates(
+            {f'site{i}.org': {'course_count': 5, 'is_gone': False} for i in range(3)}, overcount=4
+        )
+        update_sites = bulk.update_sites
+        calls = []
+
+        def flaky_update_sites(site_updates):
+            calls.append(list(site_updates))
+            if len(calls) <= 3:
+                raise RuntimeError("database went away")
+            return update_sites(site_updates)
+
+        with mock.patch.object(bulk, 'update_sites', flaky_update_sites):
+            self.run_jobs('--max-attempts', '2', '--retry-delay', '0')
+        # The first chunk failed twice and was given up on; the second failed once and then succeeded
+        status = self.job_status(queued['job'])
+        self.assertEqual(status['status'], 'failed')
+        self.assertEqual(status['chunks'], {'pending': 0, 'done': 1, 'failed': 1})
+        self.assertEqual([error['chunk'] for error in status['errors']], [0])
+        self.assertIn("database went away", status['errors'][0]['error'])
+        self.assertEqual(status['results']['updated'], ['site2.org'])
+        # A failed job's over-count isn't recorded
+        self.assertFalse(status['updated_over_count'])
+        self.assertFalse(OverCount.objects.exists())
+
+        output = self.run_jobs('--retry-failed')
+        self.assertIn("Chunks queued again: 1", output)
+        status = self.job_status(queued['job'])
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['results']['updated'], ['site0.org', 'site1.org', 'site2.org'])
+        self.assertEqual(status['errors'], [])
+        self.assertTrue(status['updated_over_count'])
+        self.assertEqual(OverCount.objects.get().course_count, 4)
+
+    def test_failing_chunks_wait_behind_the_rest(self):
+        queued = self.queue_updates({f'site{i}.org': {'course_count': 5, 'is_gone': False} for i in range(5)})
+        update_sites = bulk.update_sites
+
+        def update_sites_but_site0(site_updates):
+            if 'site0.org' in site_updates:
+                raise RuntimeError("database went away")
+            return update_sites(site_updates)
+
+        with mock.patch.object(bulk, 'update_sites', update_sites_but_site0):
+            output = self.run_jobs()
+        # The first chunk failed once, and the two behind it ran while it waited to be retried
+        self.assertEqual(output.splitlines(), [
+            f"Job {queued['job']} chunk 0 (2 sites): failed, will retry",
+            f"Job {queued['job']} chunk 1 (2 sites): done",
+            f"Job {queued['job']} chunk 2 (1 sites): done",
+        ])
+        chunk = BulkJobChunk.objects.get(job=queued['job'], index=0)
+        self.assertEqual(chunk.attempts, 1)
+        self.assertGreater(chunk.retry_after, datetime.now())
+        self.assertEqual(self.job_status(queued['job'])['status'], 'running')
+
+        # Once its wait is over, it's tried again
+        BulkJobChunk.objects.filter(pk=chunk.pk).update(retry_after=datetime.now())
+        self.assertEqual(self.run_jobs(), f"Job {queued['job']} chunk 0 (2 sites): done\n")
+        self.assertEqual(self.job_status(queued['job'])['status'], 'done')
+
+    def test_creates_are_queued(self):
+        Language.objects.create(name='French')
+        payload = "- url: https://new1.org\n  language: French\n- url: https://new2.org\n"
+        response = self.client.post('/sites/bulk_create/?async=1', payload, content_type='application/yaml')
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.content.decode())['job']
+
+        self.run_jobs()
+        status = self.job_status(job_id)
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['results'], {'created': 2, 'messages': ['Created 2 sites']})
+        self.assertEqual(Site.objects.get(url='https://new1.org').get_languages(), 'French')
+
+
+class SiteDiscoveryTestCase(TestCase):
+    """
+    Tests for the site discovery list and the referrer rollup it reads.
+    """
+
+    def setUp(self):
+        User.objects.create_user('testuser', 'testuser@edx.com', 'password')
+        self.client.login(username='testuser', password='password')
+
+    def test_domains_are_classified_when_first_seen(self):
+        domains = Domain.for_names([
+            'www.example.com.', 'bucket.s3.amazonaws.com', 'courses.edx.org', '10.0.0.1', 'example.com:8000', '',
+        ])
+        self.assertEqual(Domain.objects.count(), 6)
+        self.assertEqual(domains['www.example.com.'].netloc, 'www.example.com')
+        self.assertEqual(domains['www.example.com.'].short_netloc, 'example.com')
+        self.assertTrue(domains['bucket.s3.amazonaws.com'].is_aws)
+        self.assertTrue(domains['courses.edx.org'].is_edx)
+        self.assertTrue(domains['10.0.0.1'].is_ip_address)
+        self.assertTrue(domains['example.com:8000'].has_port)
+        self.assertCountEqual(
+            Domain.objects.filter(discoverable_domains_query()).values_list('name', flat=True),
+            [name for name, domain in domains.items() if domain.is_discoverable],
+        )
+        self.assertEqual([name for name, domain in domains.items() if domain.is_discoverable], ['www.example.com.'])
+
+        # Seen domains are looked up, not created again
+        again = Domain.for_names(['courses.edx.org', 'new.example.com'])
+        self.assertEqual(again['courses.edx.org'].pk, domains['courses.edx.org'].pk)
+        self.assertEqual(Domain.objects.count(), 7)
+
+    def test_add_counts_skips_undiscoverable_domains_and_accumulates(self):
+        domains = Domain.for_names([
+            'courses.example.com', 'bucket.s3.amazonaws.com', 'courses.edx.org', '10.0.0.1', 'example.com:8000', '',
+        ])
+        DomainDailyTraffic.add_counts({
+            (domain, '2020-01-01'): 5 for domain in domains.values()
+        })
+        DomainDailyTraffic.add_counts({
+            (domains['courses.example.com'], date(2020, 1, 1)): 2,
+            (domains['courses.example.com'], '2020-01-02'): 1,
+        })
+        self.assertCountEqual(
+            DomainDailyTraffic.objects.values_list('domain__name', 'access_date', 'access_count'),
+            [('courses.example.com', date(2020, 1, 1), 7), ('courses.example.com', date(2020, 1, 2), 1)],
+        )
+
+    def test_processing_a_log_file_updates_the_rollup(self):
+        lines = ["#Version: 1.0", "#Fields: date time ..."]
+        for day, referrer, hits in [
+            ('2020-01-01', 'https://courses.example.com/dashboard', 3),
+            ('2020-01-02', 'https://courses.example.com/', 1),
+            ('2020-01-01', 'http://10.0.0.1:8000/', 2),
+            ('2020-01-01', '-', 2),
+        ]:
+            line = "\t".join([day, '12:00:00', 'EDGE', '100', '1.2.3.4', 'GET', 'cdn', '/logo.png', '200', referrer])
+            lines.extend([line] * hits)
+
+        fetch_referrer_logs.process_log_file(lines, 'file_1.gz')
+        # Files that were already processed don't add to the rollup again
+        fetch_referrer_logs.process_log_file(lines, 'file_1.gz')
+
+        self.assertEqual(AccessLogAggregate.objects.count(), 4)
+        self.assertEqual(Domain.objects.count(), 3)
+        self.assertCountEqual(
+            DomainDailyTraffic.objects.values_list('domain__name', 'access_date', 'access_count'),
+            [('courses.example.com', date(2020, 1, 1), 3), ('courses.example.com', date(2020, 1, 2), 1)],
+        )
+
+    def test_discovery_lists_unknown_domains_in_range(self):
+        Site.objects.create(url='https://known.org/', aliases=['https://alias.org'])
+        domains = Domain.for_names(['new.org', 'www.known.org', 'studio.alias.org'])
+        DomainDailyTraffic.add_counts({
+            (domains['new.org'], '2020-01-01'): 3,
+            (domains['new.org'], '2020-01-02'): 4,
+            (domains['new.org'], '2020-02-01'): 100,
+            (domains['www.known.org'], '2020-01-01'): 3,
+            (domains['studio.alias.org'], '2020-01-01'): 3,
+        })
+
+        response = self.client.post('/sites/site_discovery/', {'start_date': '2020-01-01', 'end_date': '2020-01-31'})
+        self.assertEqual(json.loads(response.content.decode()), [{'domain': 'new.org', 'count': 7, 'visitors': None}])
+        response = self.client.post('/sites/site_discovery/', {'start_date': '', 'end_date': ''})
+        self.assertEqual(
+            json.loads(response.content.decode()), [{'domain': 'new.org', 'count': 107, 'visitors': None}]
+        )
+
+    def test_discovery_ranks_by_unique_visitors_over_files_and_days(self):
+        def log_lines(hits):
+            return [
+                "\t".join([day, '12:00:00', 'EDGE', '100', ip, 'GET', 'cdn', '/logo.png', '200', referrer])
+                for day, ip, referrer in hits
+            ]
+
+        # busy.org is fetched often by two visitors, popular.org less often by five
+        fetch_referrer_logs.process_log_file(log_lines(
+            [('2020-01-01', '10.0.0.1', 'https://busy.org/')] * 10 +
+            [('2020-01-01', f'10.0.1.{i}', 'https://popular.org/') for i in range(3)]
+        ), 'file_1.gz')
+        fetch_referrer_logs.process_log_file(log_lines(
+            [('2020-01-01', '10.0.0.2', 'https://busy.org/')] * 10 +
+            [('2020-01-01', f'10.0.1.{i}', 'https://popular.org/') for i in range(2, 4)] +
+            [('2020-01-02', f'10.0.1.{i}', 'https://popular.org/') for i in range(3, 5)]
+        ), 'file_2.gz')
+
+        self.assertEqual(
+            HyperLogLog.from_bytes(
+                DomainDailyTraffic.objects.get(domain__name='popular.org', access_date=date(2020, 1, 1)).visitor_sketch
+            ).estimate(),
+            4,
+        )
+        expected = [
+            {'domain': 'popular.org', 'count': 7, 'visitors': 5},
+            {'domain': 'busy.org', 'count': 20, 'visitors': 2},
+        ]
+        response = self.client.post('/sites/site_discovery/', {'start_date': '2020-01-01', 'end_date': '2020-01-02'})
+        self.assertEqual(json.loads(response.content.decode()), expected)
+
+        # Rebuilding the rollup from the aggregates gives the same sketches
+        DomainDailyTraffic.rebuild([date(2020, 1, 1), date(2020, 1, 2)])
+        response = self.client.post('/sites/site_discovery/', {'start_date': '2020-01-01', 'end_date': '2020-01-02'})
+        self.assertEqual(json.loads(response.content.decode()), expected)
+
 @mock_s3
 class ReferrerLogTestCase(TestCase):
     """
@@ -594,12 +1703,12 @@ class ReferrerLogTestCase(TestCase):
         file_path_gz = os.path.join(BASE, "test_data/s3_data.gz")
         self.s3.Object(bucket_name, self.prefix + "/" + file_name_gz).upload_file(file_path_gz)
         self.bucket = self.s3.Bucket(bucket_name)
+        self.source = referrer_logs.S3LogSource(bucket=self.bucket)
 
 
     def test_can_download_keys(self):
         # Get only today's keys to reduce search time
-        accessible_keys = fetch_referrer_logs.get_accessible_keys(self.bucket, self.prefix)
-        accessible_keys = [k.key for k in accessible_keys]
+        accessible_keys = list(self.source.list_keys(self.prefix))
 
         self.assertIsNotNone(accessible_keys)
         assert len(accessible_keys)==11
@@ -609,9 +1718,9 @@ class ReferrerLogTestCase(TestCase):
 
     def test_can_unzip_one_file(self):
         # Get only today's keys to reduce search time
-        accessible_keys = fetch_referrer_logs.get_accessible_keys(self.bucket, self.prefix)
+        accessible_keys = self.source.list_keys(self.prefix)
         accessible_keys = [k for k in accessible_keys]  # convert generator into list
-        num_files_processed = fetch_referrer_logs.process_keys(self.bucket, [accessible_keys[0]])
+        num_files_processed = fetch_referrer_logs.process_keys(self.source, [accessible_keys[0]])
         self.assertEqual(num_files_processed, 1)
         self.assertEqual(FilenameLog.objects.all().count(), 1)
         self.assertIsNotNone(AccessLogAggregate.objects.all())
@@ -619,23 +1728,318 @@ class ReferrerLogTestCase(TestCase):
     # Reduce number of files processed to reduce test time
     def test_todays_logs(self):
         # Get only today's keys to reduce search time
-        accessible_keys = fetch_referrer_logs.get_accessible_keys(self.bucket, self.prefix)
+        accessible_keys = self.source.list_keys(self.prefix)
         # Process only first 10 files to save time
         accessible_keys = [k for k in accessible_keys]  # convert generator into list
-        num_files_processed = fetch_referrer_logs.process_keys(self.bucket, accessible_keys[:10])
+        num_files_processed = fetch_referrer_logs.process_keys(self.source, accessible_keys[:10])
         self.assertEqual(num_files_processed, 10)
         self.assertEqual(FilenameLog.objects.all().count(), 10)
         self.assertIsNotNone(AccessLogAggregate.objects.all())
 
     def test_no_duplicate_files_are_processed(self):
         # Get only today's keys to reduce search time
-        accessible_keys = fetch_referrer_logs.get_accessible_keys(self.bucket, self.prefix)
+        accessible_keys = self.source.list_keys(self.prefix)
         accessible_keys = [k for k in accessible_keys] # convert generator into list
-        num_files_processed = fetch_referrer_logs.process_keys(self.bucket, accessible_keys[:3])
+        num_files_processed = fetch_referrer_logs.process_keys(self.source, accessible_keys[:3])
         self.assertEqual(num_files_processed, 3)
         self.assertEqual(FilenameLog.objects.all().count(), 3)
         self.assertIsNotNone(AccessLogAggregate.objects.all())
         # Now input those 3 files again with an extra, only the extra should be processed
-        num_files_processed = fetch_referrer_logs.process_keys(self.bucket, accessible_keys[:4])
+        num_files_processed = fetch_referrer_logs.process_keys(self.source, accessible_keys[:4])
         self.assertEqual(num_files_processed, 1)
         self.assertEqual(FilenameLog.objects.all().count(), 4)
+
+    def put_referrer_logs(self, prefix, num_files):
+        """
+        Upload `num_files` gzipped CloudFront logs with real referrers, returning their keys.
+        """
+        for i in range(num_files):
+            lines = ["#Version: 1.0"]
+            for day, referrer, hits in [
+                ('2020-01-01', 'https://courses.example.com/dashboard', 3),
+                ('2020-01-02', f'https://site{i % 3}.example.org/', 2),
+            ]:
+                fields = [day, '12:00:00', 'EDGE', '100', '1.2.3.4', 'GET', 'cdn', '/logo.png', '200', referrer]
+                lines.extend(["\t".join(fields)] * hits)
+            self.bucket.put_object(Key=f"{prefix}/file_{i}.gz", Body=gzip.compress("\n".join(lines).encode()))
+        return list(self.source.list_keys(prefix))
+
+    def test_workers_save_the_same_counts(self):
+        accessible_keys = self.put_referrer_logs("workers", 12)
+        num_files_processed = fetch_referrer_logs.process_keys(self.source, accessible_keys, workers=4)
+        self.assertEqual(num_files_processed, 12)
+        self.assertEqual(FilenameLog.objects.count(), 12)
+        self.assertCountEqual(
+            DomainDailyTraffic.objects.values_list('domain__name', 'access_date', 'access_count'),
+            [
+                ('courses.example.com', date(2020, 1, 1), 36),
+                ('site0.example.org', date(2020, 1, 2), 8),
+                ('site1.example.org', date(2020, 1, 2), 8),
+                ('site2.example.org', date(2020, 1, 2), 8),
+            ],
+        )
+        # Running again finds nothing new
+        self.assertEqual(fetch_referrer_logs.process_keys(self.source, accessible_keys, workers=4), 0)
+
+    def test_workers_limit_files_in_flight(self):
+        accessible_keys = self.put_referrer_logs("in_flight", 20)
+        fetched = []
+        saved = []
+        fetch_log_counts = fetch_referrer_logs.fetch_log_counts
+        save_key_counts = fetch_referrer_logs.save_key_counts
+
+        def counting_fetch(source, key_name):
+            fetched.append(key_name)
+            self.assertLessEqual(len(fetched) - len(saved), 2 * fetch_referrer_logs.IN_FLIGHT_PER_WORKER)
+            return fetch_log_counts(source, key_name)
+
+        def counting_save(key_name, *args, **kwargs):
+            saved.append(key_name)
+            return save_key_counts(key_name, *args, **kwargs)
+
+        with mock.patch.object(fetch_referrer_logs, 'fetch_log_counts', counting_fetch), \
+                mock.patch.object(fetch_referrer_logs, 'save_key_counts', counting_save):
+            num_files_processed = fetch_referrer_logs.process_keys(self.source, accessible_keys, workers=2)
+        self.assertEqual(num_files_processed, 20)
+        self.assertCountEqual(saved, accessible_keys)
+
+    def put_large_log(self, key, num_lines):
+        lines = []
+        for i in range(num_lines):
+            referrer = f'https://site{i % 50}.example.org/dashboard?session={i % 1000:012d}'
+            fields = ['2020-01-01', '12:00:00', 'EDGE', '100', '1.2.3.4', 'GET', 'cdn', '/logo.png', '200', referrer]
+            lines.append("\t".join(fields))
+        body = "\n".join(lines).encode()
+        if key.endswith(".gz"):
+            body = gzip.compress(body)
+        self.bucket.put_object(Key=key, Body=body)
+
+    def peak_memory_counting(self, key):
+        referrer_logs.referrer_host.cache_clear()
+        tracemalloc.start()
+        try:
+            line_counter, _ = fetch_referrer_logs.fetch_log_counts(self.source, key)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return line_counter, peak
+
+    def test_log_files_are_read_a_line_at_a_time(self):
+        for key, num_lines in [("small.gz", 5000), ("large.gz", 50000), ("large.txt", 50000)]:
+            self.put_large_log(key, num_lines)
+
+        small_counts, small_peak = self.peak_memory_counting("small.gz")
+        large_counts, large_peak = self.peak_memory_counting("large.gz")
+        self.assertEqual(sum(small_counts.values()), 5000)
+        self.assertEqual(sum(large_counts.values()), 50000)
+        self.assertEqual(len(large_counts), 50)
+        # Ten times the lines (about 5MB decompressed) shouldn't need much more memory than the small file
+        self.assertLess(large_peak, small_peak * 2)
+        self.assertLess(large_peak, 1024 * 1024)
+
+        text_counts, _ = self.peak_memory_counting("large.txt")
+        self.assertEqual(
+            text_counts, {(host, day, "large.txt"): count for (host, day, _), count in large_counts.items()}
+        )
+
+    def run_listing(self, prefix, rescan=False):
+        last_keys = {}
+        accessible_keys = fetch_referrer_logs.get_recent_keys(self.source, prefix, rescan=rescan, last_keys=last_keys)
+        num_files_processed = fetch_referrer_logs.process_keys(self.source, accessible_keys)
+        fetch_referrer_logs.save_listing_marks(last_keys)
+        return num_files_processed
+
+    def test_runs_list_from_shortly_before_the_last_key(self):
+        prefix = "logos/"
+        for distribution, hour in [("EAAA", "2020-01-01-00"), ("EAAA", "2020-01-10-12"), ("EBBB", "2020-01-05-00")]:
+            self.bucket.put_object(Key=f"{prefix}{distribution}.{hour}.x.gz", Body=gzip.compress(b"#Version: 1.0"))
+        self.assertEqual(self.run_listing(prefix), 3)
+        self.assertCountEqual(
+            LogListingMark.objects.values_list('prefix', 'last_key'),
+            [("logos/EAAA.", "logos/EAAA.2020-01-10-12.x.gz"), ("logos/EBBB.", "logos/EBBB.2020-01-05-00.x.gz")],
+        )
+
+        # A late log inside the lookback is picked up, one from long before the last key isn't
+        for hour in ["2020-01-09-00", "2020-01-05-00", "2020-01-11-00"]:
+            self.bucket.put_object(Key=f"{prefix}EAAA.{hour}.late.gz", Body=gzip.compress(b"#Version: 1.0"))
+        listed = list(fetch_referrer_logs.get_recent_keys(self.source, prefix))
+        self.assertEqual(listed, [
+            "logos/EAAA.2020-01-09-00.late.gz", "logos/EAAA.2020-01-10-12.x.gz", "logos/EAAA.2020-01-11-00.late.gz",
+            "logos/EBBB.2020-01-05-00.x.gz",
+        ])
+        self.assertEqual(self.run_listing(prefix), 2)
+        self.assertEqual(LogListingMark.objects.get(prefix="logos/EAAA.").last_key, "logos/EAAA.2020-01-11-00.late.gz")
+        self.assertEqual(self.run_listing(prefix), 0)
+        self.assertEqual(self.run_listing(prefix, rescan=True), 1)
+
+    def test_new_keys_are_checked_in_batches(self):
+        FilenameLog.objects.bulk_create([FilenameLog(filename=f"key_{i}") for i in range(0, 2500, 2)])
+        key_names = [f"key_{i}" for i in range(2500)]
+        with self.assertNumQueries(3):
+            new_names = list(fetch_referrer_logs.new_key_names(key_names))
+        self.assertEqual(new_names, [f"key_{i}" for i in range(1, 2500, 2)])
+
+    def test_a_file_is_saved_completely_or_not_at_all(self):
+        accessible_keys = self.put_referrer_logs("atomic", 3)
+        with mock.patch.object(DomainDailyTraffic, 'add_counts', side_effect=RuntimeError("crash")):
+            with self.assertRaises(RuntimeError):
+                fetch_referrer_logs.process_keys(self.source, accessible_keys)
+        self.assertEqual(FilenameLog.objects.count(), 0)
+        self.assertEqual(AccessLogAggregate.objects.count(), 0)
+
+        # The file that failed is retried on the next run
+        self.assertEqual(fetch_referrer_logs.process_keys(self.source, accessible_keys, batch_size=1), 3)
+        self.assertEqual(AccessLogAggregate.objects.count(), 6)
+        self.assertEqual(
+            DomainDailyTraffic.objects.get(domain__name='courses.example.com').access_count, 9
+        )
+        # Saving a file that has already been recorded changes nothing
+        line_counter, visitors = fetch_referrer_logs.fetch_log_counts(self.source, accessible_keys[0])
+        self.assertFalse(fetch_referrer_logs.save_key_counts(accessible_keys[0], line_counter, visitors))
+        self.assertEqual(
+            DomainDailyTraffic.objects.get(domain__name='courses.example.com').access_count, 9
+        )
+
+    def test_counting_only_splits_the_fields_it_needs(self):
+        with open(os.path.join(BASE, "test_data/s3_data.txt")) as s3_data:
+            lines = s3_data.read().splitlines()
+        lines.append("\t".join(['2020-01-01', '12:00:00', 'EDGE', '100', '1.2.3.4', 'GET', 'cdn', '/logo.png', '200',
+                                'https://courses.example.com/x?a=b', 'Mozilla/5.0', '-']))
+        lines *= 3
+
+        referrer_logs.referrer_host.cache_clear()
+        line_counter = referrer_logs.count_log_lines(lines, 'file_1.gz')
+        # The sample lines' referrers aren't urls, so they have no host
+        self.assertEqual(line_counter, collections.Counter({
+            ('', '2023-02-15', 'file_1.gz'): 3,
+            ('', '2011-2-10', 'file_1.gz'): 3,
+            ('courses.example.com', '2020-01-01', 'file_1.gz'): 3,
+        }))
+        self.assertEqual(referrer_logs.referrer_host.cache_info().misses, 3)
+
+    def write_cloudfront_log(self, directory, key, referrers):
+        lines = ["#Version: 1.0"]
+        for day, referrer in referrers:
+            fields = [day, '12:00:00', 'EDGE', '100', '1.2.3.4', 'GET', 'cdn', '/logo.png', '200', referrer]
+            lines.append("\t".join(fields))
+        path = os.path.join(directory, *key.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, 'wt') as log_file:
+            log_file.write("\n".join(lines))
+
+    def test_backfill_from_a_local_directory_in_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_cloudfront_log(directory, "openedx-logos-cloudfront/EAAA.2020-01-01-23.a.gz", [
+                ('2020-01-01', 'https://one.example.org/'), ('2020-01-02', 'https://one.example.org/'),
+            ])
+            self.write_cloudfront_log(directory, "openedx-logos-cloudfront/EAAA.2020-01-02-05.b.gz", [
+                ('2020-01-02', 'https://one.example.org/'), ('2020-01-02', 'https://two.example.org/'),
+            ])
+            self.write_cloudfront_log(directory, "openedx-logos-cloudfront/EBBB.2020-01-03-00.c.gz", [
+                ('2020-01-03', 'https://two.example.org/'),
+            ])
+            self.write_cloudfront_log(directory, "openedx-logos-cloudfront/EAAA.2020-02-01-00.d.gz", [
+                ('2020-02-01', 'https://one.example.org/'),
+            ])
+            # One file was processed before, and the rollup has gone stale
+            fetch_referrer_logs.process_log_file(
+                referrer_logs.LocalLogSource(directory).open_lines("openedx-logos-cloudfront/EAAA.2020-01-01-23.a.gz"),
+                "openedx-logos-cloudfront/EAAA.2020-01-01-23.a.gz",
+            )
+            DomainDailyTraffic.objects.update(access_count=100)
+
+            self.assertEqual(
+                list(fetch_referrer_logs.get_backfill_keys(
+                    referrer_logs.LocalLogSource(directory), since=date(2020, 1, 1), until=date(2020, 1, 31)
+                )),
+                [
+                    "openedx-logos-cloudfront/EAAA.2020-01-01-23.a.gz",
+                    "openedx-logos-cloudfront/EAAA.2020-01-02-05.b.gz",
+                    "openedx-logos-cloudfront/EBBB.2020-01-03-00.c.gz",
+                ],
+            )
+            call_command(
+                'fetch_referrer_logs', '--backfill', '--source', f'local:{directory}', '--processes', '2',
+                '--since', '2020-01-01', '--until', '2020-01-31', stdout=StringIO(),
+            )
+
+        self.assertEqual(FilenameLog.objects.count(), 3)
+        self.assertEqual(AccessLogAggregate.objects.count(), 5)
+        self.assertCountEqual(
+            DomainDailyTraffic.objects.values_list('domain__name', 'access_date', 'access_count'),
+            [
+                ('one.example.org', date(2020, 1, 1), 1),
+                ('one.example.org', date(2020, 1, 2), 2),
+                ('two.example.org', date(2020, 1, 2), 1),
+                ('two.example.org', date(2020, 1, 3), 1),
+            ],
+        )
+
+    def test_backfill_from_s3(self):
+        for key, day in [
+            ("logos/EAAA.2020-01-01-00.a.gz", '2020-01-01'), ("logos/EAAA.2020-01-05-00.b.gz", '2020-01-05'),
+        ]:
+            line = "\t".join([day, '12:00:00', 'EDGE', '100', '1.2.3.4', 'GET', 'cdn', '/logo.png', '200',
+                              'https://one.example.org/'])
+            self.bucket.put_object(Key=key, Body=gzip.compress(line.encode()))
+
+        key_names = list(
+            fetch_referrer_logs.get_backfill_keys(self.source, prefix="logos/", since=date(2020, 1, 2))
+        )
+        self.assertEqual(key_names, ["logos/EAAA.2020-01-05-00.b.gz"])
+        for _ in range(2):
+            self.assertEqual(fetch_referrer_logs.backfill_keys(self.source, key_names), 1)
+        self.assertEqual(
+            list(DomainDailyTraffic.objects.values_list('domain__name', 'access_date', 'access_count')),
+            [('one.example.org', date(2020, 1, 5), 1)],
+        )
+
+    def test_interrupted_backfill_keeps_rollup_in_step(self):
+        for key, day in [
+            ("logos/EAAA.2020-01-01-00.a.gz", '2020-01-01'), ("logos/EAAA.2020-01-05-00.b.gz", '2020-01-05'),
+        ]:
+            line = "\t".join([day, '12:00:00', 'EDGE', '100', '1.2.3.4', 'GET', 'cdn', '/logo.png', '200',
+                              'https://one.example.org/'])
+            self.bucket.put_object(Key=key, Body=gzip.compress(line.encode()))
+        key_names = list(fetch_referrer_logs.get_backfill_keys(self.source, prefix="logos/"))
+
+        rebuild = DomainDailyTraffic.rebuild
+        rebuilds = []
+
+        def rebuild_then_fail(access_dates):
+            rebuilds.append(access_dates)
+            rebuild(access_dates)
+            if len(rebuilds) == 2:
+                raise KeyboardInterrupt
+
+        with mock.patch.object(fetch_referrer_logs, 'BACKFILL_FILES_PER_BATCH', 1), \
+                mock.patch.object(DomainDailyTraffic, 'rebuild', side_effect=rebuild_then_fail):
+            with self.assertRaises(KeyboardInterrupt):
+                fetch_referrer_logs.backfill_keys(self.source, key_names)
+
+        # The first file's batch was committed with its rollup; the second was rolled back entirely
+        self.assertEqual(rebuilds, [{'2020-01-01'}, {'2020-01-05'}])
+        self.assertEqual(list(FilenameLog.objects.values_list('filename', flat=True)), [key_names[0]])
+        self.assertEqual(
+            list(DomainDailyTraffic.objects.values_list('domain__name', 'access_date', 'access_count')),
+            [('one.example.org', date(2020, 1, 1), 1)],
+        )
+
+    def test_fetching_from_a_local_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_cloudfront_log(directory, "openedx-logos-cloudfront/EAAA.2020-01-01-23.a.gz", [
+                ('2020-01-01', 'https://one.example.org/'), ('2020-01-02', 'https://one.example.org/'),
+            ])
+            for spec in [f'local:{directory}', f'memory:{directory}']:
+                call_command('fetch_referrer_logs', '--source', spec, stdout=StringIO())
+        self.assertEqual(list(FilenameLog.objects.values_list('filename', flat=True)), [
+            "openedx-logos-cloudfront/EAAA.2020-01-01-23.a.gz",
+        ])
+        self.assertEqual(LogListingMark.objects.get().last_key, "openedx-logos-cloudfront/EAAA.2020-01-01-23.a.gz")
+        self.assertEqual(
+            DomainDailyTraffic.objects.aggregate(total=Sum('access_count'))['total'], 2
+        )
+
+    def test_unknown_sources_are_rejected(self):
+        with self.assertRaises(CommandError):
+            call_command('fetch_referrer_logs', '--source', 'ftp:somewhere', stdout=StringIO())
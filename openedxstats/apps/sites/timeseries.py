@@ -0,0 +1,56 @@
+"""
+Per-day totals over versioned intervals, computed with a sweep line.
+
+Site versions and OverCounts are each valid over a closed interval [start, end], where an end of None means the
+row is still current. Rather than querying the database once per day, every interval becomes a +value event at the
+first day it covers and a -value event just after the last one, and a running sum over those events gives the
+total for every day at once. NumPy is used when it is installed; the pure Python path gives the same results.
+"""
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from itertools import accumulate
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+def interval_sums(days, intervals):
+    """
+    For each datetime in the ascending list `days`, sum the values of the (start, end, value) `intervals` for which
+    start <= day <= end. An end of None never expires, and a value of None counts as 0.
+    Returns a list of ints, one per day.
+    """
+    if numpy is not None:
+        return _interval_sums_numpy(days, intervals)
+    return _interval_sums_python(days, intervals)
+
+
+def _interval_sums_python(days, intervals):
+    deltas = [0] * (len(days) + 1)
+    for start, end, value in intervals:
+        first = bisect_left(days, start)
+        last = len(days) if end is None else bisect_right(days, end)
+        if first < last:
+            deltas[first] += value or 0
+            deltas[last] -= value or 0
+    return list(accumulate(deltas[:-1]))
+
+
+def _interval_sums_numpy(days, intervals):
+    if not intervals:
+        return [0] * len(days)
+    starts, ends, values = zip(*intervals)
+    day_array = numpy.array(days, dtype='datetime64[us]')
+    first = numpy.searchsorted(day_array, numpy.array(starts, dtype='datetime64[us]'), side='left')
+    ends = numpy.array([datetime.max if end is None else end for end in ends], dtype='datetime64[us]')
+    last = numpy.searchsorted(day_array, ends, side='right')
+    values = numpy.array([value or 0 for value in values], dtype=numpy.int64)
+
+    covers_a_day = first < last
+    first, last, values = first[covers_a_day], last[covers_a_day], values[covers_a_day]
+    deltas = numpy.zeros(len(days) + 1, dtype=numpy.int64)
+    numpy.add.at(deltas, first, values)
+    numpy.subtract.at(deltas, last, values)
+    return numpy.cumsum(deltas[:-1]).tolist()
@@ -5,7 +5,9 @@ app_name = 'sites'
 urlpatterns = [
     url(r'^sites/all/$', views.ListAllView.as_view(), name='sites_all_list'),
     url(r'^sites/all/json$', views.SiteView_JSON, name='sites_list_json'),
+    url(r'^sites/all/json/v2$', views.SiteView_JSON_v2, name='sites_list_json_v2'),
     url(r'^sites/current/$', views.ListView.as_view(), name='sites_list'),
+    url(r'^sites/geo_counts\.json$', views.geo_counts_json, name='sites_geo_counts_json'),
     url(r'^sites/map/$', views.MapView.as_view(), name='sites_map'),
     url(r'^sites/stats/$', views.stats_view, name='sites_stats'),
     url(r'^sites/add_site/$', views.add_site, name='add_site'),
@@ -19,4 +21,5 @@ urlpatterns = [
     url(r'^sites/csv/$', views.sites_csv_view, name='sites_csv'),
     url(r'^sites/bulk_update/$', views.bulk_update),
     url(r'^sites/bulk_create/$', views.bulk_create),
+    url(r'^sites/bulk_jobs/(?P<pk>[0-9]+)/$', views.bulk_job_status, name='bulk_job_status'),
 ]
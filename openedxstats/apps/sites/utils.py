@@ -0,0 +1,9 @@
+"""
+Helpers shared by the sites management commands.
+"""
+import functools
+
+from dateutil import parser
+
+# Parsing dates is slow, and csv exports repeat the same few a lot
+parse_date = functools.lru_cache(maxsize=4096)(parser.parse)
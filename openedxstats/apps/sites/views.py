@@ -1,63 +1,185 @@
 import csv
-from datetime import datetime, timedelta
+from datetime import datetime, time
 import requests
 import json
 import re
-from urllib import parse
 
 import yaml
 
 from django.shortcuts import render, get_object_or_404
 from django.views import generic
-from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
+from django.http import HttpResponseRedirect, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.urls import reverse, reverse_lazy
 
 from django.contrib import messages
 from django.core import serializers
-from django.core.exceptions import ValidationError
-from django.db.models import Count, Sum, Q
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import BadRequest, ValidationError
+from django.db.models import Count, F, Sum, Q
+from django.utils.dateparse import parse_date, parse_datetime
 from django.views.decorators.csrf import csrf_exempt
 from openedxstats.apps.sites.models import (
-    Site, SiteLanguage, SiteGeoZone, Language, GeoZone, SiteSummarySnapshot,
-    AccessLogAggregate, OverCount,
+    Site, TagSet, Language, GeoZone, SiteSummarySnapshot,
+    DomainDailyTraffic, OverCount, BulkJob, get_netloc,
 )
+from openedxstats.apps.sites import bulk
 from openedxstats.apps.sites.forms import SiteForm, LanguageForm, GeoZoneForm
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+# PyYAML's libyaml-based loader is many times faster than the pure Python one, when it was built with libyaml
+YamlSafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 def bool_option(request, opt_name):
     return request.GET.get(opt_name, "f").lower()[0] in "ty1"
 
+
+def as_of_option(request):
+    """
+    The datetime in the `as_of` parameter (YYYY-MM-DD or YYYY-MM-DD HH:MM), or None if it wasn't given.
+    A date alone means the last second of that day, as in the daily summaries.
+    """
+    value = request.GET.get("as_of", "")
+    if not value:
+        return None
+    try:
+        when = parse_datetime(value)
+        if when is None:
+            day = parse_date(value)
+            if day is not None:
+                when = datetime.combine(day, time(23, 59, 59))
+    except ValueError:
+        when = None
+    if when is None:
+        raise BadRequest(f"Invalid as_of date: {value!r}")
+    return when
+
+
+def listed_sites(request):
+    """
+    The site versions for the list views: the valid current ones, or every version with `all`.
+    With `as_of`, only the versions that were active at that time.
+    """
+    as_of = as_of_option(request)
+    if as_of is not None:
+        sites = Site.objects.as_of(as_of)
+    elif bool_option(request, "all"):
+        sites = Site.objects.all()
+    else:
+        sites = Site.objects.filter(active_end_date=None)
+
+    if not bool_option(request, "all"):
+        sites = sites.filter(valid_sites_query())
+    return sites
+
+
 # Converts site data into JSON format for Ajax request
 def SiteView_JSON(request):
     resp_data = {}
 
-    if bool_option(request, "all"):
-        sites = Site.objects.all()
-    else:
-        sites = Site.objects.exclude(active_end_date__isnull=False).filter(valid_sites_query())
+    sites = listed_sites(request)
 
     resp_data["sites"] = serializers.serialize("json", sites)
 
     if bool_option(request, "lang"):
-        resp_data["language"] = serializers.serialize("json", SiteLanguage.objects.all())
+        resp_data["language"] = site_tags_json("sites.sitelanguage", "language", "tag_set__languages")
 
     if bool_option(request, "geo"):
-        resp_data["geo"] = serializers.serialize("json", SiteGeoZone.objects.all())
+        resp_data["geo"] = site_tags_json("sites.sitegeozone", "geo_zone", "tag_set__geozones")
 
     if bool_option(request, "active_counts"):
-        active_sites = Site.objects.exclude(active_end_date__isnull=False)
-        active_sites_id_set = {site['id'] for site in active_sites.values('id')}
-        country_list = [country['geo_zone'] for country in SiteGeoZone.objects.values('geo_zone').order_by('geo_zone').distinct()]
-        country_site_count_dict = {country: 0 for country in country_list}
-        all_geozone = SiteGeoZone.objects.values('site_id', 'geo_zone')
-        for loc in all_geozone:
-            site_id = loc['site_id']
-            geo_zone = loc['geo_zone']
-            if site_id in active_sites_id_set and active_sites.get(id=site_id).course_count != 0:
-                country_site_count_dict[geo_zone] += 1
-        resp_data["activeSitesCount"] = country_site_count_dict
+        resp_data["activeSitesCount"] = active_site_counts_by_geozone()
 
     return JsonResponse(resp_data)
 
+
+def site_tags_json(model_name, field_name, tags_field):
+    """
+    The languages or geozones of every site version, serialized like the SiteLanguage and SiteGeoZone junction rows
+    they were stored as before tag sets (without ids), for clients of SiteView_JSON's `lang` and `geo` options.
+    """
+    return json.dumps([
+        {"model": model_name, "pk": None, "fields": {"site": site_id, field_name: name}}
+        for site_id, names in Site.objects.exclude(tag_set=None).order_by('pk').values_list('pk', tags_field)
+        for name in names
+    ])
+
+
+# Columns of each site row served by SiteView_JSON_v2, in order
+SITE_JSON_FIELDS = (
+    'id', 'site_type', 'name', 'url', 'course_count', 'active_start_date', 'active_end_date',
+    'is_gone', 'notes', 'aliases', 'languages', 'geographies',
+)
+
+# Number of rows fetched from the server-side cursor and encoded per streamed chunk
+JSON_STREAM_CHUNK_SIZE = 2000
+
+
+def sites_with_tags(sites):
+    """
+    Annotate a Site queryset with the sorted arrays of language and geozone names of its tag set, so a site and its
+    tags come back as one row from one query, joining one TagSet row per site. Sites without tags get None, not an
+    array.
+    """
+    return sites.annotate(languages=F('tag_set__languages'), geographies=F('tag_set__geozones'))
+
+
+def stream_site_rows(rows):
+    """
+    Encode (SITE_JSON_FIELDS) tuples as a single JSON document {"sites": [{...}, ...]}, yielding it in chunks.
+    """
+    encoder = DjangoJSONEncoder()
+    yield '{"sites": ['
+    chunk = []
+    separator = ''
+    for row in rows:
+        site = dict(zip(SITE_JSON_FIELDS, row))
+        site['languages'] = site['languages'] or []
+        site['geographies'] = site['geographies'] or []
+        chunk.append(separator + encoder.encode(site))
+        separator = ','
+        if len(chunk) >= JSON_STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    yield ''.join(chunk) + ']}'
+
+
+def SiteView_JSON_v2(request):
+    """
+    Flat site list for the sites pages: one row per site version with its languages and geographies inlined.
+    Unlike SiteView_JSON, nothing in the payload needs a second JSON.parse on the client.
+    """
+    rows = sites_with_tags(listed_sites(request)).order_by('id').values_list(*SITE_JSON_FIELDS)
+    return StreamingHttpResponse(
+        stream_site_rows(rows.iterator(chunk_size=JSON_STREAM_CHUNK_SIZE)),
+        content_type='application/json',
+    )
+
+
+def active_site_counts_by_geozone():
+    """
+    Count current site versions with a non-zero course count in each geozone that has ever had a site, in one query
+    that counts the sites of each tag set; the sets' counts are then added up per geozone.
+    """
+    active_site = Q(site__active_end_date__isnull=True) & ~Q(site__course_count=0)
+    tag_sets = TagSet.objects.annotate(
+        count=Count('site', filter=active_site), num_sites=Count('site')
+    ).filter(num_sites__gt=0).values_list('geozones', 'count')
+    counts = {}
+    for geozones, count in tag_sets:
+        for geozone in geozones:
+            counts[geozone] = counts.get(geozone, 0) + count
+    return dict(sorted(counts.items()))
+
+
+def geo_counts_json(request):
+    """
+    Per-country active site counts for the map choropleth, without the site list.
+    """
+    return JsonResponse({"activeSitesCount": active_site_counts_by_geozone()})
+
+
 class ListSomeView(generic.TemplateView):
     template_name = 'sites/sites_list.html'
 
@@ -90,9 +212,16 @@ class MapView(generic.ListView):
     context_object_name = 'sites_map'
 
 def stats_view(request):
-    active_sites = Site.objects.exclude(active_end_date__isnull=False).filter(valid_sites_query()).aggregate(sites=Count('*'), courses=Sum('course_count'))
-    over_count = OverCount.objects.all().last().course_count
-    valid_course_count = active_sites['courses'] - over_count
+    as_of = as_of_option(request)
+    if as_of is None:
+        sites = Site.objects.filter(active_end_date=None)
+        over_counts = OverCount.objects.all()
+    else:
+        sites = Site.objects.as_of(as_of)
+        over_counts = OverCount.objects.as_of(as_of)
+    active_sites = sites.filter(valid_sites_query()).aggregate(sites=Count('*'), courses=Sum('course_count'))
+    over_count = over_counts.last()
+    valid_course_count = (active_sites['courses'] or 0) - (over_count.course_count if over_count else 0)
     language_count = Language.objects.all().count()
     geozones_count = GeoZone.objects.all().count()
     stats_dict = {
@@ -110,61 +239,41 @@ def json_response(text=None, data=None, **response_kwargs):
     return HttpResponse(text, content_type='application/json', **response_kwargs)
 
 
-def get_netloc(url):
-    """
-    Return domain of url if parseable
-    """
-    if '//' in url:
-        netloc = parse.urlparse(url).netloc
-    else:
-        netloc = url
-    return netloc.rstrip(".")
-
-
 class SiteDiscoveryListView(generic.TemplateView):
     template_name = 'sites/site_discovery.html'
 
     def discover_domains(self, start_date, end_date):
         """
-        Grab aggregate referrer logs from database (that were generated by referrer log script), and compare to sites
-        on record, returning domain names that are not in sites list.
+        Grab daily referrer counts from the database (rolled up from the referrer logs by fetch_referrer_logs), and
+        compare to sites on record, returning domain names that are not in sites list, most unique visitors first.
+        Unique visitors are estimated by merging the domain's daily visitor sketches, and are None for domains whose
+        traffic was counted before sketches were kept.
         """
-
-        # This is hundreds of thousands of records, and will grow considerably unless the database is regularly cleaned
-        # If loading the discovery page begins to lag considerably, a default query other than all data available
-        # (e.g. logs from the last day only) should be considered to shorten initial load time
-        sites = Site.objects.all()
         known_domains = set()
-        known_domains.update(get_netloc(site.url) for site in sites)
-        known_domains.update(get_netloc(url) for site in sites for url in site.aliases)
-
-        # Filter out all logs with domains that are: aws owned, edx owned, blank, an ip address, and/or have a custom port
-        # Then aggregate based on domain and access date
-        aggregate_logs_by_day = AccessLogAggregate.objects.filter(
-            ~Q(domain__endswith='.amazonaws.com') & ~Q(domain__endswith='.edx.org') & ~Q(domain='') &
-             ~Q(domain__regex=r'^[0-9]+(?:\.[0-9]+){3}$') & ~Q(domain__regex=r':[0-9]+')
-        ).values(
-            'access_date',
-            'domain'
-        ).annotate(
-            count=Sum('access_count')
-        )
+        for url, aliases in Site.objects.values_list('url', 'aliases'):
+            known_domains.add(get_netloc(url))
+            known_domains.update(get_netloc(alias) for alias in aliases)
+
+        # The rollup only has domains that aren't aws owned, edx owned, blank, an ip address, or on a custom port
+        domain_traffic = DomainDailyTraffic.objects.all()
 
         # If date range specified, filter dates accordingly
         if start_date != '' and end_date != '':
-            aggregate_logs_by_day = aggregate_logs_by_day.filter(access_date__range=[start_date, end_date])
+            domain_traffic = domain_traffic.filter(access_date__range=[start_date, end_date])
 
-        # Filter out objects that don't fall within date range and then combine into one record
-        aggregate_logs_by_day = aggregate_logs_by_day.values('domain').annotate(count=Sum('access_count'))
+        # Leave out domains already on record, either as they are or without a www/studio/... subdomain
+        domain_traffic = domain_traffic.exclude(domain__netloc__in=known_domains).exclude(
+            domain__short_netloc__in=known_domains
+        )
 
-        # Add to final query set if domain isn't already on record
-        chaff = ['www', 'studio', 'staging', 'preview', 'stage', 'cms']
-        new_domains = []
-        for log in aggregate_logs_by_day:
-            netloc = get_netloc(log['domain'])
-            short_netloc = ".".join(part for part in netloc.split(".") if part not in chaff)
-            if netloc not in known_domains and short_netloc not in known_domains:
-                new_domains.append(log)
+        # Combine the days in range into one record per domain
+        visitors = DomainDailyTraffic.unique_visitors(domain_traffic)
+        domain_traffic = domain_traffic.values('domain__name').annotate(count=Sum('access_count')).order_by()
+        new_domains = [
+            {'domain': log['domain__name'], 'count': log['count'], 'visitors': visitors.get(log['domain__name'])}
+            for log in domain_traffic
+        ]
+        new_domains.sort(key=lambda domain: (domain['visitors'] or 0, domain['count']), reverse=True)
 
         return new_domains
 
@@ -174,71 +283,27 @@ class SiteDiscoveryListView(generic.TemplateView):
 
 
 class OTChartView(generic.list.MultipleObjectTemplateResponseMixin, generic.list.BaseListView):
+    """
+    Chart of the SiteSummarySnapshots, including the daily ones kept up to date by materialize_daily_summaries.
+    """
     model = SiteSummarySnapshot
     template_name = 'sites/ot_chart.html'
     context_object_name = 'snapshot_list'
 
-    def daterange(self, start_date, end_date):
-        """
-        This function is used to generate a date range, with one day increments. Notice the +1 adjustment on day, and -1
-        adjustment on seconds. This is used to ensure each day is actually a datetime of the last second of that day, to
-        allow for correct aggregation when querying the database with these dates.
-        """
-        for n in range(int((end_date - start_date).days)):
-            yield start_date + timedelta(days=n+1, seconds=-1)
-
-    def generate_summary_data(self, start_datetime):
-        """
-        Generate site total and course totals by day since ending of site summary snapshots were recorded
-        """
-        daily_summary_obj_list = []
-        # Generate a summary of total sites and courses active for each day in a range of dates
-        for day in self.daterange(start_datetime, datetime.now() + timedelta(days=1)):
-            # Query to get all site versions that are active within the specified date period
-            # We only count public sites with > 0 courses, and count all private sites
-            date_select = (
-                Q(active_start_date__lte=day) &
-                (Q(active_end_date__gte=day) | Q(active_end_date=None))
-            )
-
-            day_stats = Site.objects.filter(
-                valid_sites_query() &
-                date_select
-            ).aggregate(sites=Count('*'), courses=Sum('course_count'))
-            try:
-                over_count = OverCount.objects.get(date_select).course_count
-            except OverCount.DoesNotExist:
-                over_count = 0
-            # Generate summary object for day
-
-            daily_courses_count = day_stats['courses']
-            if daily_courses_count is None:
-                daily_courses_count = 0
-
-            print(f"Making a new summary for {day}")
-            daily_summary_obj = SiteSummarySnapshot(
-                timestamp=day,
-                num_sites=day_stats['sites'],
-                num_courses=daily_courses_count - over_count,
-                notes="Auto-generated day summary"
-            )
-            daily_summary_obj.save()
-            daily_summary_obj_list.append(daily_summary_obj)
-
-        return daily_summary_obj_list
-
     def post(self, request, *args, **kwargs):
-        old_ot_data = []
-        new_ot_data = []
-        if SiteSummarySnapshot.objects.count() > 0 or Site.objects.count() > 0:
-            # Get old data (pre-historical tracking implementation)
-            old_ot_data = list(SiteSummarySnapshot.objects.all())
-            # Gets oldest site summary snapshot from db, after this point we will generate statistics from site versions
-            start_datetime = SiteSummarySnapshot.objects.all().order_by('-timestamp').first().timestamp + timedelta(days=1)
-            # Generate new data
-            new_ot_data = self.generate_summary_data(start_datetime)
-
-        serialized_data = serializers.serialize('json', old_ot_data+new_ot_data)
+        snapshots = SiteSummarySnapshot.objects.order_by('timestamp', 'pk')
+
+        # If date range specified, filter dates accordingly
+        start_date = request.POST.get('start_date', '')
+        end_date = request.POST.get('end_date', '')
+        if start_date != '':
+            snapshots = snapshots.filter(timestamp__gte=start_date)
+        if end_date != '':
+            snapshots = snapshots.filter(timestamp__lte=end_date)
+
+        serialized_data = serializers.serialize(
+            'json', snapshots, fields=('timestamp', 'num_sites', 'num_courses', 'notes')
+        )
         return json_response(text=serialized_data)
 
 
@@ -296,21 +361,10 @@ def add_site(request, pk=None):
 
             languages = form.cleaned_data.pop('language')
             geozones = form.cleaned_data.pop('geography')
+            new_site.tag_set_id = TagSet.id_for([l.name for l in languages], [g.name for g in geozones])
 
             new_site.save(force_insert=True)
 
-            if pk: # Delete existing languages and geographies if updating to prevent duplicates
-                new_site.language.clear()
-                new_site.geography.clear()
-
-            for l in languages:
-                site_language = SiteLanguage.objects.create(language=l, site=new_site)
-                site_language.save()
-
-            for g in geozones:
-                site_geozone = SiteGeoZone.objects.create(geo_zone=g, site=new_site)
-                site_geozone.save()
-
             messages.success(request, 'Success! A new site version has been added!')
             return HttpResponseRedirect(reverse('sites:sites_list'))
 
@@ -398,84 +452,129 @@ def sites_csv_view(request):
         traceback.print_exc()
         raise
 
+# Number of rows fetched from the server-side cursor and written per streamed chunk of the sites CSV
+CSV_STREAM_CHUNK_SIZE = 2000
+
+
+class Echo:
+    """
+    A file-like object whose write() returns what's written, so a csv.writer can encode a row at a time for a
+    streamed response.
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv_rows(fieldnames, rows):
+    """
+    Encode the header and the `rows` as CSV, yielding it in chunks.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(fieldnames)
+    chunk = []
+    for row in rows:
+        chunk.append(writer.writerow(row))
+        if len(chunk) >= CSV_STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    yield ''.join(chunk)
+
+
+def site_csv_rows(values, num_attrs):
+    """
+    Format (attrs..., tag name arrays..., active_start_date) tuples as sites CSV rows: tags joined like
+    Site.get_languages, and the start date to the second as the `updated` column.
+    """
+    for row in values:
+        tags = (", ".join(names or []) for names in row[num_attrs:-1])
+        yield [*row[:num_attrs], *tags, row[-1].replace(microsecond=0)]
+
+
 def _sites_csv_view(request):
+    """
+    The current sites, or those active `as_of` a time, as CSV, streamed from a server-side cursor: gone sites are
+    filtered out in SQL unless `include_gone`, and each site's languages and geographies come from the same query
+    unless `skip_lang_geo`.
+    """
     include_gone = bool(request.GET.get("include_gone", ""))
     skip_lang_geo = bool(request.GET.get("skip_lang_geo", ""))
 
-    sites = Site.objects.filter(active_end_date=None)
-    if not skip_lang_geo:
-        sites.select_related("language", "geography")
+    as_of = as_of_option(request)
+    sites = Site.objects.filter(active_end_date=None) if as_of is None else Site.objects.as_of(as_of)
     if not include_gone:
-        sites = [site for site in sites if not site.is_gone]
+        sites = sites.filter(is_gone=False)
 
     attrs = ['name', 'url', 'course_count']
     if include_gone:
         attrs.extend(['is_private_instance', 'is_gone'])
-    methods = []
+    tags = []
     if not skip_lang_geo:
-        methods.extend(['languages', 'geographies'])
+        tags.extend(['languages', 'geographies'])
+        sites = sites_with_tags(sites)
     other = ['updated']
 
-    response = HttpResponse(content_type='text/csv')
+    values = sites.order_by('pk').values_list(*attrs, *tags, 'active_start_date')
+    rows = site_csv_rows(values.iterator(chunk_size=CSV_STREAM_CHUNK_SIZE), len(attrs))
+    response = StreamingHttpResponse(stream_csv_rows(attrs + tags + other, rows), content_type='text/csv')
     response['Content-Disposition'] = 'attachment; filename="sites.csv"'
-    writer = csv.DictWriter(response, fieldnames=attrs + methods + other)
-    writer.writeheader()
-    for site in sites:
-        row = {a: getattr(site, a) for a in attrs}
-        row.update({m: getattr(site, 'get_'+m)() for m in methods})
-        row.update({'updated': site.active_start_date.replace(microsecond=0)})
-        writer.writerow(row)
-
     return response
 
 
+def queued_job_response(request, job, **extra):
+    """
+    The response to a bulk request queued with `async`: the job's id and where to follow its progress.
+    """
+    status_url = request.build_absolute_uri(reverse('sites:bulk_job_status', args=[job.pk]))
+    return json_response(data={'job': job.pk, 'status_url': status_url, **extra}, status=202)
+
+
+def ndjson_records(request):
+    """
+    The objects in an NDJSON request body, read from the request a line at a time, or None if the body isn't
+    NDJSON. The body may be gzipped, with Content-Encoding: gzip.
+    """
+    if request.content_type != NDJSON_CONTENT_TYPE:
+        return None
+    return bulk.read_ndjson(request, gzipped=request.headers.get('Content-Encoding', '').lower() == 'gzip')
+
+
 @csrf_exempt
 def bulk_update(request):
+    """
+    Start new versions of the sites in the payload whose course counts or is_gone flags have changed. Sites are
+    matched by url or alias, ignoring scheme, case and trailing slashes, and all of them are updated in one
+    transaction. Sites that haven't changed are reported as unchanged and only have their SiteCheck touched.
+
+    With `async`, the sites are queued as a BulkJob for the run_bulk_jobs command instead, and the response has
+    the job's id; each chunk of the job is then updated in its own transaction. The over-count is only recorded once
+    every chunk is done, so the response's updated_over_count is false and the job's status says when it was.
+
+    The payload can also be NDJSON (see bulk.update_chunks), which is updated a chunk at a time as it's read, with
+    the results streamed back as NDJSON.
+    """
+    records = ndjson_records(request)
+    if records is not None:
+        if bool_option(request, "async"):
+            over_counts = []
+            try:
+                job = bulk.submit_job_chunks(
+                    BulkJob.UPDATE, bulk.update_chunks(records, bulk.JOB_CHUNK_SIZE, over_counts), over_counts
+                )
+            except ValueError as ex:
+                # Nothing is queued
+                raise BadRequest(str(ex))
+            return queued_job_response(request, job, updated_over_count=job.over_count_set is not None)
+        return StreamingHttpResponse(bulk.stream_updates(records), content_type=NDJSON_CONTENT_TYPE)
+
     updates = json.loads(request.body.decode('utf8'))
 
-    now = datetime.now()
-    updated = []
-    not_found = []
-
-    for siteurl, update in list(updates['sites'].items()):
-        site_match = Q(url__endswith=siteurl) | Q(url__endswith=siteurl+"/")
-        sites = Site.objects.filter(site_match, active_end_date=None)
-        if not sites:
-            not_found.append(siteurl)
-            continue
-        site = sites[0]
-
-        # The old Site ends now.
-        site.active_end_date = now
-        site.save()
-
-        languages = list(site.language.all())
-        geo_zones = list(site.geography.all())
-
-        # Make a copy of the site with new info.
-        site.pk = None
-        site.active_start_date = now
-        site.active_end_date = None
-        site.course_count = update['course_count']
-        site.is_gone = update['is_gone']
-        site.save()
-
-        for lang in languages:
-            SiteLanguage.objects.create(language=lang, site=site).save()
-        for geo_zone in geo_zones:
-            SiteGeoZone.objects.create(geo_zone=geo_zone, site=site).save()
-
-        updated.append(siteurl)
-
-    resp = {'updated': updated, 'not_found': not_found}
-
-    over_count = updates.get("overcount")
-    if over_count is not None:
-        OverCount.set_latest(over_count)
-        resp['updated_over_count'] = True
-    else:
-        resp['updated_over_count'] = False
+    if bool_option(request, "async"):
+        job = bulk.submit_job(BulkJob.UPDATE, updates)
+        return queued_job_response(request, job, updated_over_count=job.over_count_set is not None)
 
+    resp = bulk.update_sites(updates['sites'])
+    resp['updated_over_count'] = bulk.set_over_count(updates.get("overcount"))
     return json_response(data=resp)
 
 @csrf_exempt
@@ -491,68 +590,43 @@ def bulk_create(request):
         - url: https://bar.bar
           count: 1
           language: French
-    """
 
-    sites = yaml.safe_load(request.body.decode("utf-8"))
-    now = datetime.now()
-    site_dicts = []
-    resp = []
-    ok = True
-
-    for site in sites:
-        siteurl = site["url"]
-        site_match = Q(url__endswith=siteurl) | Q(url__endswith=siteurl+"/")
-        existing_sites = Site.objects.filter(site_match, active_end_date=None)
-        if existing_sites:
-            resp.append(f"Error: {siteurl} already exists: {existing_sites}")
-            ok = False
-            continue
-
-        kwargs = {
-            k:v for k, v in site.items()
-            if v and (k in {"name", "url", "course_count", "notes"})
-            }
-
-        site_obj = Site(**kwargs)
-        site_dicts.append({"site": site_obj})
-
-        # This endpoint can only make a single language per site.
-        lang = site.get("language")
-        if lang:
-            try:
-                lang_obj = Language.objects.get(name=lang)
-            except Language.DoesNotExist:
-                resp.append(f"Error: Language {lang!r} doesn't exist")
-                ok = False
-                continue
-            site_dicts[-1]["lang"] = lang_obj
-
-        # This endpoint can only make a single geography per site.
-        geo = site.get("geography")
-        if geo:
-            try:
-                geo_obj = GeoZone.objects.get(name=geo)
-            except GeoZone.DoesNotExist:
-                resp.append(f"Error: GeoZone {geo!r} doesn't exist")
-                ok = False
-                continue
-            site_dicts[-1]["geo"] = geo_obj
+    With `async`, the sites are queued as a BulkJob for the run_bulk_jobs command instead, and the response has
+    the job's id. Each chunk of the job is checked and created on its own.
 
-    if ok:
-        for site_dict in site_dicts:
-            site_obj = site_dict["site"]
-            site_obj.save()
+    The payload can also be NDJSON, one site per line, which is created a chunk at a time as it's read, with the
+    messages streamed back as NDJSON. Each chunk is checked and created on its own.
+    """
+    records = ndjson_records(request)
+    if records is not None:
+        if bool_option(request, "async"):
+            try:
+                job = bulk.submit_job_chunks(
+                    BulkJob.CREATE, bulk.chunked(bulk.create_records(records), bulk.JOB_CHUNK_SIZE)
+                )
+            except ValueError as ex:
+                # Nothing is queued
+                raise BadRequest(str(ex))
+            return queued_job_response(request, job)
+        return StreamingHttpResponse(bulk.stream_creates(records), content_type=NDJSON_CONTENT_TYPE)
 
-            if "lang" in site_dict:
-                SiteLanguage.objects.create(language=site_dict["lang"], site=site_obj).save()
-            if "geo" in site_dict:
-                SiteGeoZone.objects.create(geo_zone=site_dict["geo"], site=site_obj).save()
+    sites = yaml.load(request.body.decode("utf-8"), Loader=YamlSafeLoader)
 
-        resp.append(f"Created {len(site_dicts)} sites")
+    if bool_option(request, "async"):
+        return queued_job_response(request, bulk.submit_job(BulkJob.CREATE, sites))
 
+    _, resp = bulk.create_sites(sites)
     return HttpResponse("\n".join(resp))
 
 
+def bulk_job_status(request, pk):
+    """
+    The progress and results so far of a BulkJob.
+    """
+    job = get_object_or_404(BulkJob, pk=pk)
+    return json_response(data=job.status())
+
+
 def valid_sites_query():
     """
     Helper function for stats_view and OTChartView to query valid sites